@@ -7,5 +7,9 @@ class MoneyAmountConfig(AppConfig):
 
     def ready(self):
         from . import signals
+        from . import settings as cur_settings
+        from .ratecache import rate_cache
         super(MoneyAmountConfig, self).ready()
+        if cur_settings.CACHE_EXCHANGE and cur_settings.CACHE_EXCHANGE_WARM:
+            rate_cache.warm()
         
\ No newline at end of file
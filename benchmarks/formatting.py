@@ -0,0 +1,51 @@
+"""
+Microbenchmark of CurrencyFormatter against the previous implementation of
+CurrencyExchangeRate.format(). Needs no database:
+
+DJANGO_SETTINGS_MODULE=... python -m moneyamount.benchmarks.formatting
+"""
+import re
+import timeit
+from decimal import Decimal
+
+
+def legacy_format(amount, exch):
+    """CurrencyExchangeRate.format() before the formatter registry"""
+    parts = divmod(amount, 1)
+    parts = int(parts[0]), int(parts[1] * pow(10, exch.decimal_places))
+    val = str(parts[0])
+    if exch.thousand_mark:
+        val = exch.thousand_mark.join(re.findall(r'((?:\d+\.)?\d{1,3})', val[::-1]))[::-1]
+    if exch.decimal_places:
+        dec = str(parts[1])
+        if exch.remove_decimal_zero:
+            dec = dec.rstrip('0')
+        elif len(dec) < exch.decimal_places:
+            dec += '0' * (exch.decimal_places - len(dec))
+        if dec:
+            val = val + exch.decimal_mark + dec
+    return val
+
+
+def run(number=100000):
+    from ..formatting import CurrencyFormatter
+    from ..models import CurrencyExchangeRate
+    item = CurrencyExchangeRate(iso_code='USD', decimal_mark='.', thousand_mark=',', decimal_places=2,
+                                remove_decimal_zero=False)
+    formatter = CurrencyFormatter.from_item(item)
+    amounts = [Decimal(i) * Decimal('137.31') for i in range(100)]
+    results = {}
+    for name, func in (
+            ('legacy', lambda: [legacy_format(amount, item) for amount in amounts]),
+            ('formatter', lambda: [formatter.format(amount) for amount in amounts]),
+            ('format_many', lambda: formatter.format_many(amounts))):
+        seconds = min(timeit.repeat(func, number=number // len(amounts), repeat=3))
+        results[name] = seconds / number * 1e6
+        print("%-12s %.3f us/amount" % (name, results[name]))
+    return results
+
+
+if __name__ == '__main__':
+    import django
+    django.setup()
+    run()
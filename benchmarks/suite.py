@@ -0,0 +1,176 @@
+"""
+Benchmarks of the hot paths, with the number of queries of each path
+asserted. Runs on the test database, i.e. local SQLite in CI, and is kept
+out of the regular test run by its module name:
+
+python manage.py test moneyamount.benchmarks.suite
+
+Environment variables:
+MONEYAMOUNT_BENCHMARK_SIZES      Data sizes, default "10,100,500"
+MONEYAMOUNT_BENCHMARK_BASELINE   Baseline to compare to, default baseline.json
+                                 next to this file
+MONEYAMOUNT_BENCHMARK_TOLERANCE  Fail if a path is this many times slower than
+                                 the baseline, default no timing comparison
+MONEYAMOUNT_BENCHMARK_SAVE       Write the results here, e.g. to update the
+                                 baseline
+
+Query counts are always compared to the baseline, where present. Note that
+on SQLite, sizes above 999 make in_bulk() split its query in batches.
+"""
+import json
+import os
+import timeit
+from decimal import Decimal
+
+from django.forms import modelformset_factory
+from django.test import TestCase
+
+from ..forms import MoneyAmountModelFormSet
+from ..models import CurrencyExchangeRate, MoneyAmount
+from ..ratecache import rate_cache
+from ..tests import Order
+from .. import settings as cur_settings
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Aim at timing about this many items per repetition
+ITEMS_PER_REPEAT = 2000
+
+
+def get_sizes():
+    sizes = os.environ.get('MONEYAMOUNT_BENCHMARK_SIZES', '10,100,500')
+    return [int(size) for size in sizes.split(',') if size.strip()]
+
+
+def load_baseline(path=None):
+    path = path or os.environ.get('MONEYAMOUNT_BENCHMARK_BASELINE') or BASELINE
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def compare(result, baseline, tolerance=None):
+    """
+    Returns a list of regressions of `result` compared to `baseline`, both
+    dicts like {'queries': ..., 'us_per_item': ...}
+    """
+    regressions = []
+    if result['queries'] != baseline['queries']:
+        regressions.append("%d queries, baseline %d" % (result['queries'], baseline['queries']))
+    if tolerance and result['us_per_item'] > baseline['us_per_item'] * tolerance:
+        regressions.append("%.3f us/item, baseline %.3f" % (result['us_per_item'], baseline['us_per_item']))
+    return regressions
+
+
+class MoneyAmountBenchmark(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sizes = get_sizes()
+        currencies = ['USD', 'EUR', 'SEK']
+        Order.objects.bulk_create([
+            Order(price=MoneyAmount(amount=Decimal(i) + Decimal('0.25'), currency=currencies[i % 3]),
+                  inline_price=Decimal(i))
+            for i in range(max(cls.sizes))
+        ])
+        cls.baseline = load_baseline()
+        tolerance = os.environ.get('MONEYAMOUNT_BENCHMARK_TOLERANCE')
+        cls.tolerance = float(tolerance) if tolerance else None
+
+    @classmethod
+    def tearDownClass(cls):
+        path = os.environ.get('MONEYAMOUNT_BENCHMARK_SAVE')
+        if path:
+            with open(path, 'w') as f:
+                json.dump(cls.results, f, indent=2, sort_keys=True)
+        super(MoneyAmountBenchmark, cls).tearDownClass()
+
+    def setUp(self):
+        self.cache_exchange = cur_settings.CACHE_EXCHANGE
+        cur_settings.CACHE_EXCHANGE = True
+        rate_cache.clear()
+        rate_cache.get()
+
+    def tearDown(self):
+        cur_settings.CACHE_EXCHANGE = self.cache_exchange
+        rate_cache.clear()
+
+    def measure(self, name, size, func, queries):
+        """
+        Asserts that func() makes `queries` queries, then times it and
+        compares the result to the baseline
+        """
+        key = "%s@%d" % (name, size)
+        with self.assertNumQueries(queries):
+            func()
+        number = max(1, ITEMS_PER_REPEAT // size)
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        result = {'queries': queries, 'us_per_item': round(seconds / number / size * 1e6, 4)}
+        self.results[key] = result
+        print("%-34s %5d queries %10.3f us/item" % (key, queries, result['us_per_item']))
+        if key in self.baseline:
+            regressions = compare(result, self.baseline[key], self.tolerance)
+            if regressions:
+                self.fail("%s: %s" % (key, ", ".join(regressions)))
+
+    def amounts(self, size):
+        return [Decimal(i) + Decimal('0.25') for i in range(size)]
+
+    def test_convert(self):
+        for size in self.sizes:
+            amounts = self.amounts(size)
+            self.measure('convert', size, lambda: [
+                CurrencyExchangeRate.convert(amount, 'USD', 'EUR') for amount in amounts], 0)
+
+    def test_get_exchange_rate_item(self):
+        def miss():
+            rate_cache.clear()
+            CurrencyExchangeRate.get_exchange_rate_item('USD')
+
+        for size in self.sizes:
+            self.measure('get_exchange_rate_item.hit', size, lambda: [
+                CurrencyExchangeRate.get_exchange_rate_item('USD') for i in range(size)], 0)
+            # A miss reloads the whole snapshot with one query
+            self.measure('get_exchange_rate_item.miss', size, lambda: [miss() for i in range(size)], size)
+
+    def test_format(self):
+        for size in self.sizes:
+            amounts = self.amounts(size)
+            self.measure('format', size, lambda: [CurrencyExchangeRate.format(amount, 'USD') for amount in amounts], 0)
+            self.measure('format_many', size, lambda: CurrencyExchangeRate.format_many(amounts, 'USD'), 0)
+
+    def test_arithmetic(self):
+        for size in self.sizes:
+            moneyamounts = list(MoneyAmount.objects.order_by('pk')[:size])
+            pairs = list(zip(moneyamounts, moneyamounts[1:] + moneyamounts[:1]))
+            self.measure('arithmetic', size, lambda: [a + b - a * 2 for a, b in pairs], 0)
+            self.measure('amount_as', size, lambda: [moneyamount.amount_as('EUR') for moneyamount in moneyamounts], 0)
+
+    def test_descriptor(self):
+        for size in self.sizes:
+            self.measure('descriptor.get', size, lambda: [
+                order.price.amount for order in Order.objects.select_related('price').order_by('pk')[:size]], 1)
+            orders = list(Order.objects.order_by('pk')[:size])
+            self.measure('descriptor.set', size, lambda: [
+                setattr(order, 'price', Decimal(5)) for order in orders], 0)
+
+    def test_formset_clean(self):
+        FormSet = modelformset_factory(Order, fields=['price'], formset=MoneyAmountModelFormSet, extra=0)
+        for size in self.sizes:
+            data = {'form-TOTAL_FORMS': str(size), 'form-INITIAL_FORMS': str(size)}
+            for i, order in enumerate(Order.objects.order_by('pk')[:size]):
+                data['form-%d-id' % i] = str(order.pk)
+                data['form-%d-price_0' % i] = str(order.price_id)
+                data['form-%d-price_1' % i] = '7'
+                data['form-%d-price_2' % i] = 'USD'
+
+            def clean():
+                formset = FormSet(data, queryset=Order.objects.order_by('pk')[:size])
+                assert formset.is_valid(), formset.errors
+
+            # The Orders and their MoneyAmounts are loaded with one query
+            # each and the MoneyAmounts are checked to be unique with one
+            # more, but every form still looks up its id
+            self.measure('formset.clean', size, clean, size + 3)
@@ -0,0 +1,120 @@
+from decimal import Decimal
+
+from django.core.exceptions import FieldError
+from django.db.models import Case, DecimalField, Expression, ExpressionWrapper, F, Sum, Value, When
+from django.db.models.constants import LOOKUP_SEP
+
+from .fields import InlineMoneyAmountField, MinorMoneyAmountField, MoneyAmountField
+from .minor import minor_units
+
+
+def money_column_paths(model, field_path):
+    """
+    Returns a dict with the lookup paths of the amount, currency and
+    base_amount columns of the MoneyAmountField, InlineMoneyAmountField or
+    MinorMoneyAmountField at field_path (e.g. 'price' or 'order__price'),
+    relative to model, and 'minor', which is True if the amount columns are
+    in minor units.
+    """
+    parts = field_path.split(LOOKUP_SEP)
+    for part in parts[:-1]:
+        model = model._meta.get_field(part).related_model
+    field = model._meta.get_field(parts[-1])
+    prefix = field_path[:-len(field.name)]
+    if isinstance(field, InlineMoneyAmountField):
+        return {
+            'amount': field_path,
+            'currency': prefix + field.currency_attname,
+            'base_amount': prefix + field.base_amount_attname,
+            'minor': False,
+        }
+    if isinstance(field, MinorMoneyAmountField):
+        return {
+            'amount': field_path,
+            'currency': prefix + field.currency_attname,
+            'base_amount': prefix + field.base_units_attname,
+            'minor': True,
+        }
+    if isinstance(field, MoneyAmountField):
+        return {
+            'amount': field_path + '__amount',
+            'currency': field_path + '__currency',
+            'base_amount': field_path + '__base_amount',
+            'minor': False,
+        }
+    raise FieldError("%s is not a MoneyAmountField, InlineMoneyAmountField or MinorMoneyAmountField" % field_path)
+
+
+class AmountIn(Expression):
+    """
+    The amount of a MoneyAmountField, InlineMoneyAmountField or
+    MinorMoneyAmountField, converted to currency in the database.
+
+    By default, the stored base_amount is divided by the exchange rate of
+    currency. With current=True, amount is converted from its own currency
+    with a CASE over the current exchange rates instead, matching currencies
+    case-insensitively; rows in a currency without an active exchange rate
+    fall back to the stored base_amount.
+
+    Intended usage:
+    Order.objects.order_by(AmountIn('price', 'USD'))
+    """
+    def __init__(self, field, currency, current=False, output_field=None):
+        if output_field is None:
+            output_field = DecimalField(max_digits=20, decimal_places=4)
+        super(AmountIn, self).__init__(output_field=output_field)
+        self.field_path = field
+        self.currency = currency
+        self.current = current
+
+    def __repr__(self):
+        return "%s(%r, %r, current=%r)" % (self.__class__.__name__, self.field_path, self.currency, self.current)
+
+    def _rate_value(self, rate):
+        return Value(Decimal(rate), output_field=DecimalField())
+
+    def build(self, model):
+        """Returns the equivalent expression built from F() and Case()"""
+        from .models import CurrencyExchangeRate
+        paths = money_column_paths(model, self.field_path)
+        base_currency = CurrencyExchangeRate.base_currency()
+        to_currency = self.currency.upper()
+        stored = F(paths['base_amount'])
+        if paths['minor']:
+            stored = stored * self._rate_value(Decimal(1).scaleb(-minor_units(base_currency)))
+        if to_currency != base_currency:
+            stored = stored / self._rate_value(CurrencyExchangeRate.get_exchange_rate(to_currency))
+        if not self.current:
+            expression = stored
+        else:
+            currencies = self._currencies()
+            factors = CurrencyExchangeRate.convert_matrix([1] * len(currencies), currencies, [to_currency])
+            if paths['minor']:
+                factors = [[row[0].scaleb(-minor_units(currency))] for currency, row in zip(currencies, factors)]
+            expression = Case(*[
+                When(**{paths['currency'] + '__iexact': currency, 'then': F(paths['amount']) * self._rate_value(row[0])})
+                for currency, row in zip(currencies, factors)
+            ], default=stored, output_field=self.output_field)
+        return ExpressionWrapper(expression, output_field=self.output_field)
+
+    def _currencies(self):
+        from .models import CurrencyExchangeRate
+        currencies = set(CurrencyExchangeRate.active_currencies())
+        currencies.update([CurrencyExchangeRate.base_currency(), self.currency.upper()])
+        return sorted(currencies)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        return self.build(query.model).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+
+class SumIn(Sum):
+    """
+    Sum of the amounts of a MoneyAmountField, InlineMoneyAmountField or
+    MinorMoneyAmountField, converted to currency in the database. See
+    AmountIn.
+
+    Intended usage:
+    Order.objects.values('customer').annotate(total=SumIn('price', 'EUR'))
+    """
+    def __init__(self, field, currency, current=False, **extra):
+        super(SumIn, self).__init__(AmountIn(field, currency, current=current), **extra)
@@ -1,13 +1,38 @@
+from decimal import Decimal
+
+from django.core import exceptions
 from django.db.models import CASCADE
 from django.db.models.fields.related import ForwardOneToOneDescriptor
-from django.db.models import OneToOneField
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models import BigIntegerField, CharField, DecimalField, ForeignKey, OneToOneField
+from django import forms
+from django.db import router
+from django.db.models.fields.related_descriptors import ForeignKeyDeferredAttribute
+from django.db.models.signals import post_delete, post_save
 
 from .forms import MoneyAmountFormField
+from .money import Money
+from . import lookups
+from .metrics import metrics
+from .minor import MinorMoney, fixed_rates, to_minor
+from . import settings as cur_settings
+from .totals import LOADED_MONEYAMOUNTS, add_delta, apply_deltas, counted_moneyamount, owner_deltas, owner_key, remember_counted
+from .utils import acall
+
+PENDING_MONEYAMOUNTS = '_pending_moneyamounts'
+REPLACED_MONEYAMOUNTS = '_replaced_moneyamounts'
+INLINE_BASE_VALUES_SOURCES = '_inline_base_values_sources'
+
 
 class MoneyAmountDescriptor(ForwardOneToOneDescriptor):
     """
     Modified descriptor which, in case the remote MoneyAmount field does not
-    exist on attempted access, will create a new one with default values.
+    exist on attempted access, will attach a new one with default values.
+
+    New MoneyAmount objects are only kept in memory (see pending()) and are
+    saved together with the instance, by MoneyAmountField.pre_save(). Old
+    MoneyAmount objects replaced by assignment are deleted after the instance
+    has been saved.
     """
     def __get__(self, instance, cls=None):
         """
@@ -16,50 +41,539 @@ class MoneyAmountDescriptor(ForwardOneToOneDescriptor):
         self.field.name = name of the MoneyAmountField field (e.g. 'original_price')
         self.field.remote_field.model = MoneyAmount object
         """
+        if instance is None:
+            return self
+        rel_obj = pending(instance).get(self.field.name)
+        if rel_obj is not None:
+            return rel_obj
         try:
-            return super(MoneyAmountDescriptor, self).__get__(instance, cls)
+            rel_obj = super(MoneyAmountDescriptor, self).__get__(instance, cls)
+            if cur_settings.TRACK_TOTALS and rel_obj is not None:
+                remember_counted(instance, self.field, rel_obj)
+            return rel_obj
         except self.RelatedObjectDoesNotExist:
-            # Create new MoneyField:
+            # Attach a new, unsaved MoneyAmount:
             rel_obj = self.field.remote_field.model()
-            # Object has to be saved BEFORE the relation is made:
-            rel_obj.save()
-            # Make the relation to it:
-            super(MoneyAmountDescriptor, self).__set__(instance, rel_obj)
-            return super(MoneyAmountDescriptor, self).__get__(instance, cls)
+            self._set_pending(instance, rel_obj)
+            if metrics.enabled:
+                metrics.incr('descriptor.create')
+            return rel_obj
 
     def __set__(self, instance, value):
         from .models import MoneyAmount
-        # If value is not a MoneyAmount object, assume it's a decimal amount
-        # and create a new MoneyAmount object
-        # Also delete the old related MoneyAmount object, if there is one
+        # If value is not a MoneyAmount object, assume it's a Money object or
+        # a decimal amount and create a new MoneyAmount object
+        # Also schedule the old related MoneyAmount object for deletion, if
+        # there is one
         if not isinstance(value, MoneyAmount):
-            if value is not None:
+            old_pk = instance.__dict__.get(self.field.attname)
+            if old_pk is not None:
+                instance.__dict__.setdefault(REPLACED_MONEYAMOUNTS, set()).add(old_pk)
+            if isinstance(value, Money):
+                value = MoneyAmount.from_money(value)
+            elif value is not None:
                 value = MoneyAmount(amount=value)
-                value.save()
-            try:
-                old_obj = getattr(instance, self.field.name)
-                old_obj.delete()
-            except:
-                pass
-        super(MoneyAmountDescriptor, self).__set__(instance, value)
+        pending(instance).pop(self.field.name, None)
+        if value is not None and value.pk is None:
+            self._set_pending(instance, value)
+        else:
+            super(MoneyAmountDescriptor, self).__set__(instance, value)
+
+    async def aget(self, instance):
+        """
+        Async variant of __get__(), which loads the related MoneyAmount
+        without blocking if it is neither pending nor cached.
+        """
+        rel_obj = pending(instance).get(self.field.name)
+        if rel_obj is not None:
+            return rel_obj
+        if self.field.is_cached(instance):
+            return self.field.get_cached_value(instance)
+        pk = instance.__dict__.get(self.field.attname)
+        if pk is None:
+            return self.__get__(instance)
+        rel_obj = await acall(self.field.remote_field.model._base_manager.filter(pk=pk), 'get')
+        self.field.set_cached_value(instance, rel_obj)
+        return rel_obj
+
+    def _set_pending(self, instance, value):
+        # The relation must not be cached, or Model.save() will refuse to
+        # save the instance because of the unsaved related object
+        setattr(instance, self.field.attname, None)
+        if self.field.is_cached(instance):
+            self.field.delete_cached_value(instance)
+        pending(instance)[self.field.name] = value
+
+
+def pending(instance):
+    """
+    Returns a dict of the unsaved MoneyAmount objects attached to the instance,
+    keyed by field name.
+    """
+    return instance.__dict__.setdefault(PENDING_MONEYAMOUNTS, {})
+
+
+async def aget_moneyamount(instance, field_name):
+    """
+    Returns the MoneyAmount of the MoneyAmountField `field_name` of the
+    instance, like getattr(instance, field_name), but safe to use in async
+    code.
+    """
+    return await getattr(type(instance), field_name).aget(instance)
+
+
+def delete_replaced_moneyamounts(sender, instance, raw=False, using=None, **kwargs):
+    """
+    post_save receiver deleting the MoneyAmount objects that were replaced
+    by assignment, unless they are still referenced by the instance.
+    """
+    from .models import MoneyAmount
+    replaced = instance.__dict__.pop(REPLACED_MONEYAMOUNTS, None)
+    if raw or not replaced:
+        return
+    for field in sender._meta.concrete_fields:
+        if isinstance(field, MoneyAmountField):
+            replaced.discard(getattr(instance, field.attname))
+    if replaced:
+        MoneyAmount._base_manager.using(using).filter(pk__in=replaced).delete()
+        if metrics.enabled:
+            metrics.incr('descriptor.delete', len(replaced))
+
+
+def subtract_deleted_owner(sender, instance, using=None, **kwargs):
+    """
+    post_delete receiver subtracting the MoneyAmounts counted for a deleted
+    owner from the totals of its MoneyAmountFields. Connected only if totals
+    are tracked, so that the owners can otherwise still be fast-deleted.
+    """
+    for field in sender._meta.concrete_fields:
+        if isinstance(field, MoneyAmountField):
+            pk, values = counted_moneyamount(instance, field, using)
+            if values is not None:
+                deltas = {}
+                add_delta(deltas, values, -1)
+                apply_deltas(deltas, using, owner_key(field))
+
+
+class MoneyAmountIdAttribute(ForeignKeyDeferredAttribute):
+    """
+    The pk of the MoneyAmount of a MoneyAmountField, at <name>_id. The value
+    given to Model.__init__() is remembered for the owner totals.
+    """
+    def __set__(self, instance, value):
+        if self.field.attname not in instance.__dict__:
+            instance.__dict__.setdefault(LOADED_MONEYAMOUNTS, {})[self.field.name] = value
+        super(MoneyAmountIdAttribute, self).__set__(instance, value)
 
 
 class MoneyAmountField(OneToOneField):
     """
-    Modified OneToOneField for MoneyAmount relations. Will automatically create
-    a new MoneyAmount object if there is none.
+    Modified OneToOneField for MoneyAmount relations. Will automatically attach
+    a new MoneyAmount object if there is none, which is saved when the model
+    instance is saved.
 
     Intended usage:
     price = commerce.fields.MoneyAmoundField()
     """
     forward_related_accessor_class = MoneyAmountDescriptor
+    descriptor_class = MoneyAmountIdAttribute
 
     def __init__(self, to=None, on_delete=CASCADE, to_field=None, **kwargs):
         if not hasattr(kwargs, 'related_name'):
             kwargs['related_name'] = "+"
         super(MoneyAmountField, self).__init__('commerce.MoneyAmount', on_delete, to_field, **kwargs)
 
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(MoneyAmountField, self).contribute_to_class(cls, name, *args, **kwargs)
+        if not cls._meta.abstract:
+            post_save.connect(delete_replaced_moneyamounts, sender=cls, weak=False,
+                              dispatch_uid='moneyamount_delete_replaced')
+            if cur_settings.TRACK_TOTALS:
+                post_delete.connect(subtract_deleted_owner, sender=cls, weak=False,
+                                    dispatch_uid='moneyamount_totals_delete_owner')
+
+    def pre_save(self, model_instance, add):
+        """
+        Saves the pending MoneyAmount object, if any, before the instance.
+        A new one is created if the field is empty and not nullable. The
+        totals of the field are updated if TRACK_TOTALS is set.
+        """
+        rel_obj = pending(model_instance).get(self.name)
+        if rel_obj is None and not self.null and getattr(model_instance, self.attname) is None:
+            rel_obj = self.remote_field.model()
+            if metrics.enabled:
+                metrics.incr('descriptor.create')
+        if rel_obj is not None:
+            # It may already have been saved, e.g. by bulk_save_moneyamounts()
+            if rel_obj._state.adding or rel_obj.base_values_outdated:
+                rel_obj.save()
+            setattr(model_instance, self.name, rel_obj)
+        value = super(MoneyAmountField, self).pre_save(model_instance, add)
+        if cur_settings.TRACK_TOTALS:
+            using = router.db_for_write(model_instance.__class__, instance=model_instance)
+            apply_deltas(owner_deltas([model_instance], self, using), using, owner_key(self))
+        return value
+
+    def validate(self, value, model_instance):
+        """
+        Skips the query of ForeignKey.validate() checking that the MoneyAmount
+        exists, if it has already been loaded or saved, e.g. when it comes
+        from the prefetched MoneyAmounts of a formset. A pending MoneyAmount
+        is valid, as it is saved together with the instance.
+        """
+        if value is None and pending(model_instance).get(self.name) is not None:
+            return
+        if value is not None and self.is_cached(model_instance) and not self.get_limit_choices_to():
+            rel_obj = self.get_cached_value(model_instance)
+            if rel_obj is not None and rel_obj.pk == value and not rel_obj._state.adding:
+                super(ForeignKey, self).validate(value, model_instance)
+                return
+        super(MoneyAmountField, self).validate(value, model_instance)
+
     def formfield(self, **kwargs):
         defaults = { 'form_class': MoneyAmountFormField }
         defaults.update(kwargs)
         return super(MoneyAmountField, self).formfield(**defaults)
+
+
+class InlineMoneyAmountDescriptor(object):
+    """
+    Descriptor for InlineMoneyAmountField. Reading the attribute returns an
+    immutable Money object built from the inline columns, with the stored
+    base amount if it is still current; assigning a Money object, a
+    MoneyAmount or a plain amount writes to the columns.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if self.field.attname not in instance.__dict__:
+            # Deferred field, fetch it the same way DeferredAttribute does
+            instance.refresh_from_db(fields=[self.field.attname])
+        amount = instance.__dict__[self.field.attname]
+        if amount is None:
+            return None
+        base_amount = None
+        if not self.field.base_values_outdated(instance):
+            base_amount = getattr(instance, self.field.base_amount_attname)
+        return Money(amount, getattr(instance, self.field.currency_attname), base_amount)
+
+    def __set__(self, instance, value):
+        from .models import MoneyAmount
+        initial = self.field.attname not in instance.__dict__
+        if isinstance(value, (MoneyAmount, Money)):
+            instance.__dict__[self.field.attname] = value.amount
+            setattr(instance, self.field.currency_attname, value.currency)
+        else:
+            instance.__dict__[self.field.attname] = value
+        if initial:
+            # Set by Model.__init__(), which for loaded rows means that the
+            # base columns belong to these values
+            self.field.set_base_values_current(instance, loaded=True)
+
+
+class _InlineCompanionMixin(object):
+    """
+    Mixin for the extra columns added by InlineMoneyAmountField. They are
+    skipped if the model already has a field with the same name, which is
+    the case for the historical models built by migrations.
+    """
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        if name in [f.name for f in cls._meta.local_fields]:
+            return
+        super(_InlineCompanionMixin, self).contribute_to_class(cls, name, *args, **kwargs)
+
+
+class InlineCurrencyField(_InlineCompanionMixin, CharField):
+    pass
+
+
+class InlineBaseDecimalField(_InlineCompanionMixin, DecimalField):
+    pass
+
+
+class InlineBaseIntegerField(_InlineCompanionMixin, BigIntegerField):
+    pass
+
+
+class _InlineBaseValuesMixin(object):
+    """
+    Tracking of the amount and currency that the base columns of an inline
+    field were calculated from.
+    """
+    @property
+    def currency_attname(self):
+        return '%s_currency' % self.name
+
+    def set_base_values_current(self, instance, loaded=False):
+        """
+        Marks the base columns as belonging to the current amount and
+        currency. loaded is set for the values given to Model.__init__(),
+        which only belong together if the instance was loaded from the
+        database, something that is not known until from_db() has returned.
+        """
+        sources = instance.__dict__.setdefault(INLINE_BASE_VALUES_SOURCES, {})
+        sources[self.name] = (instance.__dict__.get(self.attname), instance.__dict__.get(self.currency_attname), loaded)
+
+    def base_values_outdated(self, instance):
+        """
+        True if amount or currency have changed since the base columns were
+        calculated or loaded, or if they are the defaults of a new instance.
+        """
+        source = instance.__dict__.get(INLINE_BASE_VALUES_SOURCES, {}).get(self.name)
+        if source is None or (source[2] and instance._state.adding):
+            return True
+        return source[:2] != (instance.__dict__.get(self.attname), instance.__dict__.get(self.currency_attname))
+
+
+class InlineMoneyAmountField(_InlineBaseValuesMixin, DecimalField):
+    """
+    MoneyAmount field stored as columns on the owning model instead of as a
+    relation to commerce.MoneyAmount, so reading it needs no join or extra
+    query. Besides the amount column, the columns <name>_currency,
+    <name>_base_amount and <name>_base_exchange_rate are added to the model.
+
+    Intended usage:
+    price = commerce.fields.InlineMoneyAmountField()
+    """
+    descriptor_class = InlineMoneyAmountDescriptor
+
+    def __init__(self, verbose_name=None, name=None, max_digits=10, decimal_places=2, **kwargs):
+        kwargs.setdefault('default', 0)
+        super(InlineMoneyAmountField, self).__init__(verbose_name, name, max_digits, decimal_places, **kwargs)
+
+    @property
+    def base_amount_attname(self):
+        return '%s_base_amount' % self.name
+
+    @property
+    def base_exchange_rate_attname(self):
+        return '%s_base_exchange_rate' % self.name
+
+    @property
+    def base_attnames(self):
+        return (self.base_amount_attname, self.base_exchange_rate_attname)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(InlineMoneyAmountField, self).contribute_to_class(cls, name, *args, **kwargs)
+        companions = (
+            (self.currency_attname, InlineCurrencyField(
+                max_length=8, choices=cur_settings.CURRENCIES, default=cur_settings.BASE_CURRENCY,
+                null=self.null, blank=self.blank)),
+            (self.base_amount_attname, InlineBaseDecimalField(
+                max_digits=self.max_digits, decimal_places=self.decimal_places, default=0,
+                editable=False, null=self.null, db_index=True)),
+            (self.base_exchange_rate_attname, InlineBaseDecimalField(
+                max_digits=10, decimal_places=4, default=1, editable=False, null=self.null)),
+        )
+        # The currency column has to come before the amount column, so that
+        # assigning a MoneyAmount in Model.__init__ is not overwritten by the
+        # currency default, and the base columns after it, so that pre_save()
+        # has updated them before they are saved.
+        for offset, (companion_name, companion) in zip((-0.5, 0.25, 0.5), companions):
+            companion.creation_counter = self.creation_counter + offset
+            companion.contribute_to_class(cls, companion_name)
+        setattr(cls, self.attname, self.descriptor_class(self))
+
+    def pre_save(self, model_instance, add):
+        """
+        Updates the base columns from the current amount and currency, the same
+        way MoneyAmount.save() does, if they have changed or the instance is new.
+        """
+        from .models import CurrencyExchangeRate
+        amount = model_instance.__dict__.get(self.attname)
+        if amount is not None and (add or self.base_values_outdated(model_instance)):
+            base_amount, base_exchange_rate = CurrencyExchangeRate.to_base_currency(
+                amount, getattr(model_instance, self.currency_attname))
+            setattr(model_instance, self.base_amount_attname, base_amount)
+            setattr(model_instance, self.base_exchange_rate_attname, base_exchange_rate)
+            self.set_base_values_current(model_instance)
+        return amount
+
+    def value_from_object(self, obj):
+        return obj.__dict__.get(self.attname)
+
+    def to_python(self, value):
+        from .models import MoneyAmount
+        if isinstance(value, (MoneyAmount, Money)):
+            value = value.amount
+        return super(InlineMoneyAmountField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        # The currency is saved in its own column (e.g. by bulk_update()) and
+        # matched by the exact lookup, so only the amount is prepared here
+        from .models import MoneyAmount
+        if isinstance(value, (MoneyAmount, Money)):
+            value = value.amount
+        return super(InlineMoneyAmountField, self).get_prep_value(value)
+
+
+class MinorUnitsAttribute(DeferredAttribute):
+    """
+    The raw minor units of a MinorMoneyAmountField, at <name>_units.
+    """
+    def __set__(self, instance, value):
+        initial = self.field.attname not in instance.__dict__
+        instance.__dict__[self.field.attname] = value
+        if initial:
+            # Set by Model.__init__(), which for loaded rows means that the
+            # base column belongs to these values
+            self.field.set_base_values_current(instance, loaded=True)
+
+
+class MinorMoneyAmountDescriptor(object):
+    """
+    Descriptor for MinorMoneyAmountField. Reading the attribute returns a
+    MinorMoney object. Numbers, including integers, are assigned as amounts
+    in the current currency of the instance, as in MinorMoney arithmetic,
+    and MinorMoney, Money and MoneyAmount objects set both units and
+    currency. The raw units are at <name>_units.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        units = getattr(instance, self.field.attname)
+        if units is None:
+            return None
+        return MinorMoney(units, getattr(instance, self.field.currency_attname))
+
+    def __set__(self, instance, value):
+        if isinstance(value, MinorMoney):
+            setattr(instance, self.field.currency_attname, value.currency)
+            value = value.units
+        elif hasattr(value, 'amount') and hasattr(value, 'currency'):
+            setattr(instance, self.field.currency_attname, value.currency)
+            value = to_minor(value.amount, value.currency)
+        elif value is not None:
+            value = to_minor(value, getattr(instance, self.field.currency_attname))
+        setattr(instance, self.field.attname, value)
+
+
+class MinorMoneyFormField(forms.DecimalField):
+    def prepare_value(self, value):
+        if isinstance(value, MinorMoney):
+            return value.amount
+        return super(MinorMoneyFormField, self).prepare_value(value)
+
+    def has_changed(self, initial, data):
+        # Compared as amounts in the currency of the field, which is a field
+        # of its own
+        if isinstance(initial, MinorMoney):
+            initial = initial.amount
+        return super(MinorMoneyFormField, self).has_changed(initial, data)
+
+
+class MinorMoneyAmountField(_InlineBaseValuesMixin, BigIntegerField):
+    """
+    Inline money field storing the amount as an integer number of minor
+    units (see minor.py), with the columns <name>_currency and
+    <name>_base_units, the amount in minor units of the base currency. The
+    attribute is a MinorMoney object, and the raw units are at <name>_units,
+    like the id of a ForeignKey; the column keeps the name of the field.
+
+    Intended usage:
+    price = commerce.fields.MinorMoneyAmountField()
+    """
+    descriptor_class = MinorUnitsAttribute
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', 0)
+        super(MinorMoneyAmountField, self).__init__(*args, **kwargs)
+
+    def get_attname(self):
+        return '%s_units' % self.name
+
+    def get_attname_column(self):
+        attname = self.get_attname()
+        return attname, self.db_column or self.name
+
+    @property
+    def base_units_attname(self):
+        return '%s_base_units' % self.name
+
+    @property
+    def base_attnames(self):
+        return (self.base_units_attname,)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(MinorMoneyAmountField, self).contribute_to_class(cls, name, *args, **kwargs)
+        companions = (
+            (self.currency_attname, InlineCurrencyField(
+                max_length=8, choices=cur_settings.CURRENCIES, default=cur_settings.BASE_CURRENCY,
+                null=self.null, blank=self.blank)),
+            (self.base_units_attname, InlineBaseIntegerField(
+                default=0, editable=False, null=self.null, db_index=True)),
+        )
+        # See InlineMoneyAmountField.contribute_to_class()
+        for offset, (companion_name, companion) in zip((-0.5, 0.25), companions):
+            companion.creation_counter = self.creation_counter + offset
+            companion.contribute_to_class(cls, companion_name)
+        setattr(cls, self.name, MinorMoneyAmountDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        units = model_instance.__dict__.get(self.attname)
+        if units is not None and (add or self.base_values_outdated(model_instance)):
+            setattr(model_instance, self.base_units_attname, fixed_rates.convert(
+                units, getattr(model_instance, self.currency_attname), cur_settings.BASE_CURRENCY))
+            self.set_base_values_current(model_instance)
+        return units
+
+    def value_from_object(self, obj):
+        return getattr(obj, self.name)
+
+    def value_to_string(self, obj):
+        # Serialized as the amount, since deserializing assigns the value to
+        # the field name, where numbers are amounts
+        value = self.value_from_object(obj)
+        return '' if value is None else str(value.amount)
+
+    def to_python(self, value):
+        if isinstance(value, MinorMoney):
+            value = value.units
+        elif isinstance(value, str):
+            # Serialized amount, see value_to_string()
+            value = value.strip()
+            if not value:
+                return None
+            try:
+                return Decimal(value)
+            except ArithmeticError:
+                raise exceptions.ValidationError(
+                    self.error_messages['invalid'], code='invalid', params={'value': value})
+        return super(MinorMoneyAmountField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, MinorMoney):
+            value = value.units
+        return super(MinorMoneyAmountField, self).get_prep_value(value)
+
+    def save_form_data(self, instance, data):
+        # The form gives an amount, which the descriptor converts to units
+        setattr(instance, self.name, data)
+
+    def formfield(self, **kwargs):
+        defaults = {'form_class': MinorMoneyFormField}
+        defaults.update(kwargs)
+        return super(MinorMoneyAmountField, self).formfield(**defaults)
+
+
+for lookup in (lookups.RelatedBaseAmountGreaterThan, lookups.RelatedBaseAmountGreaterThanOrEqual,
+               lookups.RelatedBaseAmountLessThan, lookups.RelatedBaseAmountLessThanOrEqual,
+               lookups.RelatedBaseAmountRange):
+    MoneyAmountField.register_lookup(lookup)
+
+for lookup in (lookups.InlineMoneyExact,
+               lookups.InlineBaseAmountGreaterThan, lookups.InlineBaseAmountGreaterThanOrEqual,
+               lookups.InlineBaseAmountLessThan, lookups.InlineBaseAmountLessThanOrEqual,
+               lookups.InlineBaseAmountRange):
+    InlineMoneyAmountField.register_lookup(lookup)
+
+for lookup in (lookups.MinorBaseUnitsGreaterThan, lookups.MinorBaseUnitsGreaterThanOrEqual,
+               lookups.MinorBaseUnitsLessThan, lookups.MinorBaseUnitsLessThanOrEqual,
+               lookups.MinorBaseUnitsRange):
+    MinorMoneyAmountField.register_lookup(lookup)
@@ -0,0 +1,91 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from .money import to_decimal
+from .ratecache import rate_cache
+from . import settings as cur_settings
+
+
+class CurrencyFormatter(object):
+    """
+    Formats amounts in one currency, with the format settings of its
+    CurrencyExchangeRate item prepared once. Amounts are rounded half up to
+    decimal_places.
+    """
+    __slots__ = ('decimal_mark', 'thousand_mark', 'decimal_places', 'remove_decimal_zero', 'quantum', 'spec', 'marks')
+
+    def __init__(self, decimal_mark=',', thousand_mark=' ', decimal_places=2, remove_decimal_zero=True):
+        self.decimal_mark = decimal_mark
+        self.thousand_mark = thousand_mark
+        self.decimal_places = decimal_places
+        self.remove_decimal_zero = remove_decimal_zero
+        self.quantum = Decimal(1).scaleb(-decimal_places)
+        # Formatted with Python's own marks, which are then replaced
+        self.spec = ',f' if thousand_mark else 'f'
+        self.marks = {ord(','): thousand_mark, ord('.'): decimal_mark}
+
+    @classmethod
+    def from_item(cls, item):
+        return cls(item.decimal_mark, item.thousand_mark, item.decimal_places, item.remove_decimal_zero)
+
+    def format(self, amount):
+        value = to_decimal(amount).quantize(self.quantum, rounding=ROUND_HALF_UP)
+        if not value:
+            # No "-0"
+            value = abs(value)
+        text = format(value, self.spec)
+        if self.remove_decimal_zero and self.decimal_places:
+            text = text.rstrip('0').rstrip('.')
+        return text.translate(self.marks)
+
+    def format_many(self, amounts):
+        format = self.format
+        return [format(amount) for amount in amounts]
+
+
+class FormatterRegistry(object):
+    """
+    One CurrencyFormatter per active currency, built from the current rate
+    snapshot and rebuilt when the snapshot is replaced, i.e. when the rates
+    have changed.
+    """
+    def __init__(self):
+        self._state = (None, {})
+
+    def get(self, currency):
+        """Returns the CurrencyFormatter for currency"""
+        from .models import CurrencyExchangeRate
+        currency = currency.upper()
+        if not cur_settings.CACHE_EXCHANGE:
+            return CurrencyFormatter.from_item(CurrencyExchangeRate.get_exchange_rate_item(currency))
+        snapshot = rate_cache.get()
+        built_from, formatters = self._state
+        if built_from is not snapshot:
+            formatters = {
+                iso_code: CurrencyFormatter.from_item(item) for iso_code, item in snapshot.items.items()
+            }
+            self._state = (snapshot, formatters)
+        formatter = formatters.get(currency)
+        if formatter is None:
+            formatter = CurrencyFormatter.from_item(CurrencyExchangeRate.get_exchange_rate_item(currency))
+        return formatter
+
+    def format(self, amount, currency):
+        return self.get(currency).format(amount)
+
+    def format_many(self, amounts, currencies):
+        """
+        Formats a sequence of amounts. currencies is either one currency for
+        all amounts or a sequence of the same length as amounts.
+        """
+        if isinstance(currencies, str):
+            return self.get(currencies).format_many(amounts)
+        formatters = {}
+        result = []
+        for amount, currency in zip(amounts, currencies):
+            if currency not in formatters:
+                formatters[currency] = self.get(currency)
+            result.append(formatters[currency].format(amount))
+        return result
+
+
+formatters = FormatterRegistry()
@@ -1,25 +1,42 @@
+import functools
+
 from django import forms
+from django.forms.models import BaseModelFormSet
+from .metrics import metrics
 from . import settings as cur_settings
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext as _
 
 
 class MoneyAmountWidget(forms.widgets.MultiWidget):
-    def __init__(self, attrs=None):
+    """
+    The value is a MoneyAmount object or its pk. MoneyAmount objects already
+    loaded can be given in `prefetched`, a dict keyed by pk, to avoid a query
+    per rendered widget.
+    """
+    def __init__(self, attrs=None, prefetched=None):
         widgets = (
             forms.widgets.HiddenInput(attrs=attrs),
             forms.widgets.NumberInput(attrs=attrs),
             forms.widgets.Select(attrs=attrs, choices=cur_settings.CURRENCIES)
         )
+        self.prefetched = prefetched if prefetched is not None else {}
         super(MoneyAmountWidget, self).__init__(widgets, attrs)
 
     def decompress(self, value):
         from .models import MoneyAmount, CurrencyExchangeRate
         try:
-            moneyamount = MoneyAmount.objects.get(pk=value)
-            return [ value, moneyamount.amount, moneyamount.currency ]
+            if isinstance(value, MoneyAmount):
+                moneyamount = value
+            elif value in self.prefetched:
+                moneyamount = self.prefetched[value]
+            else:
+                if metrics.enabled:
+                    metrics.incr('forms.query')
+                moneyamount = MoneyAmount.objects.get(pk=value)
+            return [ moneyamount.pk, moneyamount.amount, moneyamount.currency ]
         except:
-            return [ None, str(0), CurrencyExchangeRate.base_currency ]
+            return [ None, str(0), CurrencyExchangeRate.base_currency() ]
 
 
 class MoneyAmountFormField(forms.ModelChoiceField):
@@ -33,12 +50,32 @@ class MoneyAmountFormField(forms.ModelChoiceField):
 
     def __init__(self, queryset, *args, **kwargs):
         from .models import CurrencyExchangeRate
+        prefetched = kwargs.pop('prefetched', None)
+        # If True, compress() does not save the MoneyAmount, which is then
+        # left to e.g. save_moneyamounts()
+        self.defer_save = kwargs.pop('defer_save', False)
         self.fields = (
             forms.IntegerField(required=False),
             forms.DecimalField(),
             forms.ChoiceField(choices=cur_settings.CURRENCIES, initial=CurrencyExchangeRate.base_currency),
         )
         super(MoneyAmountFormField, self).__init__(queryset, *args, **kwargs)
+        self.prefetched = prefetched if prefetched is not None else {}
+
+    @property
+    def prefetched(self):
+        """Dict of already loaded MoneyAmount objects, keyed by pk"""
+        return self.widget.prefetched
+
+    @prefetched.setter
+    def prefetched(self, value):
+        self.widget.prefetched = value
+
+    def prepare_value(self, value):
+        from .models import MoneyAmount
+        if isinstance(value, MoneyAmount):
+            return [ value.pk, value.amount, value.currency ]
+        return super(MoneyAmountFormField, self).prepare_value(value)
 
     def validate(self, value):
         pass
@@ -50,7 +87,7 @@ class MoneyAmountFormField(forms.ModelChoiceField):
             initial = ['' for x in range(0, len(data))]
         else:
             if not isinstance(initial, list):
-                initial = self.widget.widget.decompress(initial)
+                initial = self.widget.decompress(initial)
         for field, initial, data in zip(self.fields, initial, data):
             try:
                 initial = field.to_python(initial)
@@ -112,10 +149,157 @@ class MoneyAmountFormField(forms.ModelChoiceField):
         if data_list:
             if data_list[0] in self.empty_values:
                 moneyamount = MoneyAmount()
+            elif data_list[0] in self.prefetched:
+                moneyamount = self.prefetched[data_list[0]]
             else:
-                moneyamount = MoneyAmount.objects.get(pk=data_list[0])
+                if metrics.enabled:
+                    metrics.incr('forms.query')
+                moneyamount = self.queryset.get(pk=data_list[0])
             moneyamount.amount = data_list[1]
             moneyamount.currency = data_list[2]
-            moneyamount.save()
+            if not self.defer_save:
+                moneyamount.save()
             return moneyamount
         return None
+
+
+def _moneyamount_form_fields(form):
+    return [(name, field) for name, field in form.fields.items() if isinstance(field, MoneyAmountFormField)]
+
+
+def prefetch_moneyamounts(forms):
+    """
+    Loads the MoneyAmount objects referenced by the MoneyAmountFormFields of
+    all the given forms (e.g. formset.forms) with one query, and sets the
+    fields to save them with save_moneyamounts() instead of one by one.
+    """
+    from .models import MoneyAmount
+    pks = set()
+    fields = []
+    for form in forms:
+        for name, field in _moneyamount_form_fields(form):
+            fields.append(field)
+            value = form.get_initial_for_field(field, name)
+            if isinstance(value, MoneyAmount):
+                value = value.pk
+            if value not in field.empty_values:
+                pks.add(value)
+    prefetched = {}
+    if pks:
+        if metrics.enabled:
+            metrics.incr('forms.query')
+        prefetched = MoneyAmount.objects.in_bulk(pks)
+    for field in fields:
+        field.prefetched = prefetched
+        field.defer_save = True
+    return prefetched
+
+
+def _validate_unique_except_moneyamounts(form):
+    """
+    ModelForm.validate_unique() without the checks of the MoneyAmountFields,
+    which validate_unique_moneyamounts() makes for all forms at once
+    """
+    exclude = set(form._get_validation_exclusions())
+    exclude.update(name for name, field in _moneyamount_form_fields(form))
+    try:
+        form.instance.validate_unique(exclude=exclude)
+    except ValidationError as e:
+        form._update_errors(e)
+
+
+def validate_unique_moneyamounts(forms):
+    """
+    Checks that the MoneyAmount objects cleaned by the MoneyAmountFormFields
+    of the given model forms do not belong to other rows, with one query per
+    model field instead of one per form.
+    """
+    checks = {}
+    for form in forms:
+        cleaned_data = getattr(form, 'cleaned_data', None) or {}
+        for name, field in _moneyamount_form_fields(form):
+            moneyamount = cleaned_data.get(name)
+            if moneyamount is not None and moneyamount.pk is not None:
+                checks.setdefault((type(form.instance), name), {})[moneyamount.pk] = form
+    for (model, name), forms_by_pk in checks.items():
+        model_field = model._meta.get_field(name)
+        if not model_field.unique:
+            continue
+        if metrics.enabled:
+            metrics.incr('forms.query')
+        taken = model._default_manager.filter(**{'%s__in' % model_field.attname: list(forms_by_pk)}) \
+            .values_list('pk', model_field.attname)
+        for pk, moneyamount_pk in taken:
+            form = forms_by_pk[moneyamount_pk]
+            if form.instance.pk != pk:
+                form.add_error(name, form.instance.unique_error_message(model, [name]))
+
+
+def save_moneyamounts(forms):
+    """
+    Saves the MoneyAmount objects cleaned by the MoneyAmountFormFields of all
+    the given forms, with one INSERT for the new ones and one UPDATE for the
+    changed ones. The new ones are then attached to the form instances as
+    saved objects, so that saving the instances does not save them again.
+    """
+    from .fields import pending
+    from .managers import bulk_save_moneyamounts
+    moneyamounts = []
+    attached = []
+    for form in forms:
+        cleaned_data = getattr(form, 'cleaned_data', None) or {}
+        for name, field in _moneyamount_form_fields(form):
+            moneyamount = cleaned_data.get(name)
+            if moneyamount is not None:
+                moneyamounts.append(moneyamount)
+                if pending(form.instance).get(name) is moneyamount:
+                    attached.append((form.instance, name, moneyamount))
+    bulk_save_moneyamounts(moneyamounts)
+    for instance, name, moneyamount in attached:
+        setattr(instance, name, moneyamount)
+    return moneyamounts
+
+
+class MoneyAmountFormSetMixin(object):
+    """
+    Mixin for formsets with MoneyAmountFormFields, which loads all MoneyAmount
+    objects with one query, checks that they are unique with one query per
+    field and saves them in bulk before the forms are saved, or in
+    save_m2m() if save() is called with commit=False.
+
+    Intended usage:
+    modelformset_factory(Lead, formset=commerce.forms.MoneyAmountModelFormSet)
+    """
+    def __init__(self, *args, **kwargs):
+        super(MoneyAmountFormSetMixin, self).__init__(*args, **kwargs)
+        prefetch_moneyamounts(self.forms)
+        for form in self.forms:
+            form.validate_unique = functools.partial(_validate_unique_except_moneyamounts, form)
+
+    def validate_unique(self):
+        super(MoneyAmountFormSetMixin, self).validate_unique()
+        validate_unique_moneyamounts(self.forms)
+
+    def moneyamount_forms(self):
+        """The forms whose MoneyAmounts are saved, the same ones that save() saves"""
+        deleted_forms = self.deleted_forms if self.can_delete else []
+        return [form for form in self.forms if form not in deleted_forms and form.has_changed()]
+
+    def save(self, commit=True):
+        forms = self.moneyamount_forms()
+        if commit:
+            save_moneyamounts(forms)
+            return super(MoneyAmountFormSetMixin, self).save(commit)
+        # Nothing is written until save_m2m(), like the instances themselves
+        objects = super(MoneyAmountFormSetMixin, self).save(commit)
+        save_m2m = self.save_m2m
+
+        def save_moneyamounts_and_m2m():
+            save_moneyamounts(forms)
+            save_m2m()
+        self.save_m2m = save_moneyamounts_and_m2m
+        return objects
+
+
+class MoneyAmountModelFormSet(MoneyAmountFormSetMixin, BaseModelFormSet):
+    pass
@@ -0,0 +1,129 @@
+import datetime
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from .ratecache import rate_cache
+from . import settings as cur_settings
+
+
+class RateTimeline(object):
+    """
+    The exchange rates of one currency, sorted by valid_from, for lookups
+    by point in time with bisect.
+    """
+    __slots__ = ('times', 'rates')
+
+    def __init__(self, times, rates):
+        self.times = times
+        self.rates = rates
+
+    def rate_at(self, when):
+        """Returns the rate valid at when, or None if there is none that early"""
+        i = bisect_right(self.times, when) - 1
+        if i < 0:
+            return None
+        return self.rates[i]
+
+
+def as_datetime(when):
+    """
+    Dates are taken to mean the end of the day, so that the rate published
+    on the date is used.
+    """
+    if isinstance(when, datetime.datetime):
+        return when
+    when = datetime.datetime.combine(when, datetime.time.max)
+    if settings.USE_TZ:
+        when = timezone.make_aware(when)
+    return when
+
+
+def load_timelines(currencies, using=None):
+    """
+    Loads the history of the given currencies with one query. Returns a dict
+    of RateTimelines keyed by ISO code, with an empty timeline for currencies
+    without history.
+    """
+    from .models import CurrencyExchangeRateHistory
+    timelines = {currency: RateTimeline([], []) for currency in currencies}
+    rows = CurrencyExchangeRateHistory.objects.using(using).filter(iso_code__in=list(currencies)) \
+        .order_by('iso_code', 'valid_from').values_list('iso_code', 'valid_from', 'exchange_rate')
+    for iso_code, valid_from, exchange_rate in rows.iterator():
+        timeline = timelines[iso_code]
+        timeline.times.append(valid_from)
+        timeline.rates.append(Decimal(exchange_rate))
+    return timelines
+
+
+class RateHistory(object):
+    """
+    Per-process cache of RateTimelines, loaded per currency when first
+    needed, and dropped when the rate snapshot is replaced, i.e. when the
+    rates have changed.
+    """
+    def __init__(self):
+        self._state = (None, {})
+
+    def timelines(self, currencies):
+        snapshot = rate_cache.get() if cur_settings.CACHE_EXCHANGE else None
+        built_from, timelines = self._state
+        if snapshot is None or built_from is not snapshot:
+            timelines = {}
+        missing = [currency for currency in currencies if currency not in timelines]
+        if missing:
+            timelines = dict(timelines)
+            timelines.update(load_timelines(missing))
+            if snapshot is not None:
+                self._state = (snapshot, timelines)
+        return timelines
+
+    def clear(self):
+        self._state = (None, {})
+
+    def convert_at(self, amounts, currencies, timestamps, to_currency=None, fallback_to_current=False):
+        """
+        Converts each amount from its currency to to_currency, by default the
+        base currency, at the exchange rates valid at its timestamp (datetime
+        or date). currencies is either one currency for all amounts or a
+        sequence of the same length as amounts. Returns a list of Decimals.
+
+        A LookupError is raised if a currency has no rate as early as the
+        timestamp, unless fallback_to_current is set, in which case the
+        current rate is used.
+        """
+        from .models import CurrencyExchangeRate
+        amounts = list(amounts)
+        base_currency = CurrencyExchangeRate.base_currency()
+        currencies = CurrencyExchangeRate._normalize_currencies(currencies, len(amounts))
+        to_currency = (to_currency or base_currency).upper()
+        needed = set(currencies) | {to_currency}
+        needed.discard(base_currency)
+        timelines = self.timelines(needed)
+        current_rates = {}
+
+        def rate_at(currency, when):
+            if currency == base_currency:
+                return None
+            rate = timelines[currency].rate_at(when)
+            if rate is None:
+                if not fallback_to_current:
+                    raise LookupError("No %s exchange rate as early as %s" % (currency, when))
+                if currency not in current_rates:
+                    current_rates.update(CurrencyExchangeRate.get_exchange_rates([currency]))
+                rate = current_rates[currency]
+            return rate
+
+        result = []
+        for amount, currency, when in zip(amounts, currencies, timestamps):
+            if currency == to_currency:
+                result.append(CurrencyExchangeRate._apply_factors(amount, None, None))
+                continue
+            when = as_datetime(when)
+            result.append(CurrencyExchangeRate._apply_factors(amount, rate_at(currency, when), rate_at(to_currency, when)))
+        return result
+
+
+rate_history = RateHistory()
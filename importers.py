@@ -0,0 +1,186 @@
+import csv
+import datetime
+import re
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .history import rate_history
+from .ratecache import rate_cache
+
+RateImportResult = namedtuple('RateImportResult', ['created', 'updated', 'history'])
+
+CURRENCY_RE = re.compile(r'^[A-Z]{3}$')
+RATE_QUANTUM = Decimal('0.0001')
+
+
+class RateImportError(ValueError):
+    pass
+
+
+def _parse_rate(currency, rate, where):
+    currency = currency.strip().upper()
+    if not CURRENCY_RE.match(currency):
+        raise RateImportError("%s: invalid currency code %r" % (where, currency))
+    try:
+        rate = Decimal(rate.strip())
+    except InvalidOperation:
+        raise RateImportError("%s: invalid rate %r for %s" % (where, rate, currency))
+    if not rate.is_finite() or rate <= 0:
+        raise RateImportError("%s: invalid rate %r for %s" % (where, rate, currency))
+    return currency, rate
+
+
+def _parse_date(value, where):
+    try:
+        return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise RateImportError("%s: invalid date %r" % (where, value))
+
+
+def iter_ecb_xml(path):
+    """
+    Streams an ECB style XML file (eurofxref-daily.xml, eurofxref-hist.xml),
+    yielding (date, {currency: rate}) per day, where rate is the amount of
+    currency per unit of the quote currency.
+    """
+    day = None
+    rates = {}
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        if not elem.tag.endswith('Cube'):
+            continue
+        if event == 'start' and 'time' in elem.attrib:
+            day = _parse_date(elem.attrib['time'], path)
+            rates = {}
+        elif event == 'end' and 'currency' in elem.attrib:
+            currency, rate = _parse_rate(elem.attrib['currency'], elem.attrib.get('rate', ''), "%s %s" % (path, day))
+            rates[currency] = rate
+        elif event == 'end' and 'time' in elem.attrib:
+            yield day, rates
+            elem.clear()
+
+
+def iter_ecb_csv(path):
+    """
+    Streams an ECB style CSV file (eurofxref-hist.csv), with a Date column
+    followed by one column per currency, yielding (date, {currency: rate})
+    like iter_ecb_xml(). Empty and N/A values are skipped.
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        currencies = [currency.strip().upper() for currency in header[1:]]
+        for line, row in enumerate(reader, 2):
+            if not row or not row[0].strip():
+                continue
+            where = "%s line %d" % (path, line)
+            rates = {}
+            for currency, rate in zip(currencies, row[1:]):
+                if not currency or rate.strip() in ('', 'N/A'):
+                    continue
+                currency, rate = _parse_rate(currency, rate, where)
+                rates[currency] = rate
+            yield _parse_date(row[0], where), rates
+
+
+def to_base_rates(days, quote_currency='EUR'):
+    """
+    Converts (date, {currency: rate per quote currency}) to
+    (date, {currency: CurrencyExchangeRate.exchange_rate}), i.e. the value
+    of one unit of each currency in base currency.
+    """
+    from .models import CurrencyExchangeRate
+    base_currency = CurrencyExchangeRate.base_currency()
+    for day, rates in days:
+        rates = dict(rates)
+        rates[quote_currency] = Decimal(1)
+        if base_currency not in rates:
+            raise RateImportError("%s: no rate for base currency %s" % (day, base_currency))
+        base_rate = rates[base_currency]
+        yield day, {
+            currency: (base_rate / rate).quantize(RATE_QUANTUM, rounding=ROUND_HALF_UP)
+            for currency, rate in rates.items() if currency != base_currency
+        }
+
+
+def _valid_from(day):
+    valid_from = datetime.datetime.combine(day, datetime.time.min)
+    if settings.USE_TZ:
+        valid_from = timezone.make_aware(valid_from)
+    return valid_from
+
+
+def import_rates(days, currencies=None, activate=True, batch_size=1000):
+    """
+    Imports (date, {currency: exchange_rate}) from to_base_rates(), in one
+    transaction: all days are added to CurrencyExchangeRateHistory, except
+    those already there, and the CurrencyExchangeRate of each currency is
+    updated, or created, with the rate of its latest day. Exchange rates
+    for currencies not in `currencies` (if given) are ignored.
+
+    No signals are sent for the rows; instead the rate cache is invalidated
+    once, when the transaction is committed.
+    """
+    from .models import CurrencyExchangeRate, CurrencyExchangeRateHistory
+    if currencies is not None:
+        currencies = set(currency.upper() for currency in currencies)
+    history = {}
+    latest = {}
+    for day, rates in days:
+        valid_from = _valid_from(day)
+        for currency, rate in rates.items():
+            if currencies is not None and currency not in currencies:
+                continue
+            history[currency, valid_from] = rate
+            if currency not in latest or latest[currency][0] < valid_from:
+                latest[currency] = (valid_from, rate)
+    if not latest:
+        return RateImportResult(0, 0, 0)
+    now = timezone.now()
+    with transaction.atomic():
+        existing_history = set(CurrencyExchangeRateHistory.objects.filter(
+            iso_code__in=list(latest),
+            valid_from__gte=min(valid_from for currency, valid_from in history),
+            valid_from__lte=max(valid_from for currency, valid_from in history),
+        ).values_list('iso_code', 'valid_from'))
+        new_history = [
+            CurrencyExchangeRateHistory(iso_code=currency, exchange_rate=rate, valid_from=valid_from)
+            for (currency, valid_from), rate in sorted(history.items()) if (currency, valid_from) not in existing_history
+        ]
+        CurrencyExchangeRateHistory.objects.bulk_create(new_history, batch_size=batch_size)
+        items = {}
+        for item in CurrencyExchangeRate.objects.select_for_update().filter(iso_code__in=list(latest)).order_by('active'):
+            # Active items are ordered last, so they are the ones updated
+            items[item.iso_code.upper()] = item
+        updated, created = [], []
+        for currency, (valid_from, rate) in latest.items():
+            item = items.get(currency)
+            if item is None:
+                created.append(CurrencyExchangeRate(
+                    iso_code=currency, name=currency, symbol=currency, exchange_rate=rate, active=activate, updated=now))
+            else:
+                item.exchange_rate = rate
+                item.active = item.active or activate
+                item.updated = now
+                updated.append(item)
+        CurrencyExchangeRate.objects.bulk_update(updated, ['exchange_rate', 'active', 'updated'], batch_size=batch_size)
+        CurrencyExchangeRate.objects.bulk_create(created, batch_size=batch_size)
+        rate_cache.clear()
+        rate_history.clear()
+        transaction.on_commit(rate_cache.invalidate)
+    return RateImportResult(len(created), len(updated), len(new_history))
+
+
+def import_rate_file(path, format=None, quote_currency='EUR', **kwargs):
+    """
+    Imports an ECB style XML or CSV file, see import_rates(). The format is
+    'xml' or 'csv', by default guessed from the file extension.
+    """
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'xml'
+    days = iter_ecb_csv(path) if format == 'csv' else iter_ecb_xml(path)
+    return import_rates(to_base_rates(days, quote_currency.upper()), **kwargs)
@@ -0,0 +1,173 @@
+from decimal import Decimal
+from numbers import Number
+
+from django.db.models import lookups
+
+
+def to_base_amount(value):
+    """
+    Converts a lookup value to an amount in base currency. The value can be
+    a MoneyAmount, an (amount, currency) pair or a number, which is taken to
+    already be in base currency.
+    """
+    from .models import CurrencyExchangeRate
+    if hasattr(value, 'amount_as'):
+        return value.amount_as(CurrencyExchangeRate.base_currency())
+    if isinstance(value, (list, tuple)) and len(value) == 2 and not isinstance(value[1], Number):
+        return CurrencyExchangeRate.to_base_currency(value[0], value[1])[0]
+    return Decimal(value)
+
+
+def to_base_units(value):
+    """
+    Converts a lookup value to minor units of the base currency, like
+    to_base_amount(). MinorMoney objects keep their fixed-point base units.
+    """
+    from .minor import MinorMoney, to_minor
+    from .models import CurrencyExchangeRate
+    if isinstance(value, MinorMoney):
+        return value.base_units
+    return to_minor(to_base_amount(value), CurrencyExchangeRate.base_currency())
+
+
+class BaseAmountLookupMixin(object):
+    """
+    Converts the lookup value to base currency once, so that the comparison
+    can be made on the indexed base_amount column.
+    """
+    prepare_rhs = False
+
+    def prepare_value(self, value):
+        return to_base_amount(value)
+
+    def get_prep_lookup(self):
+        if hasattr(self.rhs, 'resolve_expression'):
+            return self.rhs
+        if self.lookup_name == 'range':
+            return [self.prepare_value(value) for value in self.rhs]
+        return self.prepare_value(self.rhs)
+
+
+class RelatedBaseAmountLookup(BaseAmountLookupMixin, lookups.Lookup):
+    """
+    Lookup for MoneyAmountField, compiled as a subquery on
+    MoneyAmount.base_amount:
+    price_id IN (SELECT id FROM moneyamount WHERE base_amount > %s)
+    """
+    def as_sql(self, compiler, connection):
+        from .models import MoneyAmount
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        subquery = MoneyAmount._base_manager.filter(
+            **{'base_amount__%s' % self.lookup_name: self.rhs}).values('pk').query
+        sub_sql, sub_params = subquery.get_compiler(connection=connection).as_sql()
+        return '%s IN (%s)' % (lhs_sql, sub_sql), list(lhs_params) + list(sub_params)
+
+
+class RelatedBaseAmountGreaterThan(RelatedBaseAmountLookup):
+    lookup_name = 'gt'
+
+
+class RelatedBaseAmountGreaterThanOrEqual(RelatedBaseAmountLookup):
+    lookup_name = 'gte'
+
+
+class RelatedBaseAmountLessThan(RelatedBaseAmountLookup):
+    lookup_name = 'lt'
+
+
+class RelatedBaseAmountLessThanOrEqual(RelatedBaseAmountLookup):
+    lookup_name = 'lte'
+
+
+class RelatedBaseAmountRange(RelatedBaseAmountLookup):
+    lookup_name = 'range'
+
+
+class InlineBaseAmountLookupMixin(BaseAmountLookupMixin):
+    """
+    Lookup for InlineMoneyAmountField, comparing the <name>_base_amount
+    column instead of the amount column.
+    """
+    def base_column(self, field):
+        return field.base_amount_attname
+
+    def process_lhs(self, compiler, connection, lhs=None):
+        field = getattr(self.lhs, 'target', None)
+        if lhs is None and hasattr(field, 'base_attnames'):
+            lhs = field.model._meta.get_field(self.base_column(field)).get_col(self.lhs.alias)
+        return super(InlineBaseAmountLookupMixin, self).process_lhs(compiler, connection, lhs)
+
+
+class InlineMoneyExact(lookups.Exact):
+    """
+    Exact lookup for InlineMoneyAmountField. A MoneyAmount or Money value
+    matches on both the amount and the <name>_currency column, so that
+    10 USD does not match a row with 10 EUR. Numbers match on the amount.
+    """
+    def get_prep_lookup(self):
+        self.currency = None
+        if hasattr(self.rhs, 'amount_as') and hasattr(self.rhs, 'currency'):
+            self.currency = self.rhs.currency.upper()
+            self.rhs = self.rhs.amount
+        return super(InlineMoneyExact, self).get_prep_lookup()
+
+    def as_sql(self, compiler, connection):
+        sql, params = super(InlineMoneyExact, self).as_sql(compiler, connection)
+        if self.currency is None:
+            return sql, params
+        field = self.lhs.target
+        currency_col = field.model._meta.get_field(field.currency_attname).get_col(self.lhs.alias)
+        currency_sql, currency_params = compiler.compile(currency_col)
+        return '(%s AND %s = %%s)' % (sql, currency_sql), list(params) + list(currency_params) + [self.currency]
+
+
+class InlineBaseAmountGreaterThan(InlineBaseAmountLookupMixin, lookups.GreaterThan):
+    pass
+
+
+class InlineBaseAmountGreaterThanOrEqual(InlineBaseAmountLookupMixin, lookups.GreaterThanOrEqual):
+    pass
+
+
+class InlineBaseAmountLessThan(InlineBaseAmountLookupMixin, lookups.LessThan):
+    pass
+
+
+class InlineBaseAmountLessThanOrEqual(InlineBaseAmountLookupMixin, lookups.LessThanOrEqual):
+    pass
+
+
+class InlineBaseAmountRange(InlineBaseAmountLookupMixin, lookups.Range):
+    pass
+
+
+class MinorBaseUnitsLookupMixin(InlineBaseAmountLookupMixin):
+    """
+    Lookup for MinorMoneyAmountField, comparing the <name>_base_units
+    column with the value in minor units of the base currency.
+    """
+    def base_column(self, field):
+        return field.base_units_attname
+
+    def prepare_value(self, value):
+        return to_base_units(value)
+
+
+class MinorBaseUnitsGreaterThan(MinorBaseUnitsLookupMixin, lookups.GreaterThan):
+    pass
+
+
+class MinorBaseUnitsGreaterThanOrEqual(MinorBaseUnitsLookupMixin, lookups.GreaterThanOrEqual):
+    pass
+
+
+class MinorBaseUnitsLessThan(MinorBaseUnitsLookupMixin, lookups.LessThan):
+    pass
+
+
+class MinorBaseUnitsLessThanOrEqual(MinorBaseUnitsLookupMixin, lookups.LessThanOrEqual):
+    pass
+
+
+class MinorBaseUnitsRange(MinorBaseUnitsLookupMixin, lookups.Range):
+    pass
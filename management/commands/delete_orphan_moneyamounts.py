@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...orphans import iter_orphan_chunks
+
+
+class Command(BaseCommand):
+    help = "Deletes MoneyAmount objects that are not referenced by any model, in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of pks per chunk")
+        parser.add_argument('--start-pk', type=int, default=None, help="Resume from this pk")
+        parser.add_argument('--end-pk', type=int, default=None, help="Stop at this pk")
+        parser.add_argument('--margin', type=int, default=1000,
+                            help="Skip the newest pks, which may belong to instances being saved")
+        parser.add_argument('--sleep', type=float, default=0, help="Seconds to wait between chunks")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the orphans")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        found = deleted = 0
+        chunk = None
+        try:
+            for chunk in iter_orphan_chunks(
+                    chunk_size=options['chunk_size'], start_pk=options['start_pk'], end_pk=options['end_pk'],
+                    margin=options['margin'], sleep=options['sleep'], dry_run=options['dry_run'],
+                    using=options['database']):
+                found += chunk.found
+                deleted += chunk.deleted
+                if options['verbosity'] >= 2:
+                    self.stdout.write("pk %d-%d: %d found, %d deleted" % chunk)
+        except KeyboardInterrupt:
+            if chunk is not None:
+                self.stderr.write("Interrupted, resume with --start-pk %d" % (chunk.last_pk + 1))
+            raise
+        self.stdout.write("%d orphaned MoneyAmounts found, %d deleted" % (found, deleted))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...importers import RateImportError, import_rate_file
+
+
+class Command(BaseCommand):
+    help = "Imports exchange rates and their history from an ECB style XML or CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['xml', 'csv'], default=None,
+                            help="File format, by default guessed from the file extension")
+        parser.add_argument('--quote-currency', default='EUR',
+                            help="Currency that the rates in the file are given per unit of")
+        parser.add_argument('--currencies', default=None, help="Comma separated ISO codes to import, default all")
+        parser.add_argument('--no-activate', action='store_false', dest='activate',
+                            help="Do not activate currencies that are not already active")
+
+    def handle(self, *args, **options):
+        currencies = options['currencies'].split(',') if options['currencies'] else None
+        try:
+            result = import_rate_file(
+                options['path'], format=options['format'], quote_currency=options['quote_currency'],
+                currencies=currencies, activate=options['activate'])
+        except (RateImportError, EnvironmentError) as e:
+            raise CommandError(str(e))
+        self.stdout.write("%d exchange rates created, %d updated, %d history entries added" % result)
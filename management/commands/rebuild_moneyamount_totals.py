@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...totals import rebuild_totals
+
+
+class Command(BaseCommand):
+    help = "Recalculates the MoneyAmount totals per currency and owner, aggregating the tables in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Number of pks per chunk")
+        parser.add_argument('--dry-run', action='store_true', help="Only report the totals that are wrong")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        differences = rebuild_totals(
+            chunk_size=options['chunk_size'], dry_run=options['dry_run'], using=options['database'])
+        for difference in differences:
+            self.stdout.write("%s%s: stored %s, actual %s" % (
+                difference.owner + " " if difference.owner else "", difference.currency, difference.stored, difference.actual))
+        self.stdout.write("%d wrong totals%s" % (
+            len(differences), "" if options['dry_run'] or not differences else ", rebuilt"))
@@ -0,0 +1,154 @@
+from decimal import Decimal
+
+from django.db import connections, models, router, transaction
+
+from .expressions import SumIn
+from .fields import MoneyAmountField, REPLACED_MONEYAMOUNTS, _InlineBaseValuesMixin, pending
+from .totals import apply_deltas, change_deltas, mark_stored, owner_deltas, owner_key
+from . import settings as cur_settings
+
+
+def _moneyamount_fields(model, names=None):
+    return [
+        f for f in model._meta.concrete_fields
+        if isinstance(f, MoneyAmountField) and (names is None or f.name in names or f.attname in names)
+    ]
+
+
+def _inline_fields(model, names):
+    """Returns the inline money fields whose amount or currency is in names"""
+    return [
+        f for f in model._meta.concrete_fields
+        if isinstance(f, _InlineBaseValuesMixin) and (f.name in names or f.attname in names or f.currency_attname in names)
+    ]
+
+
+def _set_base_values(moneyamounts):
+    """
+    Sets base_amount and base_exchange_rate on all the given MoneyAmount
+    objects, with the exchange rates from one snapshot.
+    """
+    from .models import CurrencyExchangeRate
+    base_currency = CurrencyExchangeRate.base_currency()
+    currencies = [(moneyamount.currency or base_currency).upper() for moneyamount in moneyamounts]
+    rates = CurrencyExchangeRate.get_exchange_rates([c for c in currencies if c != base_currency])
+    for moneyamount, currency in zip(moneyamounts, currencies):
+        if currency == base_currency or moneyamount.amount == 0.0:
+            moneyamount.base_amount, moneyamount.base_exchange_rate = Decimal(moneyamount.amount), 1
+        else:
+            moneyamount.base_amount = Decimal(moneyamount.amount) * rates[currency]
+            moneyamount.base_exchange_rate = rates[currency]
+        moneyamount.set_base_values_current()
+
+
+def bulk_save_moneyamounts(moneyamounts, batch_size=None, using=None):
+    """
+    Saves the new MoneyAmount objects with one INSERT, and the ones whose
+    amount or currency have changed with one UPDATE, per batch. Base values
+    are calculated with the exchange rates from one snapshot.
+    """
+    from .models import MoneyAmount
+    new = [moneyamount for moneyamount in moneyamounts if moneyamount.pk is None]
+    changed = [moneyamount for moneyamount in moneyamounts
+               if moneyamount.pk is not None and moneyamount.base_values_outdated]
+    _set_base_values(new + changed)
+    using = using or router.db_for_write(MoneyAmount)
+    if not cur_settings.TRACK_TOTALS:
+        _write_moneyamounts(new, changed, using, batch_size)
+        return
+    with transaction.atomic(using=using):
+        deltas = change_deltas(new + changed, using)
+        _write_moneyamounts(new, changed, using, batch_size)
+        apply_deltas(deltas, using)
+    for moneyamount in new + changed:
+        mark_stored(moneyamount)
+
+
+def _write_moneyamounts(new, changed, using, batch_size):
+    from .models import MoneyAmount
+    features = connections[using].features
+    if new:
+        if getattr(features, 'can_return_rows_from_bulk_insert', getattr(features, 'can_return_ids_from_bulk_insert', False)):
+            MoneyAmount._base_manager.using(using).bulk_create(new, batch_size=batch_size)
+        else:
+            # Without RETURNING, the primary keys have to be fetched row by row
+            for moneyamount in new:
+                moneyamount.save_base(using=using)
+    if changed:
+        MoneyAmount._base_manager.using(using).bulk_update(
+            changed, ['amount', 'currency', 'base_amount', 'base_exchange_rate'], batch_size=batch_size)
+
+
+class MoneyAmountOwnerQuerySet(models.QuerySet):
+    """
+    QuerySet for models with MoneyAmountFields. bulk_create() and bulk_update()
+    also write the related MoneyAmount objects, with one query per batch.
+
+    Intended usage:
+    objects = commerce.managers.MoneyAmountOwnerManager()
+    """
+    def _save_moneyamounts(self, objs, fields=None, batch_size=None):
+        attached = []
+        for field in _moneyamount_fields(self.model, fields):
+            for obj in objs:
+                rel_obj = pending(obj).get(field.name)
+                if rel_obj is None and not field.null and getattr(obj, field.attname) is None:
+                    rel_obj = field.remote_field.model()
+                if rel_obj is not None:
+                    attached.append((obj, field, rel_obj))
+                elif field.is_cached(obj) and field.get_cached_value(obj) is not None:
+                    attached.append((obj, field, field.get_cached_value(obj)))
+        bulk_save_moneyamounts([rel_obj for obj, field, rel_obj in attached], batch_size=batch_size, using=self.db)
+        for obj, field, rel_obj in attached:
+            setattr(obj, field.name, rel_obj)
+        if cur_settings.TRACK_TOTALS:
+            # Counted here with one UPDATE per currency, which leaves nothing
+            # for MoneyAmountField.pre_save() to count
+            for field in _moneyamount_fields(self.model, fields):
+                apply_deltas(owner_deltas(objs, field, self.db), self.db, owner_key(field))
+
+    def _delete_replaced_moneyamounts(self, objs):
+        from .models import MoneyAmount
+        replaced = set()
+        for obj in objs:
+            replaced.update(obj.__dict__.pop(REPLACED_MONEYAMOUNTS, ()))
+        for field in _moneyamount_fields(self.model):
+            replaced.difference_update(getattr(obj, field.attname) for obj in objs)
+        if replaced:
+            MoneyAmount._base_manager.using(self.db).filter(pk__in=replaced).delete()
+
+    def total_in(self, field, currency, current=False):
+        """
+        Returns the sum of the amounts of the MoneyAmountField `field`
+        converted to currency, aggregated in the database. See
+        commerce.expressions.AmountIn.
+        """
+        return self.aggregate(total=SumIn(field, currency, current=current))['total']
+
+    def bulk_create(self, objs, batch_size=None, *args, **kwargs):
+        objs = list(objs)
+        self._for_write = True
+        with transaction.atomic(using=self.db):
+            self._save_moneyamounts(objs, batch_size=batch_size)
+            objs = super(MoneyAmountOwnerQuerySet, self).bulk_create(objs, batch_size, *args, **kwargs)
+            self._delete_replaced_moneyamounts(objs)
+        return objs
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        objs = list(objs)
+        fields = list(fields)
+        # QuerySet.bulk_update() does not call pre_save(), which keeps the
+        # base columns of inline fields up to date
+        for field in _inline_fields(self.model, fields):
+            for obj in objs:
+                field.pre_save(obj, False)
+            fields.extend(name for name in field.base_attnames if name not in fields)
+        self._for_write = True
+        with transaction.atomic(using=self.db):
+            self._save_moneyamounts(objs, fields=fields, batch_size=batch_size)
+            rows = super(MoneyAmountOwnerQuerySet, self).bulk_update(objs, fields, batch_size)
+            self._delete_replaced_moneyamounts(objs)
+        return rows
+
+
+MoneyAmountOwnerManager = models.Manager.from_queryset(MoneyAmountOwnerQuerySet)
@@ -0,0 +1,162 @@
+"""
+Counters and timings of the hot paths, sent to a pluggable sink set by the
+METRICS_SINK setting: 'logging', 'statsd', 'memory', the dotted path of a
+sink class, or None (the default) to disable them. Call sites check
+metrics.enabled before building any metric names, so disabled metrics cost
+one attribute lookup.
+
+Metric names:
+rate_cache.hit / rate_cache.miss    Rate lookups served by the rate cache, or
+                                    falling back to a query
+rate_cache.reload                   Snapshot reloads, also as a timing
+convert.<FROM>.<TO>                 Converted amounts per currency pair
+descriptor.create                   MoneyAmounts attached by MoneyAmountDescriptor
+descriptor.delete                   Replaced MoneyAmounts deleted on save
+base_values.update                  Timing of base value calculations
+forms.query                         Queries made by MoneyAmount form fields
+"""
+import logging
+import socket
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from . import settings as cur_settings
+
+
+class LoggingSink(object):
+    """Logs every metric at DEBUG level"""
+    def __init__(self, logger='moneyamount.metrics'):
+        self.logger = logging.getLogger(logger)
+
+    def incr(self, name, value):
+        self.logger.debug("%s +%d", name, value)
+
+    def timing(self, name, ms):
+        self.logger.debug("%s %.3f ms", name, ms)
+
+
+class StatsdSink(object):
+    """Sends every metric as a StatsD UDP packet, ignoring network errors"""
+    def __init__(self, address=None, prefix=None):
+        self.address = tuple(address or cur_settings.METRICS_STATSD_ADDRESS)
+        self.prefix = prefix if prefix is not None else cur_settings.METRICS_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data.encode('ascii'), self.address)
+        except (socket.error, UnicodeError):
+            pass
+
+    def _name(self, name):
+        return "%s.%s" % (self.prefix, name) if self.prefix else name
+
+    def incr(self, name, value):
+        self._send("%s:%d|c" % (self._name(name), value))
+
+    def timing(self, name, ms):
+        self._send("%s:%.3f|ms" % (self._name(name), ms))
+
+
+class MemorySink(object):
+    """Keeps counters and timing summaries in memory, see snapshot()"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+    def incr(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, ms):
+        with self._lock:
+            count, total, low, high = self.timings.get(name, (0, 0.0, ms, ms))
+            self.timings[name] = (count + 1, total + ms, min(low, ms), max(high, ms))
+
+    def snapshot(self):
+        """
+        Returns {'counters': {name: value}, 'timings': {name: {'count',
+        'total', 'min', 'max', 'mean'}}}, with times in milliseconds
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': {
+                    name: {'count': count, 'total': total, 'min': low, 'max': high, 'mean': total / count}
+                    for name, (count, total, low, high) in self.timings.items()
+                },
+            }
+
+
+SINKS = {
+    'logging': LoggingSink,
+    'statsd': StatsdSink,
+    'memory': MemorySink,
+}
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    def __init__(self, sink=None):
+        self.configure(sink)
+
+    def configure(self, sink):
+        """Sets the sink, which is a sink object, a name in SINKS, a dotted path or None"""
+        if isinstance(sink, str):
+            sink = SINKS[sink]() if sink in SINKS else import_string(sink)()
+        self.sink = sink
+        self.enabled = sink is not None
+
+    def incr(self, name, value=1):
+        if self.enabled:
+            self.sink.incr(name, value)
+
+    def timing(self, name, ms):
+        if self.enabled:
+            self.sink.timing(name, ms)
+
+    def timer(self, name):
+        """Context manager sending the time spent in it as a timing"""
+        return _Timer(self, name) if self.enabled else NULL_TIMER
+
+    def snapshot(self):
+        """Returns the snapshot of a MemorySink, or None for other sinks"""
+        snapshot = getattr(self.sink, 'snapshot', None)
+        return snapshot() if snapshot is not None else None
+
+
+metrics = Metrics(cur_settings.METRICS_SINK)
@@ -0,0 +1,261 @@
+"""
+Integer arithmetic on amounts in minor units (e.g. cents), as stored by
+fields.MinorMoneyAmountField. Decimals are only produced at the edges, by
+MinorMoney.amount and amount_as().
+
+The number of decimals of each currency comes from the CURRENCY_MINOR_UNITS
+setting. Conversions use the exchange rates as integers scaled by
+RATE_SCALE, and round half away from zero, once per conversion.
+"""
+import functools
+from decimal import Decimal, ROUND_HALF_UP
+from numbers import Number
+
+from .money import Money, to_decimal
+from .ratecache import rate_cache
+from . import settings as cur_settings
+
+RATE_DIGITS = 8
+RATE_SCALE = 10 ** RATE_DIGITS
+
+
+def minor_units(currency):
+    """Returns the number of decimals of the minor unit of currency"""
+    return cur_settings.CURRENCY_MINOR_UNITS.get(currency.upper(), cur_settings.DEFAULT_MINOR_UNITS)
+
+
+def to_minor(amount, currency):
+    """Converts an amount to minor units of currency, rounding half away from zero"""
+    if isinstance(amount, int):
+        return amount * 10 ** minor_units(currency)
+    return int(to_decimal(amount).scaleb(minor_units(currency)).to_integral_value(ROUND_HALF_UP))
+
+
+def from_minor(units, currency):
+    """Converts minor units of currency to a Decimal amount"""
+    return Decimal(units).scaleb(-minor_units(currency))
+
+
+def div_round(numerator, denominator):
+    """Integer division rounding half away from zero"""
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def fixed_rate(rate):
+    """Returns an exchange rate as an integer scaled by RATE_SCALE"""
+    return int(to_decimal(rate).scaleb(RATE_DIGITS).to_integral_value(ROUND_HALF_UP))
+
+
+class FixedRateRegistry(object):
+    """
+    Exchange rates as integers scaled by RATE_SCALE, built from the current
+    rate snapshot and rebuilt when it is replaced.
+    """
+    def __init__(self):
+        self._state = (None, {})
+
+    def get(self, currency):
+        from .models import CurrencyExchangeRate
+        currency = currency.upper()
+        if currency == cur_settings.BASE_CURRENCY:
+            return RATE_SCALE
+        if not cur_settings.CACHE_EXCHANGE:
+            return fixed_rate(CurrencyExchangeRate.get_exchange_rate(currency))
+        snapshot = rate_cache.get()
+        built_from, rates = self._state
+        if built_from is not snapshot:
+            rates = {iso_code: fixed_rate(item.exchange_rate) for iso_code, item in snapshot.items.items()}
+            self._state = (snapshot, rates)
+        rate = rates.get(currency)
+        if rate is None:
+            rate = fixed_rate(CurrencyExchangeRate.get_exchange_rate(currency))
+        return rate
+
+    def convert(self, units, from_currency, to_currency):
+        """Converts minor units of from_currency to minor units of to_currency"""
+        from_currency = from_currency.upper()
+        to_currency = to_currency.upper()
+        if from_currency == to_currency:
+            return units
+        return div_round(
+            units * self.get(from_currency) * 10 ** minor_units(to_currency),
+            self.get(to_currency) * 10 ** minor_units(from_currency),
+        )
+
+    def convert_many(self, units, from_currencies, to_currency):
+        """
+        Converts a sequence of minor units. from_currencies is either one
+        currency for all of them or a sequence of the same length.
+        """
+        if isinstance(from_currencies, str):
+            from_currencies = [from_currencies] * len(units)
+        return [self.convert(u, from_currency, to_currency) for u, from_currency in zip(units, from_currencies)]
+
+
+fixed_rates = FixedRateRegistry()
+
+
+@functools.total_ordering
+class MinorMoney(object):
+    """
+    Immutable amount as an integer number of minor units of a currency.
+    Arithmetic with other MinorMoney objects is made in integers, other
+    operands are converted to minor units first. As with Money, the result
+    is in the currency of the left operand, and numbers are amounts in that
+    currency, also in comparisons.
+    """
+    __slots__ = ('units', 'currency', '_base_units')
+
+    def __init__(self, units=0, currency=None):
+        object.__setattr__(self, 'units', int(units))
+        object.__setattr__(self, 'currency', (currency or cur_settings.BASE_CURRENCY).upper())
+        object.__setattr__(self, '_base_units', None)
+
+    @classmethod
+    def from_amount(cls, amount, currency=None):
+        currency = currency or cur_settings.BASE_CURRENCY
+        return cls(to_minor(amount, currency), currency)
+
+    @classmethod
+    def from_money(cls, money):
+        """Converts a Money or MoneyAmount object"""
+        return cls.from_amount(money.amount, money.currency)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MinorMoney is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MinorMoney is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.units, self.currency))
+
+    def __repr__(self):
+        return "MinorMoney(%r, %r)" % (self.units, self.currency)
+
+    def __str__(self):
+        return " ".join([str(self.amount), self.currency, ])
+
+    def __bool__(self):
+        return bool(self.units)
+
+    __nonzero__ = __bool__
+
+    def __hash__(self):
+        # The same hash as the equal Money amount and number
+        return hash(from_minor(self.base_units, cur_settings.BASE_CURRENCY))
+
+    @property
+    def amount(self):
+        return from_minor(self.units, self.currency)
+
+    @property
+    def base_units(self):
+        if self._base_units is None:
+            object.__setattr__(self, '_base_units', fixed_rates.convert(
+                self.units, self.currency, cur_settings.BASE_CURRENCY))
+        return self._base_units
+
+    def units_as(self, currency):
+        currency = currency.upper()
+        if currency == self.currency:
+            return self.units
+        if currency == cur_settings.BASE_CURRENCY:
+            return self.base_units
+        return fixed_rates.convert(self.units, self.currency, currency)
+
+    def amount_as(self, currency):
+        return from_minor(self.units_as(currency), currency)
+
+    def convert_to(self, currency):
+        currency = currency.upper()
+        return MinorMoney(self.units_as(currency), currency)
+
+    def to_money(self):
+        return Money(self.amount, self.currency)
+
+    def _other_units(self, other):
+        """
+        Returns other in minor units of the currency of self, or None if
+        other is of an unsupported type.
+        """
+        if isinstance(other, MinorMoney):
+            return other.units_as(self.currency)
+        if hasattr(other, 'amount_as') and hasattr(other, 'currency'):
+            return to_minor(other.amount_as(self.currency), self.currency)
+        if isinstance(other, Number):
+            return to_minor(other, self.currency)
+        return None
+
+    def __eq__(self, other):
+        if isinstance(other, MinorMoney) and other.currency != self.currency:
+            return self.base_units == other.base_units
+        units = self._other_units(other)
+        if units is None:
+            return NotImplemented
+        return self.units == units
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        if isinstance(other, MinorMoney) and other.currency != self.currency:
+            return self.base_units < other.base_units
+        units = self._other_units(other)
+        if units is None:
+            return NotImplemented
+        return self.units < units
+
+    def __add__(self, other):
+        units = self._other_units(other)
+        if units is None:
+            return NotImplemented
+        return MinorMoney(self.units + units, self.currency)
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        units = self._other_units(other)
+        if units is None:
+            return NotImplemented
+        return MinorMoney(self.units - units, self.currency)
+
+    def __rsub__(self, other):
+        units = self._other_units(other)
+        if units is None:
+            return NotImplemented
+        return MinorMoney(units - self.units, self.currency)
+
+    def __mul__(self, other):
+        if isinstance(other, int):
+            return MinorMoney(self.units * other, self.currency)
+        if isinstance(other, Number):
+            units = (self.units * to_decimal(other)).to_integral_value(ROUND_HALF_UP)
+            return MinorMoney(units, self.currency)
+        return NotImplemented
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        if isinstance(other, int):
+            return MinorMoney(div_round(self.units, other), self.currency)
+        if isinstance(other, Number):
+            units = (self.units / to_decimal(other)).to_integral_value(ROUND_HALF_UP)
+            return MinorMoney(units, self.currency)
+        return NotImplemented
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return MinorMoney(-self.units, self.currency)
+
+    def __abs__(self):
+        return MinorMoney(abs(self.units), self.currency)
@@ -1,20 +1,26 @@
-import re
-from datetime import timedelta
+from collections import Counter
 from decimal import Decimal
 from numbers import Number
 
-from django.db import models
-from django.utils import timezone
+from asgiref.sync import sync_to_async
+from django.db import models, router, transaction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .fields import MoneyAmountField
+from .formatting import formatters
+from .history import as_datetime, rate_history
+from .metrics import metrics
+from .money import Money, to_decimal
+from .ratecache import rate_cache
+from .totals import apply_deltas, change_deltas, mark_stored
+from .utils import acall
 from . import settings as cur_settings
 
 
-class _ExchangeRateCacher(object):
-    items = None
-    recache_at = None
-
-
 class CurrencyExchangeRate(models.Model):
     iso_code = models.CharField(max_length=6)
     name = models.CharField(max_length=64)
@@ -42,21 +48,34 @@ class CurrencyExchangeRate(models.Model):
         """Returns active exchange rate item for the given currency"""
         currency = currency.upper()
         if cur_settings.CACHE_EXCHANGE:
-            if _ExchangeRateCacher.items is None:
-                # init the cache
-                _ExchangeRateCacher.items = {}
-                if cur_settings.CACHE_EXCHANGE_DURATION > 0:
-                    # to fetch data now
-                    _ExchangeRateCacher.recache_at = timezone.now() + timedelta(minutes=-1)
-            if currency not in _ExchangeRateCacher.items or (_ExchangeRateCacher.recache_at is not None and _ExchangeRateCacher.recache_at > timezone.now()):
-                for item in cls.objects.filter(active=True):
-                    _ExchangeRateCacher.items[item.iso_code] = item
-                if cur_settings.CACHE_EXCHANGE_DURATION > 0:
-                    _ExchangeRateCacher.recache_at = timezone.now() + timedelta(minutes=cur_settings.CACHE_EXCHANGE_DURATION)
-            if currency in _ExchangeRateCacher.items:
-                return _ExchangeRateCacher.items[currency]
+            item = rate_cache.get().get(currency)
+            if item is not None:
+                if metrics.enabled:
+                    metrics.incr('rate_cache.hit')
+                return item
+        if metrics.enabled:
+            metrics.incr('rate_cache.miss')
         return cls.objects.get(iso_code=currency, active=True)
 
+    @classmethod
+    async def aget_exchange_rate(cls, currency):
+        """Async variant of get_exchange_rate()"""
+        return (await cls.aget_exchange_rate_item(currency)).exchange_rate
+
+    @classmethod
+    async def aget_exchange_rate_item(cls, currency):
+        """Async variant of get_exchange_rate_item(), sharing its rate snapshot"""
+        currency = currency.upper()
+        if cur_settings.CACHE_EXCHANGE:
+            item = (await rate_cache.aget()).get(currency)
+            if item is not None:
+                if metrics.enabled:
+                    metrics.incr('rate_cache.hit')
+                return item
+        if metrics.enabled:
+            metrics.incr('rate_cache.miss')
+        return await acall(cls.objects.filter(active=True), 'get', iso_code=currency)
+
     @classmethod
     def convert(cls, amount, from_currency=None, to_currency=None):
         """
@@ -64,21 +83,168 @@ class CurrencyExchangeRate(models.Model):
         """
         if amount == 0.0:
             return Decimal(0.0), 1
+        from_currency, to_currency = cls._convert_pair(from_currency, to_currency)
+        if to_currency == from_currency:
+            return Decimal(amount), 1
+        base_currency = cls.base_currency()
+        from_rate = cls.get_exchange_rate(from_currency) if from_currency != base_currency else None
+        to_rate = cls.get_exchange_rate(to_currency) if to_currency != base_currency else None
+        return cls._convert_with_rates(amount, from_rate, to_rate)
+
+    @classmethod
+    async def aconvert(cls, amount, from_currency=None, to_currency=None):
+        """Async variant of convert()"""
+        if amount == 0.0:
+            return Decimal(0.0), 1
+        from_currency, to_currency = cls._convert_pair(from_currency, to_currency)
+        if to_currency == from_currency:
+            return Decimal(amount), 1
+        base_currency = cls.base_currency()
+        from_rate = await cls.aget_exchange_rate(from_currency) if from_currency != base_currency else None
+        to_rate = await cls.aget_exchange_rate(to_currency) if to_currency != base_currency else None
+        return cls._convert_with_rates(amount, from_rate, to_rate)
+
+    @classmethod
+    def _convert_pair(cls, from_currency, to_currency):
         base_currency = cls.base_currency()
-        to_currency = (to_currency or base_currency).upper()
         from_currency = (from_currency or base_currency).upper()
+        to_currency = (to_currency or base_currency).upper()
+        if metrics.enabled:
+            metrics.incr('convert.%s.%s' % (from_currency, to_currency))
+        return from_currency, to_currency
+
+    @staticmethod
+    def _convert_with_rates(amount, from_rate, to_rate):
         new_amount = amount
         exchange_rate = 1
-        if to_currency == from_currency:
-            return Decimal(new_amount), 1
-        if from_currency != base_currency:
-            exchange_rate = cls.get_exchange_rate(from_currency)
+        if from_rate is not None:
+            exchange_rate = from_rate
             new_amount = Decimal(new_amount) * Decimal(exchange_rate)
-        if to_currency != base_currency:
-            exchange_rate = cls.get_exchange_rate(to_currency)
+        if to_rate is not None:
+            exchange_rate = to_rate
             new_amount = Decimal(new_amount) / Decimal(exchange_rate)
         return Decimal(new_amount), exchange_rate
 
+    @classmethod
+    def active_currencies(cls):
+        """Returns the ISO codes of all currencies with an active exchange rate"""
+        if cur_settings.CACHE_EXCHANGE:
+            return list(rate_cache.get().items)
+        return [iso_code.upper() for iso_code in cls.objects.filter(active=True).values_list('iso_code', flat=True)]
+
+    @classmethod
+    def get_exchange_rates(cls, currencies):
+        """
+        Returns a dict of active exchange rates for the given currencies,
+        keyed by upper case ISO code. All rates come from the same snapshot.
+        """
+        snapshot = rate_cache.get() if cur_settings.CACHE_EXCHANGE else None
+        rates = {}
+        for currency in set(currency.upper() for currency in currencies):
+            item = snapshot.get(currency) if snapshot is not None else None
+            if metrics.enabled:
+                metrics.incr('rate_cache.hit' if item is not None else 'rate_cache.miss')
+            if item is None:
+                item = cls.objects.get(iso_code=currency, active=True)
+            rates[currency] = Decimal(item.exchange_rate)
+        return rates
+
+    @classmethod
+    def _normalize_currencies(cls, currencies, length):
+        base_currency = cls.base_currency()
+        if currencies is None or isinstance(currencies, str):
+            return [(currencies or base_currency).upper()] * length
+        return [str(currency or base_currency).upper() for currency in currencies]
+
+    @classmethod
+    def _factors(cls, from_currencies, to_currencies):
+        """
+        Returns a dict of (multiplier, divisor) for every currency pair, with
+        None where convert() would skip the operation.
+        """
+        base_currency = cls.base_currency()
+        rates = cls.get_exchange_rates(
+            [c for c in set(from_currencies) | set(to_currencies) if c != base_currency])
+        factors = {}
+        for from_currency in set(from_currencies):
+            for to_currency in set(to_currencies):
+                if from_currency == to_currency:
+                    factors[from_currency, to_currency] = (None, None)
+                else:
+                    factors[from_currency, to_currency] = (rates.get(from_currency), rates.get(to_currency))
+        return factors
+
+    @staticmethod
+    def _apply_factors(amount, multiplier, divisor):
+        if amount == 0.0:
+            return Decimal(0.0)
+        new_amount = Decimal(amount)
+        if multiplier is not None:
+            new_amount = new_amount * multiplier
+        if divisor is not None:
+            new_amount = new_amount / divisor
+        return new_amount
+
+    @classmethod
+    def convert_many(cls, amounts, from_currencies=None, to_currency=None, exact=True):
+        """
+        Converts a sequence of amounts to to_currency, by default the base
+        currency. from_currencies is either one currency for all amounts or a
+        sequence of the same length as amounts. Every currency pair is only
+        resolved once.
+
+        Returns a list of Decimals, equal to what convert() would return. With
+        exact=False, the amounts are converted as float64 instead, and a NumPy
+        array is returned if NumPy is installed, or else a list of floats.
+        """
+        matrix = cls.convert_matrix(amounts, from_currencies, [to_currency or cls.base_currency()], exact)
+        if numpy is not None and not exact:
+            return matrix[:, 0]
+        return [row[0] for row in matrix]
+
+    @classmethod
+    def convert_matrix(cls, amounts, from_currencies=None, to_currencies=None, exact=True):
+        """
+        Converts a sequence of amounts to each of the to_currencies. Returns
+        a matrix with one row per amount and one column per currency in
+        to_currencies, as a list of lists of Decimals, or with exact=False,
+        as a float64 NumPy array (list of lists of floats without NumPy).
+        """
+        if numpy is not None and isinstance(amounts, numpy.ndarray):
+            amounts = amounts.tolist() if exact else amounts
+        else:
+            amounts = list(amounts)
+        from_currencies = cls._normalize_currencies(from_currencies, len(amounts))
+        if to_currencies is None or isinstance(to_currencies, str):
+            to_currencies = [to_currencies]
+        to_currencies = cls._normalize_currencies(to_currencies, len(to_currencies))
+        factors = cls._factors(from_currencies, to_currencies)
+        if metrics.enabled:
+            for from_currency, count in Counter(from_currencies).items():
+                for to_currency in to_currencies:
+                    metrics.incr('convert.%s.%s' % (from_currency, to_currency), count)
+        if exact:
+            return [
+                [cls._apply_factors(amount, *factors[from_currency, to_currency]) for to_currency in to_currencies]
+                for amount, from_currency in zip(amounts, from_currencies)
+            ]
+        float_factors = {
+            pair: float((multiplier or 1) / (divisor or 1)) for pair, (multiplier, divisor) in factors.items()
+        }
+        if numpy is None:
+            return [
+                [float(amount) * float_factors[from_currency, to_currency] for to_currency in to_currencies]
+                for amount, from_currency in zip(amounts, from_currencies)
+            ]
+        if not from_currencies:
+            return numpy.zeros((0, len(to_currencies)), dtype=numpy.float64)
+        unique_currencies, inverse = numpy.unique(numpy.array(from_currencies), return_inverse=True)
+        factor_matrix = numpy.array([
+            [float_factors[from_currency, to_currency] for to_currency in to_currencies]
+            for from_currency in unique_currencies.tolist()
+        ], dtype=numpy.float64)
+        return numpy.asarray(amounts, dtype=numpy.float64)[:, None] * factor_matrix[inverse]
+
     @classmethod
     def to_base_currency(cls, amount, currency):
         """
@@ -93,26 +259,72 @@ class CurrencyExchangeRate(models.Model):
         """
         return cls.convert(amount, cls.base_currency(), currency)
 
+    @classmethod
+    def get_exchange_rate_at(cls, currency, when):
+        """Returns the exchange rate for the given currency at the given point in time"""
+        currency = currency.upper()
+        if currency == cls.base_currency():
+            return Decimal(1)
+        rate = rate_history.timelines([currency])[currency].rate_at(as_datetime(when))
+        if rate is None:
+            raise LookupError("No %s exchange rate as early as %s" % (currency, when))
+        return rate
+
+    @classmethod
+    def convert_at(cls, amounts, currencies, timestamps, to_currency=None, fallback_to_current=False):
+        """
+        Converts amounts at the exchange rates valid at their timestamps,
+        by default to base currency. See history.RateHistory.convert_at().
+        """
+        return rate_history.convert_at(amounts, currencies, timestamps, to_currency, fallback_to_current)
+
     @classmethod
     def format(cls, amount, currency):
         """
         Returns formated price string based on currency format settings
         """
-        exch = cls.get_exchange_rate_item(currency)
-        parts = divmod(amount, 1)
-        parts = int(parts[0]), int(parts[1] * pow(10, exch.decimal_places))
-        val = str(parts[0])
-        if exch.thousand_mark:
-            val = exch.thousand_mark.join(re.findall('((?:\d+\.)?\d{1,3})', val[::-1]))[::-1]
-        if exch.decimal_places:
-            dec = str(parts[1])
-            if exch.remove_decimal_zero:
-                dec = dec.rstrip('0')
-            elif len(dec) < exch.decimal_places:
-                dec += '0' * (exch.decimal_places-len(dec))
-            if dec:
-                val = val + exch.decimal_mark + dec
-        return val
+        return formatters.format(amount, currency)
+
+    @classmethod
+    def format_many(cls, amounts, currencies):
+        """
+        Returns formated price strings for a sequence of amounts, in one
+        currency or a sequence of currencies of the same length
+        """
+        return formatters.format_many(amounts, currencies)
+
+
+class CurrencyExchangeRateHistory(models.Model):
+    """
+    Exchange rate of a currency from valid_from until the next entry for
+    the same currency. Recorded when an active CurrencyExchangeRate is saved
+    with a new rate.
+    """
+    iso_code = models.CharField(max_length=6)
+    exchange_rate = models.DecimalField(decimal_places=4, max_digits=10)
+    valid_from = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['iso_code', 'valid_from'])]
+
+
+class MoneyAmountTotal(models.Model):
+    """
+    Total of all MoneyAmount objects in a currency, or of those referenced by
+    one MoneyAmountField if owner is set, maintained incrementally when
+    TRACK_TOTALS is set. See totals.py.
+    """
+    owner = models.CharField(max_length=255, blank=True, default='', help_text="app_label.model.field, or empty for all MoneyAmounts")
+    currency = models.CharField(max_length=8)
+    amount = models.DecimalField(default=0, max_digits=20, decimal_places=2)
+    base_amount = models.DecimalField(default=0, max_digits=20, decimal_places=2, help_text="Amount in system base currency")
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('owner', 'currency')]
+
+    def __unicode__(self):
+        return " ".join([str(self.amount), self.currency, ])
 
 
 class MoneyAmount(models.Model):
@@ -123,80 +335,90 @@ class MoneyAmount(models.Model):
     amount = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=8, choices=cur_settings.CURRENCIES, default=CurrencyExchangeRate.base_currency,
         help_text="Stored as ISO codes (SEK, EUR, etc) in the DB")
-    base_amount = models.DecimalField(default=0.0, editable=False, decimal_places=2, max_digits=10, help_text="Amount in system base currency")
+    base_amount = models.DecimalField(default=0.0, editable=False, decimal_places=2, max_digits=10, db_index=True, help_text="Amount in system base currency")
     base_currency = models.CharField(default=CurrencyExchangeRate.base_currency, editable=False, max_length=6, help_text="System base currency")
     base_exchange_rate = models.DecimalField(default=1, editable=False, decimal_places=4, max_digits=10)
 
-    def __cmp__(self, other):
+    # Defining __eq__ removes the inherited __hash__ on Python 3, which
+    # makes it impossible to delete MoneyAmount objects through the ORM
+    __hash__ = models.Model.__hash__
+
+    # Comparisons with MoneyAmount and Money objects are made on the amount
+    # in base currency (see base_key), and numbers are compared with the
+    # amount, as in arithmetic. __hash__ stays the pk hash above: a value
+    # hash would make the deletion Collector, which keeps instances in sets,
+    # treat different rows with equal amounts as one.
+
+    @property
+    def base_key(self):
+        """
+        The amount in base currency, cached until amount or currency change
+        """
+        source = (self.__dict__.get('amount'), self.__dict__.get('currency'))
+        cached = self.__dict__.get('_base_key')
+        if cached is None or cached[0] != source:
+            cached = (source, self.amount_as_base)
+            self.__dict__['_base_key'] = cached
+        return cached[1]
+
+    def _comparison_keys(self, other):
         if isinstance(other, MoneyAmount):
-            base_currency = CurrencyExchangeRate.base_currency()
-            diff = self.amount_as(base_currency) - other.amount_as(base_currency)
-        elif isinstance(other, Number):
-            diff = self.amount - Decimal(other)
-        else:
+            return self.base_key, other.base_key
+        if isinstance(other, Money):
+            return self.base_key, other.amount_as_base
+        if isinstance(other, Number):
+            return self.amount, to_decimal(other)
+        return None
+
+    def __cmp__(self, other):
+        keys = self._comparison_keys(other)
+        if keys is None:
             return NotImplemented
-        if diff < 0:
-            return -1
-        elif diff > 0:
-            return 1
-        else:
-            return 0
+        return (keys[0] > keys[1]) - (keys[0] < keys[1])
 
     def __eq__(self, other):
-        if isinstance(other, MoneyAmount):
-            base_currency = CurrencyExchangeRate.base_currency()
-            return self.amount_as(base_currency) == other.amount_as(base_currency)
-        elif isinstance(other, Number):
-            return self.amount == Decimal(other)
-        else:
-            return NotImplemented
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] == keys[1]
 
     def __ne__(self, other):
-        if isinstance(other, MoneyAmount):
-            base_currency = CurrencyExchangeRate.base_currency()
-            return self.amount_as(base_currency) != other.amount_as(base_currency)
-        elif isinstance(other, Number):
-            return self.amount != Decimal(other)
-        else:
-            return NotImplemented
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] != keys[1]
+
+    def __lt__(self, other):
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] < keys[1]
+
+    def __le__(self, other):
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] <= keys[1]
+
+    def __gt__(self, other):
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] > keys[1]
+
+    def __ge__(self, other):
+        keys = self._comparison_keys(other)
+        return NotImplemented if keys is None else keys[0] >= keys[1]
+
+    # Arithmetic gives Money objects, not new MoneyAmount instances
 
     def __add__(self, other):
-        if isinstance(other, MoneyAmount):
-            return MoneyAmount(amount=self.amount + other.amount_as(self.currency), currency=self.currency)
-        elif isinstance(other, Number):
-            return MoneyAmount(amount=self.amount + Decimal(other), currency=self.currency)
-        else:
-            return NotImplemented
+        return self.money.__add__(other)
 
     def __radd__(self, other):
-        return self.__add__(other)
+        return self.money.__radd__(other)
 
     def __sub__(self, other):
-        if isinstance(other, MoneyAmount):
-            return MoneyAmount(amount=self.amount - other.amount_as(self.currency), currency=self.currency)
-        elif isinstance(other, Number):
-            return MoneyAmount(amount=self.amount - Decimal(other), currency=self.currency)
-        else:
-            return NotImplemented
+        return self.money.__sub__(other)
 
     def __rsub__(self, other):
-        if isinstance(other, MoneyAmount):
-            return MoneyAmount(amount=other.amount_as(self.currency) - self.amount, currency=self.currency)
-        elif isinstance(other, Number):
-            return MoneyAmount(amount=Decimal(other) - self.amount, currency=self.currency)
-        else:
-            return NotImplemented
+        return self.money.__rsub__(other)
 
     def __mul__(self, other):
-        if isinstance(other, MoneyAmount):
-            return MoneyAmount(amount=self.amount * other.amount_as(self.currency), currency=self.currency)
-        elif isinstance(other, Number):
-            return MoneyAmount(amount=self.amount * Decimal(other), currency=self.currency)
-        else:
-            return NotImplemented
+        return self.money.__mul__(other)
 
     def __rmul__(self, other):
-        return self.__mul__(other)
+        return self.money.__rmul__(other)
 
     def __unicode__(self):
         return " ".join([str(self.amount), self.currency, ])
@@ -204,23 +426,89 @@ class MoneyAmount(models.Model):
     def __float__(self):
         return float(self.amount)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(MoneyAmount, cls).from_db(db, field_names, values)
+        # The stored base values belong to the stored amount and currency
+        instance.set_base_values_current()
+        if cur_settings.TRACK_TOTALS and 'base_amount' in instance.__dict__:
+            mark_stored(instance, (instance.currency.upper(), instance.amount, instance.base_amount))
+        return instance
+
+    def set_base_values_current(self):
+        """
+        Marks base_amount and base_exchange_rate as belonging to the current
+        amount and currency.
+        """
+        self._base_values_source = (self.__dict__.get('amount'), self.__dict__.get('currency'))
+
+    @property
+    def base_values_outdated(self):
+        """
+        True if amount or currency have changed since base_amount and
+        base_exchange_rate were calculated or loaded.
+        """
+        return getattr(self, '_base_values_source', None) != (self.__dict__.get('amount'), self.__dict__.get('currency'))
+
+    def update_base_values(self):
+        """
+        Recalculates base_amount and base_exchange_rate with the current
+        exchange rate, if amount or currency have changed.
+        """
+        if self.base_values_outdated:
+            with metrics.timer('base_values.update'):
+                self.base_amount, self.base_exchange_rate = CurrencyExchangeRate.to_base_currency(self.amount, self.currency)
+            self.set_base_values_current()
+
+    async def aupdate_base_values(self):
+        """Async variant of update_base_values()"""
+        if self.base_values_outdated:
+            with metrics.timer('base_values.update'):
+                self.base_amount, self.base_exchange_rate = \
+                    await CurrencyExchangeRate.aconvert(self.amount, self.currency)
+            self.set_base_values_current()
+
     def save(self, *args, **kwargs):
-        self.base_amount, self.base_exchange_rate = CurrencyExchangeRate.to_base_currency(self.amount, self.currency)
-        super(MoneyAmount, self).save(*args, ** kwargs)
+        self.update_base_values()
+        if not cur_settings.TRACK_TOTALS:
+            super(MoneyAmount, self).save(*args, ** kwargs)
+            return
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            deltas = change_deltas([self], using)
+            super(MoneyAmount, self).save(*args, ** kwargs)
+            apply_deltas(deltas, using)
+        mark_stored(self)
+
+    async def asave(self, *args, **kwargs):
+        """
+        Async variant of save(). The exchange rates are looked up without
+        blocking, the row is then written in a thread, as Django has no
+        native async save.
+        """
+        await self.aupdate_base_values()
+        await sync_to_async(self.save)(*args, **kwargs)
+
+    @property
+    def money(self):
+        """Returns the amount and currency as an immutable Money object"""
+        return Money(self.amount, self.currency)
+
+    @classmethod
+    def from_money(cls, money):
+        return cls(amount=money.amount, currency=money.currency)
 
     def convert_to(self, currency):
         currency = currency.upper()
-        return MoneyAmount(
-            amount=self.amount_as(currency),
-            currency=currency
-        )
+        return Money(self.amount_as(currency), currency)
 
     def amount_as(self, currency):
         currency = currency.upper()
+        if currency == self.currency:
+            return self.amount
+        self.update_base_values()
         if currency == self.base_currency:
             return self.base_amount
-        elif currency == self.currency:
-            return self.amount
         return CurrencyExchangeRate.convert(self.base_amount, self.base_currency, currency)[0]
 
     @property
@@ -0,0 +1,165 @@
+import functools
+from decimal import Decimal
+from numbers import Number
+
+from . import settings as cur_settings
+
+
+def to_decimal(value):
+    """
+    Converts a number to Decimal. Floats are converted through their string
+    representation, so that e.g. 0.1 becomes Decimal('0.1').
+    """
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+@functools.total_ordering
+class Money(object):
+    """
+    Immutable monetary amount with a currency, used as the result of
+    arithmetic on MoneyAmount objects, so that no model instances are
+    created.
+
+    As with MoneyAmount, arithmetic on two different currencies gives a
+    result in the currency of the left operand, and numbers are amounts in
+    that currency, also in comparisons. Comparisons with other money and
+    hashing are made on the amount in base currency, also for two values in
+    the same currency, so that values with different stored base amounts are
+    not equal. It is converted once, when it is first needed, unless it is
+    given as base_amount (e.g. a stored one). Only values in base currency
+    hash equal to the numbers they equal.
+    """
+    __slots__ = ('amount', 'currency', '_base_amount')
+
+    def __init__(self, amount=0, currency=None, base_amount=None):
+        object.__setattr__(self, 'amount', to_decimal(amount))
+        object.__setattr__(self, 'currency', (currency or cur_settings.BASE_CURRENCY).upper())
+        object.__setattr__(self, '_base_amount', None if base_amount is None else to_decimal(base_amount))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Money is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Money is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.amount, self.currency, self._base_amount))
+
+    def __repr__(self):
+        return "Money(%r, %r)" % (self.amount, self.currency)
+
+    def __str__(self):
+        return " ".join([str(self.amount), self.currency, ])
+
+    __unicode__ = __str__
+
+    def __float__(self):
+        return float(self.amount)
+
+    def __bool__(self):
+        return bool(self.amount)
+
+    __nonzero__ = __bool__
+
+    def __hash__(self):
+        return hash(self.amount_as_base)
+
+    @property
+    def amount_as_base(self):
+        if self._base_amount is None:
+            if self.currency == cur_settings.BASE_CURRENCY:
+                base_amount = self.amount
+            else:
+                from .models import CurrencyExchangeRate
+                base_amount = CurrencyExchangeRate.to_base_currency(self.amount, self.currency)[0]
+            object.__setattr__(self, '_base_amount', base_amount)
+        return self._base_amount
+
+    def amount_as(self, currency):
+        currency = currency.upper()
+        if currency == self.currency:
+            return self.amount
+        if currency == cur_settings.BASE_CURRENCY:
+            return self.amount_as_base
+        from .models import CurrencyExchangeRate
+        return CurrencyExchangeRate.convert(self.amount, self.currency, currency)[0]
+
+    def convert_to(self, currency):
+        currency = currency.upper()
+        return Money(self.amount_as(currency), currency)
+
+    def _other_amount(self, other):
+        """
+        Returns the amount of other in the currency of self, or None if other
+        is of an unsupported type.
+        """
+        if hasattr(other, 'amount_as') and hasattr(other, 'currency'):
+            return other.amount_as(self.currency)
+        if isinstance(other, Number):
+            return to_decimal(other)
+        return None
+
+    def __eq__(self, other):
+        if hasattr(other, 'amount_as') and hasattr(other, 'currency'):
+            return self.amount_as_base == other.amount_as(cur_settings.BASE_CURRENCY)
+        elif isinstance(other, Number):
+            return self.amount == to_decimal(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        if hasattr(other, 'amount_as') and hasattr(other, 'currency'):
+            return self.amount_as_base < other.amount_as(cur_settings.BASE_CURRENCY)
+        elif isinstance(other, Number):
+            return self.amount < to_decimal(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        amount = self._other_amount(other)
+        if amount is None:
+            return NotImplemented
+        return Money(self.amount + amount, self.currency)
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        amount = self._other_amount(other)
+        if amount is None:
+            return NotImplemented
+        return Money(self.amount - amount, self.currency)
+
+    def __rsub__(self, other):
+        amount = self._other_amount(other)
+        if amount is None:
+            return NotImplemented
+        return Money(amount - self.amount, self.currency)
+
+    def __mul__(self, other):
+        amount = self._other_amount(other)
+        if amount is None:
+            return NotImplemented
+        return Money(self.amount * amount, self.currency)
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        if not isinstance(other, Number):
+            return NotImplemented
+        return Money(self.amount / to_decimal(other), self.currency)
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return Money(-self.amount, self.currency)
+
+    def __abs__(self):
+        return Money(abs(self.amount), self.currency)
@@ -0,0 +1,93 @@
+"""
+Sorting, min/max and price bands for collections of MoneyAmount, Money and
+MinorMoney objects, by their amounts in base currency. The key of each value
+is computed once, with the exchange rates of one snapshot, so sorting n
+values makes n conversions at most. Numbers have no currency, and compare
+with the amount of each value in its own currency in the operators of these
+classes, so they have no key of their own and are rejected.
+"""
+from bisect import bisect_right
+
+from .minor import MinorMoney, from_minor
+from .money import Money, to_decimal
+from . import settings as cur_settings
+
+
+def base_keys(values):
+    """
+    Returns a list of the amounts of values in base currency. Stored base
+    amounts of MoneyAmount objects are used as they are, like
+    MoneyAmount.amount_as() does; everything else that needs converting is
+    converted with one convert_many().
+    """
+    from .models import CurrencyExchangeRate, MoneyAmount
+    base_currency = cur_settings.BASE_CURRENCY
+    keys = []
+    missing = []
+    for i, value in enumerate(values):
+        key = None
+        if isinstance(value, MoneyAmount):
+            if value.currency.upper() == base_currency:
+                key = value.amount
+            elif not value.base_values_outdated:
+                key = value.base_amount
+            else:
+                missing.append((i, value.amount, value.currency))
+        elif isinstance(value, Money):
+            if value.currency == base_currency or value._base_amount is not None:
+                key = value.amount_as_base
+            else:
+                missing.append((i, value.amount, value.currency))
+        elif isinstance(value, MinorMoney):
+            key = from_minor(value.base_units, base_currency)
+        else:
+            raise TypeError("Cannot compare %r as money" % (value,))
+        keys.append(key)
+    if missing:
+        converted = CurrencyExchangeRate.convert_many(
+            [amount for i, amount, currency in missing], [currency for i, amount, currency in missing])
+        for (i, amount, currency), key in zip(missing, converted):
+            keys[i] = key
+    return keys
+
+
+def money_sorted(values, reverse=False):
+    """Returns the values in a new list, sorted by amount in base currency"""
+    values = list(values)
+    keys = base_keys(values)
+    return [values[i] for i in sorted(range(len(values)), key=keys.__getitem__, reverse=reverse)]
+
+
+def money_max(values, default=None):
+    """Returns the value with the largest amount in base currency, or default if there are none"""
+    values = list(values)
+    if not values:
+        return default
+    keys = base_keys(values)
+    return values[max(range(len(values)), key=keys.__getitem__)]
+
+
+def money_min(values, default=None):
+    """Returns the value with the smallest amount in base currency, or default if there are none"""
+    values = list(values)
+    if not values:
+        return default
+    keys = base_keys(values)
+    return values[min(range(len(values)), key=keys.__getitem__)]
+
+
+def money_bands(values, limits, currency=None):
+    """
+    Groups the values in price bands. limits is an ascending sequence of
+    band limits in currency (by default base currency). Returns a list of
+    len(limits) + 1 lists: the values below limits[0], the values from
+    limits[0] up to but not including limits[1], and so on, the last being
+    the values from limits[-1] and up. Values keep their order within a band.
+    """
+    from .models import CurrencyExchangeRate
+    values = list(values)
+    limits = CurrencyExchangeRate.convert_many([to_decimal(limit) for limit in limits], currency)
+    bands = [[] for i in range(len(limits) + 1)]
+    for value, key in zip(values, base_keys(values)):
+        bands[bisect_right(limits, key)].append(value)
+    return bands
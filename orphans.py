@@ -0,0 +1,122 @@
+import time
+from collections import namedtuple
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Exists, Max, Min, OuterRef
+
+from .totals import apply_deltas, queryset_deltas
+from . import settings as cur_settings
+
+OrphanChunk = namedtuple('OrphanChunk', ['first_pk', 'last_pk', 'found', 'deleted'])
+
+
+def moneyamount_references():
+    """
+    Returns a list of (model, field) for every concrete relation to
+    MoneyAmount in the installed models, i.e. every MoneyAmountField and any
+    other foreign key to MoneyAmount.
+    """
+    from .models import MoneyAmount
+    references = []
+    for model in apps.get_models():
+        if model._meta.proxy:
+            continue
+        for field in model._meta.local_concrete_fields:
+            if field.is_relation and field.related_model is MoneyAmount:
+                references.append((model, field))
+    return references
+
+
+def orphan_queryset(first_pk=None, last_pk=None, using=DEFAULT_DB_ALIAS, references=None):
+    """
+    Returns a queryset of the MoneyAmount objects with pk in [first_pk,
+    last_pk] that are not referenced by any model, with one NOT EXISTS
+    anti-join per reference.
+    """
+    from .models import MoneyAmount
+    if references is None:
+        references = moneyamount_references()
+    queryset = MoneyAmount._base_manager.using(using)
+    if first_pk is not None:
+        queryset = queryset.filter(pk__gte=first_pk)
+    if last_pk is not None:
+        queryset = queryset.filter(pk__lte=last_pk)
+    for i, (model, field) in enumerate(references):
+        alias = 'referenced_%d' % i
+        referencing = model._base_manager.using(using).filter(**{field.attname: OuterRef('pk')})
+        queryset = queryset.annotate(**{alias: Exists(referencing)}).filter(**{alias: False})
+    return queryset
+
+
+def iter_orphan_chunks(chunk_size=1000, start_pk=None, end_pk=None, margin=1000, sleep=0,
+                       dry_run=False, using=DEFAULT_DB_ALIAS):
+    """
+    Finds and deletes unreferenced MoneyAmount objects, going through the
+    table in pk ranges of chunk_size. Each range is deleted in its own
+    transaction, and sleep seconds are waited between ranges, so that no
+    locks are held for long. Yields an OrphanChunk per range, whose last_pk
+    + 1 can be used as start_pk to resume an interrupted run.
+
+    The newest `margin` pks are skipped by default, since they may belong
+    to instances that are being saved. With dry_run, orphans are only
+    counted.
+
+    The deletes are raw, without signals or cascades, and still check that
+    the rows are unreferenced, so a row that has been referenced since it
+    was found is not deleted.
+    """
+    from .models import MoneyAmount
+    references = moneyamount_references()
+    bounds = MoneyAmount._base_manager.using(using).aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+    if bounds['max_pk'] is None:
+        return
+    first_pk = bounds['min_pk'] if start_pk is None else max(start_pk, bounds['min_pk'])
+    last_pk = bounds['max_pk'] - margin if end_pk is None else min(end_pk, bounds['max_pk'])
+    while first_pk <= last_pk:
+        chunk_last_pk = min(first_pk + chunk_size - 1, last_pk)
+        orphans = orphan_queryset(first_pk, chunk_last_pk, using, references)
+        deleted = 0
+        if dry_run:
+            found = orphans.count()
+        else:
+            with transaction.atomic(using=using):
+                pks = list(orphans.values_list('pk', flat=True))
+                found = len(pks)
+                if pks:
+                    try:
+                        with transaction.atomic(using=using):
+                            deleted = _delete_orphans(
+                                orphan_queryset(using=using, references=references).filter(pk__in=pks), using)
+                    except IntegrityError:
+                        # Referenced in the meantime; left for the next run
+                        deleted = 0
+        yield OrphanChunk(first_pk, chunk_last_pk, found, deleted)
+        first_pk = chunk_last_pk + 1
+        if sleep and first_pk <= last_pk:
+            time.sleep(sleep)
+
+
+def _delete_orphans(queryset, using):
+    if not cur_settings.TRACK_TOTALS:
+        return queryset._raw_delete(using)
+    # The raw delete sends no post_delete, so the totals are updated here
+    deltas = queryset_deltas(queryset)
+    deleted = queryset._raw_delete(using)
+    if deleted != -sum(delta[2] for delta in deltas.values()):
+        # Some row changed between the two queries
+        raise IntegrityError("Orphans changed while being deleted")
+    apply_deltas(deltas, using)
+    return deleted
+
+
+def delete_orphan_moneyamounts(**kwargs):
+    """
+    Runs iter_orphan_chunks() to the end. Returns a tuple of the number of
+    orphans found and deleted.
+    """
+    found = deleted = 0
+    for chunk in iter_orphan_chunks(**kwargs):
+        found += chunk.found
+        deleted += chunk.deleted
+    return found, deleted
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.db import DatabaseError
+
+from .metrics import metrics
+from .utils import acall, alist
+from . import settings as cur_settings
+
+VERSION_KEY = 'moneyamount:exchange_rates:version'
+
+
+class RateSnapshot(object):
+    """
+    Immutable set of active CurrencyExchangeRate items, keyed by upper case
+    ISO code, as loaded at one point in time.
+    """
+    __slots__ = ('items', 'version', 'expires_at')
+
+    def __init__(self, items, version=None, expires_at=None):
+        object.__setattr__(self, 'items', dict(items))
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'expires_at', expires_at)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RateSnapshot is immutable")
+
+    def __contains__(self, currency):
+        return currency in self.items
+
+    def get(self, currency, default=None):
+        return self.items.get(currency, default)
+
+
+class ExchangeRateCache(object):
+    """
+    Per-process cache of the active exchange rates.
+
+    Readers get the current RateSnapshot without locking. Every
+    CACHE_EXCHANGE_VERSION_CHECK seconds, the version stored in the Django
+    cache backend is compared to the one of the snapshot, and the rates are
+    reloaded if it has changed, or if the snapshot is older than
+    CACHE_EXCHANGE_DURATION minutes (0 = no time limit).
+    """
+    def __init__(self):
+        self._snapshot = None
+        self._check_at = 0
+        self._lock = threading.Lock()
+        # Running async reloads, keyed by event loop
+        self._flights = {}
+
+    @property
+    def _cache(self):
+        return caches[cur_settings.CACHE_EXCHANGE_BACKEND]
+
+    def _shared_version(self):
+        version = self._cache.get(VERSION_KEY)
+        if version is None:
+            self._cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = self._cache.get(VERSION_KEY)
+        return version
+
+    async def _ashared_version(self):
+        version = await acall(self._cache, 'get', VERSION_KEY)
+        if version is None:
+            await acall(self._cache, 'add', VERSION_KEY, uuid.uuid4().hex, None)
+            version = await acall(self._cache, 'get', VERSION_KEY)
+        return version
+
+    def _is_current(self, snapshot, version, now):
+        return (
+            snapshot is not None and snapshot.version == version and
+            (snapshot.expires_at is None or snapshot.expires_at > now)
+        )
+
+    def get(self):
+        """Returns the current RateSnapshot, reloading it if needed"""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now < self._check_at:
+            return snapshot
+        version = self._shared_version()
+        if self._is_current(snapshot, version, now):
+            self._check_at = now + cur_settings.CACHE_EXCHANGE_VERSION_CHECK
+            return snapshot
+        return self.reload(version)
+
+    async def aget(self):
+        """
+        Async variant of get(). Concurrent reloads in the same event loop
+        are collapsed into one, see areload().
+        """
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now < self._check_at:
+            return snapshot
+        version = await self._ashared_version()
+        if self._is_current(snapshot, version, now):
+            self._check_at = now + cur_settings.CACHE_EXCHANGE_VERSION_CHECK
+            return snapshot
+        return await self.areload(version)
+
+    def reload(self, version=None):
+        """Loads a new RateSnapshot from the database and swaps it in"""
+        from .models import CurrencyExchangeRate
+        with self._lock:
+            now = time.monotonic()
+            if version is None:
+                version = self._shared_version()
+            # Another thread may have reloaded while we waited for the lock
+            if self._is_current(self._snapshot, version, now):
+                return self._snapshot
+            with metrics.timer('rate_cache.reload'):
+                items = CurrencyExchangeRate.objects.filter(active=True)
+                snapshot = self._swap(items, version, now)
+        return snapshot
+
+    async def areload(self, version=None):
+        """
+        Async variant of reload(). Callers awaiting a reload while another
+        one is running in the same event loop share its result, so
+        concurrent misses make one query.
+        """
+        loop = asyncio.get_running_loop()
+        flight = self._flights.get(loop)
+        if flight is None:
+            flight = self._flights[loop] = loop.create_task(self._areload(version))
+            flight.add_done_callback(lambda task: self._flights.pop(loop, None))
+        # A cancelled caller must not cancel the reload of the others
+        return await asyncio.shield(flight)
+
+    async def _areload(self, version):
+        from .models import CurrencyExchangeRate
+        now = time.monotonic()
+        if version is None:
+            version = await self._ashared_version()
+        if self._is_current(self._snapshot, version, now):
+            return self._snapshot
+        with metrics.timer('rate_cache.reload'):
+            items = await alist(CurrencyExchangeRate.objects.filter(active=True))
+            return self._swap(items, version, now)
+
+    def _swap(self, items, version, now):
+        if metrics.enabled:
+            metrics.incr('rate_cache.reload')
+        expires_at = None
+        if cur_settings.CACHE_EXCHANGE_DURATION > 0:
+            expires_at = now + cur_settings.CACHE_EXCHANGE_DURATION * 60
+        snapshot = RateSnapshot({item.iso_code.upper(): item for item in items}, version, expires_at)
+        self._snapshot = snapshot
+        self._check_at = now + cur_settings.CACHE_EXCHANGE_VERSION_CHECK
+        return snapshot
+
+    def clear(self):
+        """Drops the snapshot of this process only"""
+        self._snapshot = None
+
+    def invalidate(self):
+        """Bumps the shared version, so that all processes reload their rates"""
+        self._cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+        self.clear()
+
+    def warm(self):
+        """
+        Loads the rates unless the database isn't ready yet, e.g. before
+        the initial migration.
+        """
+        try:
+            self.reload()
+        except DatabaseError:
+            pass
+
+
+rate_cache = ExchangeRateCache()
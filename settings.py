@@ -10,3 +10,25 @@ CURRENCIES = getattr(settings, "CURRENCIES", (
         ('INR', 'INR'),
     )
 )
+# Seconds between checks of the shared exchange rate version in the cache
+# backend CACHE_EXCHANGE_BACKEND. Saving a CurrencyExchangeRate bumps the
+# version, which makes every process reload its rates.
+CACHE_EXCHANGE_VERSION_CHECK = getattr(settings, "CACHE_EXCHANGE_VERSION_CHECK", 5)
+CACHE_EXCHANGE_BACKEND = getattr(settings, "CACHE_EXCHANGE_BACKEND", "default")
+# Load the exchange rates in MoneyAmountConfig.ready(), i.e. before forking
+CACHE_EXCHANGE_WARM = getattr(settings, "CACHE_EXCHANGE_WARM", False)
+# Sink for the metrics of metrics.py: 'logging', 'statsd', 'memory', the
+# dotted path of a sink class, or None to disable them
+METRICS_SINK = getattr(settings, "METRICS_SINK", None)
+METRICS_STATSD_ADDRESS = getattr(settings, "METRICS_STATSD_ADDRESS", ("localhost", 8125))
+METRICS_PREFIX = getattr(settings, "METRICS_PREFIX", "moneyamount")
+# Decimals of the minor unit of each currency, used by MinorMoneyAmountField.
+# Unlike CurrencyExchangeRate.decimal_places, which only affects formatting,
+# these must not change once amounts have been stored.
+CURRENCY_MINOR_UNITS = getattr(settings, "CURRENCY_MINOR_UNITS", {
+    'SEK': 2, 'USD': 2, 'EUR': 2, 'INR': 2, 'GBP': 2, 'NOK': 2, 'DKK': 2,
+    'JPY': 0, 'KRW': 0, 'ISK': 0, 'BHD': 3, 'KWD': 3, 'JOD': 3, 'OMR': 3, 'TND': 3,
+})
+DEFAULT_MINOR_UNITS = getattr(settings, "DEFAULT_MINOR_UNITS", 2)
+# Maintain running totals per currency in MoneyAmountTotal, see totals.py
+TRACK_TOTALS = getattr(settings, "TRACK_TOTALS", False)
@@ -1,12 +1,50 @@
-from django.db.models.signals import post_init
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
 
-from .models import MoneyAmount, CurrencyExchangeRate
+from .models import MoneyAmount, CurrencyExchangeRate, CurrencyExchangeRateHistory
+from .ratecache import rate_cache
+from .totals import add_delta, apply_deltas, row_values, stored_values
+from . import settings as cur_settings
 
 
 @receiver(post_init, sender=MoneyAmount)
 def set_base_moneyamount_values(sender, instance, **kwargs):
-    if instance.amount is not None:
-        if not instance.currency:
-            instance.currency = CurrencyExchangeRate.base_currency
-        instance.base_amount, instance.base_exchange_rate = CurrencyExchangeRate.to_base_currency(instance.amount, instance.currency)
+    # Base values are no longer calculated here, but by
+    # MoneyAmount.update_base_values() when they are needed
+    if 'currency' in instance.__dict__ and not instance.currency:
+        instance.currency = CurrencyExchangeRate.base_currency()
+
+
+def subtract_deleted_moneyamount(sender, instance, using=None, **kwargs):
+    # Connected below only if totals are tracked, so that MoneyAmounts can
+    # otherwise still be fast-deleted without fetching them
+    deltas = {}
+    add_delta(deltas, stored_values(instance) or row_values(instance), -1)
+    apply_deltas(deltas, using)
+
+
+if cur_settings.TRACK_TOTALS:
+    post_delete.connect(subtract_deleted_moneyamount, sender=MoneyAmount, dispatch_uid='moneyamount_totals_delete')
+
+
+@receiver([post_save, post_delete], sender=CurrencyExchangeRate)
+def invalidate_exchange_rates(sender, using=None, **kwargs):
+    # The local snapshot is dropped at once, the other processes are told
+    # to reload when the new rates are visible to them
+    rate_cache.clear()
+    transaction.on_commit(rate_cache.invalidate, using=using)
+
+
+@receiver(post_save, sender=CurrencyExchangeRate)
+def record_exchange_rate_history(sender, instance, raw=False, using=None, **kwargs):
+    if raw or not instance.active:
+        return
+    iso_code = instance.iso_code.upper()
+    latest_rate = CurrencyExchangeRateHistory.objects.using(using).filter(iso_code=iso_code) \
+        .order_by('-valid_from').values_list('exchange_rate', flat=True).first()
+    if latest_rate is None or latest_rate != Decimal(instance.exchange_rate):
+        CurrencyExchangeRateHistory.objects.using(using).create(
+            iso_code=iso_code, exchange_rate=instance.exchange_rate, valid_from=instance.updated)
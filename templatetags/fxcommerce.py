@@ -1,11 +1,185 @@
+from decimal import Decimal
+from numbers import Number
+
 from django import template
+from django.db.models import QuerySet
+
+from ..formatting import formatters
+from ..minor import from_minor
+from ..money import Money
+from ..ratecache import rate_cache
+from .. import settings as cur_settings
+
+MEMO_KEY = '_moneyamount_memo'
 
 register = template.Library()
 
 @register.filter
 def as_currency(amount, currency):
     """
-    amount = MoneyAmount
+    amount = MoneyAmount or Money
     currency = string
+
+    Returns a Money object.
     """
     return amount.convert_to(currency)
+
+
+def _amount_and_currency(value, currency):
+    if hasattr(value, 'amount_as'):
+        if currency:
+            return value.amount_as(currency), currency
+        return value.amount, value.currency
+    return value, currency or cur_settings.BASE_CURRENCY
+
+
+@register.filter
+def format_money(value, currency=None):
+    """
+    value = MoneyAmount, Money or number
+    currency = string, optional
+
+    Returns the formatted amount, converted to currency if given. Numbers
+    are taken to be in currency, by default the base currency.
+    """
+    return formatters.format(*_amount_and_currency(value, currency))
+
+
+@register.filter
+def format_money_many(values, currency=None):
+    """
+    values = sequence of MoneyAmount, Money or numbers
+    currency = string, optional
+
+    Returns a list of formatted amounts, like format_money.
+    """
+    pairs = [_amount_and_currency(value, currency) for value in values]
+    return formatters.format_many([amount for amount, c in pairs], [c for amount, c in pairs])
+
+
+def _memo(context):
+    """
+    Returns the memo of converted and formatted amounts shared by the tags
+    below, kept on the request if there is one in the context, or else for
+    the current render. It is emptied when the exchange rates change.
+    """
+    snapshot = rate_cache.get() if cur_settings.CACHE_EXCHANGE else None
+    request = context.get('request')
+    if request is not None:
+        memo = getattr(request, MEMO_KEY, None)
+    else:
+        memo = context.render_context.get(MEMO_KEY)
+    if memo is None or memo[0] is not snapshot:
+        memo = (snapshot, {})
+        if request is not None:
+            setattr(request, MEMO_KEY, memo)
+        else:
+            context.render_context[MEMO_KEY] = memo
+    return memo[1]
+
+
+def _source(value, currency):
+    """
+    Returns the (amount, currency) that converting value to currency starts
+    from: for MoneyAmount objects the stored base amount, as in
+    MoneyAmount.amount_as(), for other values with amount_as() and currency
+    (e.g. Money and MinorMoney) their own amount. Numbers are taken to be in
+    currency, by default the base currency, as by the format_money filter.
+    """
+    from ..models import MoneyAmount
+    if isinstance(value, MoneyAmount):
+        if currency is not None and value.currency.upper() != currency:
+            value.update_base_values()
+            return value.base_amount, value.base_currency.upper()
+        return value.amount, value.currency.upper()
+    if hasattr(value, 'amount_as') and hasattr(value, 'currency'):
+        return value.amount, value.currency.upper()
+    if isinstance(value, Number):
+        return value, currency or cur_settings.BASE_CURRENCY
+    raise template.TemplateSyntaxError("Cannot convert %r" % (value,))
+
+
+def _convert_and_format(memo, sources, currency):
+    """
+    Returns a list of (converted amount, formatted amount) for the given
+    (amount, currency) sources, converted to currency, or left in their own
+    currencies if it is None. Only results missing from the memo are
+    calculated, with one convert_many() and one format_many() per currency.
+    """
+    from ..models import CurrencyExchangeRate
+    missing = {}
+    for amount, from_currency in sources:
+        key = (amount, from_currency, currency or from_currency)
+        if key not in memo:
+            missing.setdefault(key[2], {})[key] = None
+    for to_currency, keys in missing.items():
+        keys = list(keys)
+        converted = CurrencyExchangeRate.convert_many(
+            [amount for amount, c, t in keys], [c for amount, c, t in keys], to_currency)
+        formatted = formatters.format_many(converted, to_currency)
+        memo.update(zip(keys, zip(converted, formatted)))
+    return [memo[amount, from_currency, currency or from_currency] for amount, from_currency in sources]
+
+
+@register.simple_tag(takes_context=True)
+def convert_money(context, value, currency):
+    """
+    {% convert_money price "EUR" %}
+
+    Like as_currency, but shares its results with the other tags for the
+    rest of the request (or render), so each distinct amount is converted
+    once. Returns a Money object.
+    """
+    currency = currency.upper()
+    [(amount, formatted)] = _convert_and_format(_memo(context), [_source(value, currency)], currency)
+    return Money(amount, currency)
+
+
+@register.simple_tag(takes_context=True)
+def format_money_memo(context, value, currency=None):
+    """
+    {% format_money_memo price "EUR" %}
+
+    Like the format_money filter, memoized like convert_money.
+    """
+    currency = currency.upper() if currency else None
+    [(amount, formatted)] = _convert_and_format(_memo(context), [_source(value, currency)], currency)
+    return formatted
+
+
+@register.simple_tag(takes_context=True)
+def format_money_column(context, values, currency=None, field=None):
+    """
+    {% format_money_column products "EUR" field="price" as prices %}
+
+    Converts and formats a whole list in one batch, memoized like
+    convert_money, and returns a list of formatted amounts. values is a
+    sequence of MoneyAmount, Money, MinorMoney or numbers, or of objects
+    whose attribute `field` is one. For a QuerySet and the name of a
+    MoneyAmountField, InlineMoneyAmountField or MinorMoneyAmountField, only
+    the amount columns are fetched, in one query. Empty (NULL) amounts give
+    empty strings.
+    """
+    currency = currency.upper() if currency else None
+    if isinstance(values, QuerySet) and field:
+        from ..expressions import money_column_paths
+        paths = money_column_paths(values.model, field)
+        sources = []
+        for amount, from_currency, base_amount in values.values_list(
+                paths['amount'], paths['currency'], paths['base_amount']):
+            if amount is None:
+                sources.append(None)
+                continue
+            from_currency = from_currency.upper()
+            if paths['minor']:
+                amount, base_amount = from_minor(amount, from_currency), from_minor(base_amount, cur_settings.BASE_CURRENCY)
+            if currency is not None and from_currency != currency:
+                sources.append((Decimal(base_amount), cur_settings.BASE_CURRENCY))
+            else:
+                sources.append((Decimal(amount), from_currency))
+    else:
+        if field:
+            values = [getattr(value, field) for value in values]
+        sources = [None if value is None else _source(value, currency) for value in values]
+    results = iter(_convert_and_format(_memo(context), [source for source in sources if source is not None], currency))
+    return ['' if source is None else next(results)[1] for source in sources]
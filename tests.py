@@ -1,8 +1,54 @@
+import asyncio
 from decimal import Decimal
+from datetime import date, timedelta
+import os
+import pickle
+import socket
+import tempfile
+from io import StringIO
+from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.core import serializers
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, connection, models
+from django.template import Context, Template
+from django.db.models.signals import post_delete, post_init
+from django.forms import modelform_factory, modelformset_factory
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .expressions import AmountIn, SumIn
+from .forms import MoneyAmountModelFormSet
+from .fields import InlineMoneyAmountField, MinorMoneyAmountField, MoneyAmountField, aget_moneyamount, subtract_deleted_owner
+from .managers import MoneyAmountOwnerManager
+from .ratecache import VERSION_KEY, rate_cache
+from . import settings as cur_settings
+from .history import rate_history
+from .importers import RateImportError, import_rate_file
+from .metrics import StatsdSink, metrics
+from .minor import MinorMoney, div_round
+from .models import CurrencyExchangeRate, CurrencyExchangeRateHistory, MoneyAmount, MoneyAmountTotal
+from .money import Money
+from .ordering import money_bands, money_max, money_min, money_sorted
+from .orphans import delete_orphan_moneyamounts
+from . import models as moneyamount_models
+from .signals import subtract_deleted_moneyamount
+from .totals import base_total, get_totals, rebuild_totals
+from .utils import copy_moneyamounts_inline
+
+
+class Order(models.Model):
+    price = MoneyAmountField()
+    inline_price = InlineMoneyAmountField()
+    minor_price = MinorMoneyAmountField()
+    discount = MoneyAmountField(null=True)
+    inline_discount = InlineMoneyAmountField(null=True, default=None)
+
+    objects = MoneyAmountOwnerManager()
 
-from .models import CurrencyExchangeRate
 
 class CurrencyExchangeRateTestCase(TestCase):
     def test_base_currency_is_valid(self):
@@ -60,4 +106,882 @@ class CurrencyExchangeRateTestCase(TestCase):
         usd_format = CurrencyExchangeRate.format(amount, "USD")
         sek_format = CurrencyExchangeRate.format(amount, "SEK")
         self.assertEqual(usd_format, "12,345.68")
-        self.assertEqual(sek_format, "12 345")
+        self.assertEqual(sek_format, "12 346")
+
+    def test_format_rounding(self):
+        """ Amounts should be rounded, keep leading decimal zeros and negative signs """
+        self.assertEqual(CurrencyExchangeRate.format(Decimal("1234.005"), "USD"), "1,234.01")
+        self.assertEqual(CurrencyExchangeRate.format(Decimal("-1234567.05"), "USD"), "-1,234,567.05")
+        self.assertEqual(CurrencyExchangeRate.format(Decimal("0.999"), "SEK"), "1")
+
+    def test_format_many(self):
+        amounts = [Decimal("1.5"), Decimal("1000")]
+        self.assertEqual(CurrencyExchangeRate.format_many(amounts, "USD"),
+                         [CurrencyExchangeRate.format(amount, "USD") for amount in amounts])
+        self.assertEqual(CurrencyExchangeRate.format_many(amounts, ["USD", "SEK"]),
+                         [CurrencyExchangeRate.format(amounts[0], "USD"), CurrencyExchangeRate.format(amounts[1], "SEK")])
+
+
+class InlineMoneyAmountFieldTestCase(TestCase):
+    def test_inline_columns_roundtrip(self):
+        """ Saving and reloading an inline field should keep amount, currency and base values """
+        order = Order(inline_price=MoneyAmount(amount=Decimal(10), currency="EUR"))
+        order.save()
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        price = Order.objects.get(pk=order.pk).inline_price
+        self.assertIsInstance(price, Money)
+        self.assertEqual(price.amount, Decimal(10))
+        self.assertEqual(price.currency, "EUR")
+        self.assertEqual(price.amount_as_base, (Decimal(10) * eur_rate).quantize(Decimal("0.01")))
+        # Changes have to be assigned to the order, not made on the value
+        with self.assertRaises(AttributeError):
+            price.amount = Decimal(5)
+
+    def test_unsaved_base_amount(self):
+        """ An unsaved instance should not use the defaults of the base columns """
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        order = Order(inline_price=Money(10, "EUR"))
+        self.assertEqual(order.inline_price.amount_as_base, Decimal(10) * eur_rate)
+        order.save()
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.inline_price.amount_as_base, order.inline_price_base_amount)
+
+    def test_copy_moneyamounts_inline(self):
+        """ The migration helper should copy the related values into the inline columns """
+        moneyamount = MoneyAmount(amount=Decimal(5), currency="USD")
+        moneyamount.save()
+        order = Order.objects.create(price=moneyamount)
+        self.assertEqual(copy_moneyamounts_inline(Order, "price", "inline_price", batch_size=1), 1)
+        price = Order.objects.get(pk=order.pk).inline_price
+        self.assertEqual(price.amount, Decimal(5))
+        self.assertEqual(price.currency, "USD")
+
+    def test_bulk_update(self):
+        """ bulk_update() should recalculate the base columns of inline fields """
+        order = Order.objects.create(inline_price=Money(10, "EUR"), minor_price=MinorMoney(1000, "EUR"))
+        order.inline_price = Money(100, "EUR")
+        order.minor_price = MinorMoney(10000, "EUR")
+        Order.objects.bulk_update([order], ["inline_price", "inline_price_currency", "minor_price"])
+        self.assertEqual(Order.objects.filter(inline_price__gt=500).count(), 1)
+        self.assertEqual(Order.objects.get(pk=order.pk).minor_price_base_units, 96000)
+
+
+class MoneyAmountDescriptorTestCase(TestCase):
+    def test_read_does_not_write(self):
+        """ Reading an empty field should attach an unsaved MoneyAmount without any queries """
+        order = Order()
+        with self.assertNumQueries(0):
+            price = order.price
+        self.assertIsNone(price.pk)
+        order.save()
+        self.assertIsNotNone(order.price_id)
+        self.assertEqual(Order.objects.get(pk=order.pk).price.pk, price.pk)
+
+    def test_set_replaces_old_moneyamount(self):
+        """ Assigning an amount should delete the old MoneyAmount only when the instance is saved """
+        order = Order.objects.create(price=10)
+        old_pk = order.price_id
+        order.price = 20
+        self.assertTrue(MoneyAmount.objects.filter(pk=old_pk).exists())
+        order.save()
+        self.assertFalse(MoneyAmount.objects.filter(pk=old_pk).exists())
+        self.assertEqual(Order.objects.get(pk=order.pk).price.amount, Decimal(20))
+
+    def test_bulk_create(self):
+        """ bulk_create() should save the attached MoneyAmounts with base values """
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        orders = Order.objects.bulk_create([Order(price=MoneyAmount(amount=i, currency="EUR")) for i in range(1, 4)])
+        self.assertEqual(MoneyAmount.objects.filter(currency="EUR").count(), 3)
+        for order in orders:
+            self.assertIsNotNone(order.price_id)
+            self.assertEqual(order.price.base_amount, order.price.amount * eur_rate)
+
+    def test_bulk_create_is_atomic(self):
+        """ A failing insert of the orders should not leave their MoneyAmounts behind """
+        existing = Order.objects.create()
+        count = MoneyAmount.objects.count()
+        with self.assertRaises(IntegrityError):
+            Order.objects.bulk_create([Order(price=Decimal(1)), Order(pk=existing.pk, price=Decimal(2))])
+        self.assertEqual(MoneyAmount.objects.count(), count)
+
+
+class ExchangeRateCacheTestCase(TestCase):
+    def tearDown(self):
+        rate_cache.clear()
+
+    def test_cached_lookup(self):
+        """ Lookups should not hit the database once the rates are loaded """
+        rate_cache.reload()
+        with self.assertNumQueries(0):
+            CurrencyExchangeRate.get_exchange_rate("eur")
+            CurrencyExchangeRate.get_exchange_rate("usd")
+
+    def test_snapshot_is_immutable(self):
+        snapshot = rate_cache.get()
+        with self.assertRaises(AttributeError):
+            snapshot.items = {}
+
+    def test_save_invalidates(self):
+        """ Saving an exchange rate should make the new rate visible at once """
+        CurrencyExchangeRate.get_exchange_rate("eur")
+        obj = CurrencyExchangeRate.objects.get(iso_code="EUR", active=True)
+        obj.exchange_rate = obj.exchange_rate + 1
+        obj.save()
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate("eur"), obj.exchange_rate)
+
+    def test_version_change_reloads(self):
+        """ A version bumped by another process should make the next lookup reload the rates """
+        with mock.patch.object(cur_settings, "CACHE_EXCHANGE_VERSION_CHECK", 0):
+            snapshot = rate_cache.get()
+            self.assertIs(rate_cache.get(), snapshot)
+            caches[cur_settings.CACHE_EXCHANGE_BACKEND].set(VERSION_KEY, "other")
+            self.assertIsNot(rate_cache.get(), snapshot)
+
+
+class ConvertManyTestCase(TestCase):
+    def test_convert_many_matches_convert(self):
+        """ convert_many() should give the same results as convert() """
+        amounts = [Decimal(10), 2.5, 0, Decimal("1234.56")]
+        currencies = ["eur", "USD", "SEK", "eur"]
+        expected = [CurrencyExchangeRate.convert(a, c, "usd")[0] for a, c in zip(amounts, currencies)]
+        self.assertEqual(CurrencyExchangeRate.convert_many(amounts, currencies, "usd"), expected)
+
+    def test_convert_many_single_currency(self):
+        amounts = [Decimal(1), Decimal(2)]
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        self.assertEqual(CurrencyExchangeRate.convert_many(amounts, "eur"), [eur_rate, eur_rate * 2])
+
+    def test_convert_matrix(self):
+        amounts = [Decimal(10), Decimal(20)]
+        matrix = CurrencyExchangeRate.convert_matrix(amounts, ["eur", "usd"], ["sek", "usd", "eur"])
+        for row, amount, currency in zip(matrix, amounts, ["eur", "usd"]):
+            self.assertEqual(row, [CurrencyExchangeRate.convert(amount, currency, to)[0] for to in ["sek", "usd", "eur"]])
+
+    def test_convert_many_float(self):
+        """ The float mode should be close to the exact mode """
+        amounts = [10.0, 20.5, 0.0]
+        currencies = ["eur", "usd", "inr"]
+        exact = CurrencyExchangeRate.convert_many(amounts, currencies, "usd")
+        for numpy in (moneyamount_models.numpy, None):
+            with mock.patch.object(moneyamount_models, "numpy", numpy):
+                fast = CurrencyExchangeRate.convert_many(amounts, currencies, "usd", exact=False)
+            for exact_amount, fast_amount in zip(exact, fast):
+                self.assertAlmostEqual(float(exact_amount), fast_amount, places=6)
+
+
+class ConversionExpressionTestCase(TestCase):
+    def setUp(self):
+        Order.objects.create(price=MoneyAmount(amount=Decimal(10), currency="EUR"),
+                             inline_price=MoneyAmount(amount=Decimal(10), currency="EUR"))
+        Order.objects.create(price=MoneyAmount(amount=Decimal(100), currency="USD"),
+                             inline_price=MoneyAmount(amount=Decimal(100), currency="USD"))
+        Order.objects.create(price=MoneyAmount(amount=Decimal(50), currency="SEK"),
+                             inline_price=MoneyAmount(amount=Decimal(50), currency="SEK"))
+
+    def expected_total(self, currency):
+        return sum(order.price.amount_as(currency) for order in Order.objects.all())
+
+    def test_sum_in(self):
+        """ SumIn should sum the converted amounts in the database """
+        for field in ("price", "inline_price"):
+            for current in (False, True):
+                total = Order.objects.aggregate(total=SumIn(field, "EUR", current=current))["total"]
+                self.assertAlmostEqual(float(total), float(self.expected_total("EUR")), places=2)
+
+    def test_total_in(self):
+        self.assertAlmostEqual(float(Order.objects.total_in("price", "USD")), float(self.expected_total("USD")), places=2)
+
+    def test_sum_in_minor(self):
+        """ Amounts in minor units should be scaled to amounts """
+        for order in Order.objects.all():
+            order.minor_price = order.inline_price
+            order.save()
+        for current in (False, True):
+            total = Order.objects.aggregate(total=SumIn("minor_price", "EUR", current=current))["total"]
+            self.assertAlmostEqual(float(total), float(self.expected_total("EUR")), places=2)
+
+    def test_current_unknown_currency(self):
+        """ With current=True, lower case currencies should match and inactive ones use base_amount """
+        Order.objects.all().delete()
+        order = Order.objects.create(price=MoneyAmount(amount=Decimal(10), currency="eur"))
+        self.assertAlmostEqual(float(Order.objects.total_in("price", "SEK", current=True)), 96.0, places=2)
+        MoneyAmount.objects.filter(pk=order.price_id).update(currency="GBP")
+        self.assertAlmostEqual(float(Order.objects.total_in("price", "SEK", current=True)), 96.0, places=2)
+
+    def test_order_by_amount_in(self):
+        """ Ordering by AmountIn should order by the converted amount """
+        orders = Order.objects.order_by(AmountIn("price", "USD").desc())
+        amounts = [order.price.amount_as("USD") for order in orders]
+        self.assertEqual(amounts, sorted(amounts, reverse=True))
+
+
+class BaseAmountLookupTestCase(TestCase):
+    def setUp(self):
+        for amount, currency in ((10, "EUR"), (100, "USD"), (50, "SEK")):
+            Order.objects.create(price=MoneyAmount(amount=Decimal(amount), currency=currency),
+                                 inline_price=MoneyAmount(amount=Decimal(amount), currency=currency))
+
+    def expected(self, compare):
+        return sorted(order.pk for order in Order.objects.all() if compare(order.price.amount_as_base))
+
+    def test_gt(self):
+        """ Filtering with a MoneyAmount should compare the amounts in base currency """
+        limit = MoneyAmount(amount=Decimal(10), currency="USD")
+        for field in ("price", "inline_price"):
+            pks = sorted(Order.objects.filter(**{field + "__gt": limit}).values_list("pk", flat=True))
+            self.assertEqual(pks, self.expected(lambda base_amount: base_amount > limit.amount_as_base))
+
+    def test_range(self):
+        """ Range lookups should accept (amount, currency) pairs """
+        low, high = (Decimal(5), "EUR"), (Decimal(200), "USD")
+        low_base = CurrencyExchangeRate.to_base_currency(*low)[0]
+        high_base = CurrencyExchangeRate.to_base_currency(*high)[0]
+        for field in ("price", "inline_price"):
+            pks = sorted(Order.objects.filter(**{field + "__range": (low, high)}).values_list("pk", flat=True))
+            self.assertEqual(pks, self.expected(lambda base_amount: low_base <= base_amount <= high_base))
+
+    def test_lte_base_amount(self):
+        """ Plain numbers should be taken as amounts in base currency """
+        pks = sorted(Order.objects.filter(price__lte=50).values_list("pk", flat=True))
+        self.assertEqual(pks, self.expected(lambda base_amount: base_amount <= 50))
+
+    def test_inline_exact_currency(self):
+        """ An exact lookup with a money value should match the currency as well """
+        self.assertEqual(Order.objects.filter(inline_price=Money(10, "EUR")).count(), 1)
+        self.assertEqual(Order.objects.filter(inline_price=Money(10, "USD")).count(), 0)
+        self.assertEqual(Order.objects.filter(inline_price=MoneyAmount(amount=Decimal(100), currency="usd")).count(), 1)
+        self.assertEqual(Order.objects.filter(inline_price=50).count(), 1)
+
+
+class MoneyTestCase(TestCase):
+    def test_immutable(self):
+        money = Money(10, "eur")
+        with self.assertRaises(AttributeError):
+            money.amount = 5
+        self.assertEqual(money.currency, "EUR")
+
+    def test_float_amount(self):
+        """ Floats should be converted through their string representation """
+        self.assertEqual(Money(0.1).amount, Decimal("0.1"))
+
+    def test_arithmetic(self):
+        """ Arithmetic should give Money in the currency of the left operand """
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        result = Money(10, "SEK") + Money(1, "EUR")
+        self.assertIsInstance(result, Money)
+        self.assertEqual(result, Money(10 + eur_rate, "SEK"))
+        self.assertEqual(Money(10, "EUR") - 4, Money(6, "EUR"))
+        self.assertEqual(3 * Money(2, "USD"), Money(6, "USD"))
+
+    def test_sum_moneyamounts(self):
+        """ Summing MoneyAmounts should give Money without creating model instances """
+        moneyamounts = [MoneyAmount(amount=Decimal(i), currency="SEK") for i in range(1, 11)]
+        created = []
+        receiver = lambda sender, **kwargs: created.append(kwargs["instance"])
+        post_init.connect(receiver, sender=MoneyAmount)
+        try:
+            total = sum(moneyamounts)
+        finally:
+            post_init.disconnect(receiver, sender=MoneyAmount)
+        self.assertEqual(total, Money(55, "SEK"))
+        self.assertEqual(created, [])
+
+    def test_ordering_and_hash(self):
+        """ Money should be ordered and hashed by its amount in base currency """
+        eur_rate = CurrencyExchangeRate.get_exchange_rate("eur")
+        one_eur_in_sek = Money(eur_rate, "SEK")
+        self.assertEqual(Money(1, "EUR"), one_eur_in_sek)
+        self.assertEqual(hash(Money(1, "EUR")), hash(one_eur_in_sek))
+        self.assertEqual(sorted([Money(2, "EUR"), Money(1, "SEK"), Money(1, "EUR")]),
+                         [Money(1, "SEK"), Money(1, "EUR"), Money(2, "EUR")])
+
+    def test_stored_base_amount_equality(self):
+        """ Equality should agree with the hash when a base amount is stored """
+        stored = Money(10, "EUR", base_amount=90)
+        self.assertNotEqual(stored, Money(10, "EUR"))
+        self.assertLess(stored, Money(10, "EUR"))
+        self.assertEqual(stored, Money(90, "SEK"))
+        self.assertEqual(hash(stored), hash(Money(90, "SEK")))
+        self.assertEqual(pickle.loads(pickle.dumps(stored)), stored)
+
+    def test_convert_to(self):
+        moneyamount = MoneyAmount(amount=Decimal(10), currency="EUR")
+        money = moneyamount.convert_to("usd")
+        self.assertIsInstance(money, Money)
+        self.assertEqual(money.amount, moneyamount.amount_as("USD"))
+
+
+class BaseValuesTestCase(TestCase):
+    def tearDown(self):
+        rate_cache.clear()
+
+    def change_eur_rate(self):
+        obj = CurrencyExchangeRate.objects.get(iso_code="EUR", active=True)
+        obj.exchange_rate = obj.exchange_rate * 2
+        obj.save()
+        return obj.exchange_rate
+
+    def test_loaded_values_are_kept(self):
+        """ Loading a MoneyAmount should keep its stored base values without any conversion """
+        moneyamount = MoneyAmount(amount=Decimal(10), currency="EUR")
+        moneyamount.save()
+        base_amount = moneyamount.base_amount
+        self.change_eur_rate()
+        with self.assertNumQueries(1):
+            loaded = MoneyAmount.objects.get(pk=moneyamount.pk)
+            self.assertEqual(loaded.amount_as_base, base_amount)
+        loaded.save()
+        self.assertEqual(MoneyAmount.objects.get(pk=moneyamount.pk).base_amount, base_amount)
+
+    def test_changed_values_are_recalculated(self):
+        """ Changing the amount should recalculate the base values with the current rate """
+        moneyamount = MoneyAmount(amount=Decimal(10), currency="EUR")
+        moneyamount.save()
+        new_rate = self.change_eur_rate()
+        loaded = MoneyAmount.objects.get(pk=moneyamount.pk)
+        loaded.amount = Decimal(20)
+        self.assertEqual(loaded.amount_as_base, Decimal(20) * new_rate)
+        loaded.save()
+        self.assertEqual(MoneyAmount.objects.get(pk=moneyamount.pk).base_exchange_rate, new_rate)
+
+    def test_inline_loaded_values_are_kept(self):
+        order = Order.objects.create(inline_price=MoneyAmount(amount=Decimal(10), currency="EUR"))
+        base_amount = order.inline_price_base_amount
+        new_rate = self.change_eur_rate()
+        loaded = Order.objects.get(pk=order.pk)
+        loaded.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).inline_price.amount_as_base, base_amount)
+        loaded.inline_price = Money(20, "EUR")
+        loaded.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).inline_price_base_amount, Decimal(20) * new_rate)
+
+
+class TemplateFilterTestCase(TestCase):
+    def test_format_money(self):
+        template = Template('{% load fxcommerce %}{{ price|format_money }}|{{ price|format_money:"USD" }}|'
+                            '{{ prices|format_money_many|join:";" }}')
+        price = Money(Decimal("1234.5"), "USD")
+        rendered = template.render(Context({"price": price, "prices": [price, Money(10, "SEK")]}))
+        usd = CurrencyExchangeRate.format(Decimal("1234.5"), "USD")
+        self.assertEqual(rendered, "%s|%s|%s;%s" % (usd, usd, usd, CurrencyExchangeRate.format(10, "SEK")))
+
+
+class MemoizedTemplateTagTestCase(TestCase):
+    def test_memo(self):
+        """ Each distinct amount should only be converted once per render """
+        template = Template('{% load fxcommerce %}{% for price in prices %}{% format_money_memo price "EUR" %};'
+                            '{% endfor %}{% convert_money prices.0 "usd" as converted %}{{ converted.currency }}')
+        prices = [Money(10, "USD"), Money(10, "USD"), Money(20, "SEK")]
+        with mock.patch.object(CurrencyExchangeRate, "convert_many", wraps=CurrencyExchangeRate.convert_many) as convert:
+            rendered = template.render(Context({"prices": prices}))
+        # The second 10 USD to EUR comes from the memo
+        self.assertEqual(convert.call_count, 3)
+        eur = [CurrencyExchangeRate.format(price.amount_as("EUR"), "EUR") for price in prices]
+        self.assertEqual(rendered, "%s;%s;%s;USD" % tuple(eur))
+
+    def test_memo_number(self):
+        """ Numbers should be taken to be in the given currency, as by the format_money filter """
+        template = Template('{% load fxcommerce %}{% format_money_memo 10 "EUR" %}|{{ 10|format_money:"EUR" }}|'
+                            '{% format_money_memo 10 %}')
+        rendered = template.render(Context({}))
+        eur, sek = CurrencyExchangeRate.format(10, "EUR"), CurrencyExchangeRate.format(10, "SEK")
+        self.assertEqual(rendered, "%s|%s|%s" % (eur, eur, sek))
+
+    def test_column(self):
+        """ A queryset column should be converted and formatted with one query """
+        for amount in (1, 2, 3):
+            Order.objects.create(price=MoneyAmount(amount=Decimal(amount), currency="USD"), inline_price=Decimal(amount))
+        template = Template('{% load fxcommerce %}{% format_money_column orders "EUR" field="price" as prices %}'
+                            '{% format_money_column orders "EUR" field="inline_price" as inline %}'
+                            '{{ prices|join:";" }}|{{ inline|join:";" }}')
+        with self.assertNumQueries(2):
+            rendered = template.render(Context({"orders": Order.objects.order_by("pk")}))
+        orders = Order.objects.order_by("pk")
+        expected = [";".join(CurrencyExchangeRate.format(getattr(order, field).amount_as("EUR"), "EUR") for order in orders)
+                    for field in ("price", "inline_price")]
+        self.assertEqual(rendered, "|".join(expected))
+
+    def test_column_null_and_minor(self):
+        """ NULL amounts should give empty strings, minor units and MinorMoney should be converted """
+        Order.objects.create(minor_price=MinorMoney(1000, "EUR"))
+        Order.objects.create(minor_price=MinorMoney(500, "SEK"), discount=Money(2, "USD"), inline_discount=Money(3, "EUR"))
+        template = Template('{% load fxcommerce %}'
+                            '{% format_money_column orders "SEK" field="discount" as discounts %}'
+                            '{% format_money_column orders "SEK" field="inline_discount" as inline %}'
+                            '{% format_money_column orders "SEK" field="minor_price" as minor %}'
+                            '{% format_money_column prices "SEK" as listed %}'
+                            '{{ discounts|join:";" }}|{{ inline|join:";" }}|{{ minor|join:";" }}|{{ listed|join:";" }}')
+        context = Context({"orders": Order.objects.order_by("pk"), "prices": [MinorMoney(1000, "EUR"), None]})
+        sek = [CurrencyExchangeRate.format(amount, "SEK") for amount in (Decimal(17), Decimal("28.8"), 96, 5)]
+        self.assertEqual(template.render(context), ";%s|;%s|%s;%s|%s;" % (sek[0], sek[1], sek[2], sek[3], sek[2]))
+
+
+class MoneyAmountFormSetTestCase(TestCase):
+    def setUp(self):
+        for amount in range(1, 6):
+            Order.objects.create(price=MoneyAmount(amount=Decimal(amount), currency="EUR"))
+        self.FormSet = modelformset_factory(Order, fields=["price"], formset=MoneyAmountModelFormSet, extra=0)
+
+    def post_data(self, formset, amount):
+        data = {"form-TOTAL_FORMS": str(len(formset.forms)), "form-INITIAL_FORMS": str(len(formset.forms))}
+        for i, form in enumerate(formset.forms):
+            data["form-%d-id" % i] = str(form.instance.pk)
+            data["form-%d-price_0" % i] = str(form.instance.price_id)
+            data["form-%d-price_1" % i] = str(amount)
+            data["form-%d-price_2" % i] = "USD"
+        return data
+
+    def test_render_queries(self):
+        """ Rendering a formset should load all MoneyAmounts with one query """
+        with self.assertNumQueries(2):
+            formset = self.FormSet(queryset=Order.objects.order_by("pk"))
+            formset.as_p()
+
+    def test_clean_queries(self):
+        """ Validating a formset should check that the MoneyAmounts exist and are unique without a query per form """
+        formset = self.FormSet(queryset=Order.objects.order_by("pk"))
+        data = self.post_data(formset, 7)
+        # The orders, their MoneyAmounts, one id lookup per form and the uniqueness check
+        with self.assertNumQueries(len(formset.forms) + 3):
+            formset = self.FormSet(data, queryset=Order.objects.order_by("pk"))
+            self.assertTrue(formset.is_valid())
+
+    def test_moneyamount_of_other_row(self):
+        """ A MoneyAmount belonging to a row outside the formset should be rejected """
+        other = Order.objects.create(price=1)
+        queryset = Order.objects.exclude(pk=other.pk).order_by("pk")
+        data = self.post_data(self.FormSet(queryset=queryset), 7)
+        data["form-0-price_0"] = str(other.price_id)
+        formset = self.FormSet(data, queryset=queryset)
+        self.assertFalse(formset.is_valid())
+        self.assertIn("price", formset.forms[0].errors)
+
+    def test_save(self):
+        """ Saving a formset should update all changed MoneyAmounts with one query """
+        formset = self.FormSet(queryset=Order.objects.order_by("pk"))
+        formset = self.FormSet(self.post_data(formset, 7), queryset=Order.objects.order_by("pk"))
+        self.assertTrue(formset.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            formset.save()
+        moneyamount_updates = [q for q in queries if q["sql"].startswith('UPDATE "%s"' % MoneyAmount._meta.db_table)]
+        self.assertEqual(len(moneyamount_updates), 1)
+        usd_rate = CurrencyExchangeRate.get_exchange_rate("usd")
+        for order in Order.objects.all():
+            self.assertEqual(order.price.amount, Decimal(7))
+            self.assertEqual(order.price.currency, "USD")
+            self.assertEqual(order.price.base_amount, Decimal(7) * usd_rate)
+
+    def test_save_new_and_deleted(self):
+        """ New MoneyAmounts should be inserted once, and those of deleted forms not saved """
+        FormSet = modelformset_factory(Order, fields=["price"], formset=MoneyAmountModelFormSet, extra=1, can_delete=True)
+        queryset = Order.objects.order_by("pk")
+        formset = FormSet(queryset=queryset)
+        data = self.post_data(formset, 7)
+        data["form-TOTAL_FORMS"] = str(len(formset.forms))
+        data["form-INITIAL_FORMS"] = str(len(formset.forms) - 1)
+        data["form-5-id"] = data["form-5-price_0"] = ""
+        data["form-0-DELETE"] = "on"
+        deleted_price_id = formset.forms[0].instance.price_id
+        formset = FormSet(data, queryset=queryset)
+        self.assertTrue(formset.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            formset.save()
+        moneyamount_writes = [q for q in queries if q["sql"].startswith(
+            ('UPDATE "%s"' % MoneyAmount._meta.db_table, 'INSERT INTO "%s"' % MoneyAmount._meta.db_table))]
+        self.assertEqual(len(moneyamount_writes), 2)
+        self.assertEqual(MoneyAmount.objects.get(pk=deleted_price_id).currency, "EUR")
+        self.assertEqual(Order.objects.filter(price__currency="USD").count(), 5)
+
+    def test_save_commit_false(self):
+        """ Nothing should be written before save_m2m() when saving with commit=False """
+        formset = self.FormSet(queryset=Order.objects.order_by("pk"))
+        formset = self.FormSet(self.post_data(formset, 7), queryset=Order.objects.order_by("pk"))
+        self.assertTrue(formset.is_valid())
+        with self.assertNumQueries(0):
+            orders = formset.save(commit=False)
+        self.assertEqual(MoneyAmount.objects.filter(currency="USD").count(), 0)
+        for order in orders:
+            order.save()
+        formset.save_m2m()
+        self.assertEqual(Order.objects.filter(price__currency="USD").count(), 5)
+
+
+class OrphanMoneyAmountTestCase(TestCase):
+    def setUp(self):
+        self.orders = [Order.objects.create(price=i) for i in range(1, 4)]
+        self.orphans = [MoneyAmount.objects.create(amount=i) for i in range(1, 6)]
+
+    def test_dry_run(self):
+        self.assertEqual(delete_orphan_moneyamounts(margin=0, dry_run=True), (5, 0))
+        self.assertEqual(MoneyAmount.objects.count(), 8)
+
+    def test_delete(self):
+        """ Only unreferenced MoneyAmounts should be deleted """
+        self.assertEqual(delete_orphan_moneyamounts(margin=0, chunk_size=2), (5, 5))
+        self.assertEqual(sorted(MoneyAmount.objects.values_list("pk", flat=True)),
+                         sorted(order.price_id for order in self.orders))
+
+    def test_command_resume(self):
+        """ The command should only process pks from --start-pk """
+        out = StringIO()
+        call_command("delete_orphan_moneyamounts", margin=0, start_pk=self.orphans[2].pk, stdout=out)
+        self.assertIn("3 orphaned MoneyAmounts found, 3 deleted", out.getvalue())
+        self.assertTrue(MoneyAmount.objects.filter(pk=self.orphans[1].pk).exists())
+
+
+class ExchangeRateHistoryTestCase(TestCase):
+    def setUp(self):
+        CurrencyExchangeRateHistory.objects.all().delete()
+        self.now = timezone.now()
+        for days, eur_rate, usd_rate in ((30, "10.0000", "8.0000"), (20, "11.0000", "9.0000"), (10, "12.0000", "10.0000")):
+            valid_from = self.now - timedelta(days=days)
+            CurrencyExchangeRateHistory.objects.create(iso_code="EUR", exchange_rate=Decimal(eur_rate), valid_from=valid_from)
+            CurrencyExchangeRateHistory.objects.create(iso_code="USD", exchange_rate=Decimal(usd_rate), valid_from=valid_from)
+        rate_history.clear()
+
+    def tearDown(self):
+        rate_history.clear()
+        rate_cache.clear()
+
+    def test_get_exchange_rate_at(self):
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate_at("eur", self.now - timedelta(days=25)), Decimal(10))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate_at("eur", self.now - timedelta(days=20)), Decimal(11))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate_at("eur", self.now), Decimal(12))
+        with self.assertRaises(LookupError):
+            CurrencyExchangeRate.get_exchange_rate_at("eur", self.now - timedelta(days=40))
+
+    def test_convert_at(self):
+        """ convert_at() should use the rates valid at each timestamp, loaded with one query """
+        timestamps = [self.now - timedelta(days=25), self.now - timedelta(days=15), (self.now - timedelta(days=5)).date()]
+        rate_cache.get()
+        with self.assertNumQueries(1):
+            result = CurrencyExchangeRate.convert_at([Decimal(10)] * 3, "eur", timestamps, "usd")
+        self.assertEqual(result, [Decimal(10) * Decimal(10) / Decimal(8), Decimal(10) * Decimal(11) / Decimal(9),
+                                  Decimal(10) * Decimal(12) / Decimal(10)])
+        self.assertEqual(CurrencyExchangeRate.convert_at([Decimal(10)], ["sek"], [self.now]), [Decimal(10)])
+
+    def test_fallback_to_current(self):
+        early = self.now - timedelta(days=40)
+        result = CurrencyExchangeRate.convert_at([Decimal(1)], "eur", [early], fallback_to_current=True)
+        self.assertEqual(result, [CurrencyExchangeRate.get_exchange_rate("eur")])
+
+    def test_save_records_history(self):
+        """ Saving an active rate with a new value should add a history entry """
+        obj = CurrencyExchangeRate.objects.get(iso_code="EUR", active=True)
+        obj.exchange_rate = Decimal("13.0000")
+        obj.save()
+        obj.save()
+        self.assertEqual(CurrencyExchangeRateHistory.objects.filter(iso_code="EUR").count(), 4)
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate_at("eur", timezone.now()), Decimal(13))
+
+
+ECB_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<gesmes:Envelope xmlns:gesmes="http://www.gesmes.org/xml/2002-08-01" xmlns="http://www.ecb.int/vocabulary/2002-08-01/eurofxref">
+  <Cube>
+    <Cube time="2020-01-03"><Cube currency="USD" rate="1.2"/><Cube currency="SEK" rate="10.8"/><Cube currency="GBP" rate="0.9"/></Cube>
+    <Cube time="2020-01-02"><Cube currency="USD" rate="1.1"/><Cube currency="SEK" rate="11.0"/><Cube currency="GBP" rate="0.8"/></Cube>
+  </Cube>
+</gesmes:Envelope>
+"""
+
+
+class RateImportTestCase(TestCase):
+    def setUp(self):
+        CurrencyExchangeRateHistory.objects.all().delete()
+
+    def tearDown(self):
+        rate_cache.clear()
+        rate_history.clear()
+
+    def write(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_xml(self):
+        """ Rates should be converted to base currency, the latest day becoming the current rate """
+        path = self.write('.xml', ECB_XML)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            result = import_rate_file(path)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(tuple(result), (1, 2, 6))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate("usd"), Decimal("9.0000"))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate("eur"), Decimal("10.8000"))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate("gbp"), Decimal("12.0000"))
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate_at("usd", date(2020, 1, 2)), Decimal("10.0000"))
+        # Importing again should not duplicate the history
+        self.assertEqual(tuple(import_rate_file(path)), (0, 3, 0))
+
+    def test_import_csv(self):
+        path = self.write('.csv', "Date,USD,SEK,XYZ,\n2020-01-02,1.1,11.0,N/A,\n")
+        import_rate_file(path, currencies=["usd"])
+        self.assertEqual(CurrencyExchangeRate.get_exchange_rate("usd"), Decimal("10.0000"))
+        self.assertEqual(CurrencyExchangeRateHistory.objects.get().iso_code, "USD")
+
+    def test_invalid_file(self):
+        """ An invalid row should abort the import before anything is written """
+        path = self.write('.csv', "Date,USD,SEK\n2020-01-02,1.1,11.0\n2020-01-03,-1,11.0\n")
+        with self.assertRaises(RateImportError):
+            import_rate_file(path)
+        self.assertFalse(CurrencyExchangeRateHistory.objects.exists())
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.configure('memory')
+        rate_cache.clear()
+
+    def tearDown(self):
+        metrics.configure(cur_settings.METRICS_SINK)
+        rate_cache.clear()
+
+    def test_counters(self):
+        CurrencyExchangeRate.convert(Decimal(10), "usd", "eur")
+        CurrencyExchangeRate.convert_many([Decimal(1), Decimal(2)], "usd", "eur")
+        order = Order()
+        order.price.amount = Decimal(5)
+        order.save()
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['convert.USD.EUR'], 3)
+        self.assertEqual(counters['rate_cache.reload'], 1)
+        self.assertEqual(counters['descriptor.create'], 1)
+        self.assertNotIn('rate_cache.miss', counters)
+        self.assertEqual(metrics.snapshot()['timings']['base_values.update']['count'], 1)
+
+    def test_disabled(self):
+        metrics.configure(None)
+        CurrencyExchangeRate.convert(Decimal(10), "usd", "eur")
+        self.assertFalse(metrics.enabled)
+        self.assertIsNone(metrics.snapshot())
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(1)
+        self.addCleanup(server.close)
+        metrics.configure(StatsdSink(server.getsockname(), prefix="shop"))
+        metrics.incr("rate_cache.hit", 2)
+        self.assertEqual(server.recv(512), b"shop.rate_cache.hit:2|c")
+
+
+class AsyncTestCase(TestCase):
+    def setUp(self):
+        rate_cache.clear()
+
+    def tearDown(self):
+        metrics.configure(cur_settings.METRICS_SINK)
+        rate_cache.clear()
+
+    async def test_aconvert(self):
+        self.assertEqual(await CurrencyExchangeRate.aconvert(Decimal(10), "usd", "eur"),
+                         CurrencyExchangeRate.convert(Decimal(10), "usd", "eur"))
+        self.assertEqual(await CurrencyExchangeRate.aget_exchange_rate("usd"), Decimal("8.5"))
+
+    async def test_single_flight(self):
+        """ Concurrent misses should reload the rates once """
+        metrics.configure('memory')
+        items = await asyncio.gather(*[CurrencyExchangeRate.aget_exchange_rate_item("usd") for i in range(5)])
+        self.assertEqual(len(set(item.pk for item in items)), 1)
+        self.assertEqual(metrics.snapshot()['counters']['rate_cache.reload'], 1)
+
+    async def test_asave_and_descriptor(self):
+        moneyamount = MoneyAmount(amount=Decimal(10), currency="USD")
+        await moneyamount.asave()
+        self.assertEqual(moneyamount.base_amount, Decimal(85))
+        order = Order(price=moneyamount, inline_price=Decimal(1))
+        await order.price.asave()
+        await sync_to_async(order.save)()
+        order = await sync_to_async(Order.objects.get)(pk=order.pk)
+        self.assertEqual((await aget_moneyamount(order, "price")).amount, Decimal(10))
+
+
+class MinorMoneyTestCase(TestCase):
+    def test_arithmetic(self):
+        a = MinorMoney.from_amount(Decimal("12.50"), "usd")
+        self.assertEqual(a.units, 1250)
+        self.assertEqual((a + MinorMoney(250, "USD")).units, 1500)
+        self.assertEqual((a * 3).units, 3750)
+        self.assertEqual((a / 3).units, 417)
+        self.assertEqual(a - 2, MinorMoney(1050, "USD"))
+        self.assertEqual(a.amount, Decimal("12.50"))
+        self.assertEqual(div_round(-5, 2), -3)
+
+    def test_conversion(self):
+        """ Conversions should use fixed-point rates and round half away from zero """
+        usd = MinorMoney(1001, "USD")
+        self.assertEqual(usd.base_units, 8509)
+        self.assertEqual(usd.convert_to("EUR").units, 886)
+        self.assertEqual(usd.amount_as("SEK"), Decimal("85.09"))
+        self.assertEqual(MinorMoney(8509, "SEK"), usd)
+        self.assertLess(MinorMoney(100, "SEK"), usd)
+        self.assertEqual(hash(MinorMoney(8509, "SEK")), hash(usd))
+        self.assertEqual(hash(MinorMoney(1000, "SEK")), hash(Money(10, "SEK")))
+        self.assertEqual(hash(MinorMoney(1000, "SEK")), hash(10))
+
+    def test_field(self):
+        order = Order(minor_price=MinorMoney(1001, "USD"))
+        order.save()
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.minor_price, MinorMoney(1001, "USD"))
+        self.assertEqual(order.minor_price_base_units, 8509)
+        order.minor_price = Decimal("2.5")
+        self.assertEqual(order.minor_price.units, 250)
+        order.save()
+        self.assertEqual(Order.objects.filter(minor_price_base_units=2125).count(), 1)
+        # Integers are amounts, as in MinorMoney arithmetic, the raw units are at minor_price_units
+        order.minor_price = 5
+        self.assertEqual(order.minor_price, MinorMoney(0, "USD") + 5)
+        self.assertEqual(order.minor_price_units, 500)
+        self.assertEqual(Order.objects.only("pk").get(pk=order.pk).minor_price, MinorMoney(250, "USD"))
+
+    def test_lookups(self):
+        """ Lookups should compare the amounts in base currency """
+        Order.objects.create(minor_price=MinorMoney(1000, "EUR"))
+        self.assertEqual(Order.objects.filter(minor_price__gt=MinorMoney(5000, "SEK")).count(), 1)
+        self.assertEqual(Order.objects.filter(minor_price__lte=Money(10, "EUR")).count(), 1)
+        self.assertEqual(Order.objects.filter(minor_price__range=(50, 95)).count(), 0)
+
+    def test_form(self):
+        """ Forms should show and take amounts, not minor units """
+        order = Order.objects.create(minor_price=MinorMoney(1250, "EUR"))
+        Form = modelform_factory(Order, fields=["minor_price_currency", "minor_price"])
+        self.assertIn('value="12.50"', str(Form(instance=order)["minor_price"]))
+        self.assertFalse(Form({"minor_price_currency": "EUR", "minor_price": "12.50"}, instance=order).has_changed())
+        form = Form({"minor_price_currency": "USD", "minor_price": "3.10"}, instance=order)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).minor_price, MinorMoney(310, "USD"))
+
+    def test_serialization_roundtrip(self):
+        """ Serializing and deserializing should keep the minor units """
+        order = Order.objects.create(minor_price=MinorMoney(1234, "EUR"))
+        data = serializers.serialize("json", [order])
+        obj = next(serializers.deserialize("json", data)).object
+        self.assertEqual(obj.minor_price_units, 1234)
+        self.assertEqual(obj.minor_price.currency, "EUR")
+        obj.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).minor_price_units, 1234)
+
+
+class MoneyAmountTotalTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cur_settings, "TRACK_TOTALS", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        post_delete.connect(subtract_deleted_moneyamount, sender=MoneyAmount, dispatch_uid="moneyamount_totals_delete")
+        self.addCleanup(post_delete.disconnect, sender=MoneyAmount, dispatch_uid="moneyamount_totals_delete")
+        MoneyAmount.objects.all().delete()
+
+    def assertTotals(self, expected):
+        totals = get_totals()
+        self.assertEqual({currency: (total.amount, total.count) for currency, total in totals.items()}, expected)
+        self.assertEqual(rebuild_totals(chunk_size=2, dry_run=True), [])
+
+    def test_save_and_delete(self):
+        order = Order.objects.create(price=MoneyAmount(amount=Decimal(10), currency="USD"))
+        MoneyAmount.objects.create(amount=Decimal(5), currency="USD")
+        self.assertTotals({"USD": (Decimal(15), 2)})
+        order.price.amount = Decimal(20)
+        order.price.currency = "EUR"
+        order.price.save()
+        # The totals of the field follow when the order is saved
+        order.save()
+        self.assertTotals({"USD": (Decimal(5), 1), "EUR": (Decimal(20), 1)})
+        # Replaced by assignment, and deleted on save
+        order.price = Decimal(3)
+        order.save()
+        self.assertTotals({"USD": (Decimal(5), 1), "SEK": (Decimal(3), 1)})
+        self.assertEqual(base_total(), Decimal("42.50") + Decimal(3))
+
+    def test_bulk_and_orphans(self):
+        Order.objects.bulk_create([Order(price=Decimal(i)) for i in (1, 2, 3)])
+        self.assertTotals({"SEK": (Decimal(6), 3)})
+        orders = list(Order.objects.all())
+        for order in orders:
+            order.price = Money(1, "EUR")
+        Order.objects.bulk_update(orders, ["price"])
+        self.assertTotals({"EUR": (Decimal(3), 3)})
+        MoneyAmount.objects.create(amount=Decimal(7), currency="EUR")
+        delete_orphan_moneyamounts(margin=0)
+        self.assertTotals({"EUR": (Decimal(3), 3)})
+
+    def test_owner_totals(self):
+        """ The MoneyAmounts of each field should be totalled, and subtracted when the owner is deleted """
+        post_delete.connect(subtract_deleted_owner, sender=Order, dispatch_uid="moneyamount_totals_delete_owner")
+        self.addCleanup(post_delete.disconnect, sender=Order, dispatch_uid="moneyamount_totals_delete_owner")
+        price = Order._meta.get_field("price")
+
+        def owner_totals():
+            self.assertEqual(rebuild_totals(chunk_size=2, dry_run=True), [])
+            return {currency: (total.amount, total.count) for currency, total in get_totals(field=price).items()}
+
+        orders = [Order.objects.create(price=Money(i, "USD")) for i in (1, 2)]
+        MoneyAmount.objects.create(amount=Decimal(5), currency="USD")
+        self.assertEqual(owner_totals(), {"USD": (Decimal(3), 2)})
+        self.assertEqual(get_totals(field=Order._meta.get_field("discount")), {})
+        order = Order.objects.get(pk=orders[0].pk)
+        order.price.currency = "EUR"
+        order.price.save()
+        order.save()
+        self.assertEqual(owner_totals(), {"USD": (Decimal(2), 1), "EUR": (Decimal(1), 1)})
+        order = Order.objects.get(pk=orders[1].pk)
+        order.price = Money(4, "EUR")
+        order.save()
+        self.assertEqual(owner_totals(), {"EUR": (Decimal(5), 2)})
+        Order.objects.filter(pk=orders[0].pk).delete()
+        self.assertEqual(owner_totals(), {"EUR": (Decimal(4), 1)})
+        self.assertEqual(base_total(field=price), Decimal(4) * CurrencyExchangeRate.get_exchange_rate("eur"))
+
+    def test_rebuild(self):
+        MoneyAmount.objects.create(amount=Decimal(5), currency="USD")
+        MoneyAmountTotal.objects.all().delete()
+        out = StringIO()
+        call_command("rebuild_moneyamount_totals", stdout=out)
+        self.assertIn("1 wrong totals, rebuilt", out.getvalue())
+        self.assertTotals({"USD": (Decimal(5), 1)})
+
+
+class MoneyOrderingTestCase(TestCase):
+    def setUp(self):
+        self.values = [
+            MoneyAmount(amount=Decimal(2), currency="EUR"), Money(1, "USD"), Money(10, "SEK"),
+            MoneyAmount(amount=Decimal(1), currency="EUR"), MinorMoney(500, "SEK"),
+        ]
+
+    def test_rich_comparisons(self):
+        """ MoneyAmount objects should be sortable without a key on Python 3 """
+        a, b = MoneyAmount(amount=Decimal(1), currency="EUR"), MoneyAmount(amount=Decimal(5), currency="SEK")
+        self.assertTrue(b < a <= Money(1, "EUR") < Money(2, "EUR"))
+        self.assertEqual(sorted([a, b]), [b, a])
+        # Equal amounts in different rows must stay distinct, e.g. in the deletion Collector
+        saved = [MoneyAmount.objects.create(amount=Decimal(1), currency="EUR") for i in range(2)]
+        self.assertEqual(saved[0], saved[1])
+        self.assertEqual(len(set(saved)), 2)
+        a.amount = Decimal(2)
+        self.assertEqual(a.base_key, Decimal("19.2"))
+
+    def test_sorted(self):
+        """ Each key should be converted once, in one batch """
+        with mock.patch.object(CurrencyExchangeRate, "convert_many", wraps=CurrencyExchangeRate.convert_many) as convert:
+            result = money_sorted(self.values)
+        self.assertEqual(convert.call_count, 1)
+        self.assertEqual(result, [self.values[4], self.values[1], self.values[3], self.values[2], self.values[0]])
+        self.assertIs(money_max(self.values), self.values[0])
+        self.assertIs(money_min(self.values), self.values[4])
+        self.assertIsNone(money_min([]))
+
+    def test_numbers(self):
+        """ Numbers should be amounts in the currency of the value, in comparisons as in arithmetic """
+        for value in (MoneyAmount(amount=Decimal(1), currency="EUR"), Money(1, "EUR"), MinorMoney(100, "EUR")):
+            self.assertTrue(value == 1 and value < 2 and value > Decimal("0.5"))
+            self.assertEqual(value + 1, Money(2, "EUR"))
+        self.assertEqual(hash(Money(10, "SEK")), hash(10))
+        with self.assertRaises(TypeError):
+            money_sorted([Money(1, "EUR"), 9])
+
+    def test_bands(self):
+        bands = money_bands(self.values, [1, 2], "EUR")
+        self.assertEqual(bands, [[self.values[1], self.values[4]], [self.values[2], self.values[3]], [self.values[0]]])
@@ -0,0 +1,277 @@
+"""
+Running totals of the MoneyAmount table per currency, in the
+MoneyAmountTotal model, so that totals are read from one row per currency
+instead of aggregating every MoneyAmount. Maintained when TRACK_TOTALS is
+set, from MoneyAmount.save(), deletes through the ORM (post_delete),
+bulk_save_moneyamounts() and the orphan deletes. Raw SQL and
+QuerySet.update() on MoneyAmount are not tracked; rebuild_totals() (the
+rebuild_moneyamount_totals command) recalculates the table.
+
+The MoneyAmounts referenced by each MoneyAmountField are also totalled per
+currency, with the owner 'app_label.model.field'. These totals are kept
+from MoneyAmountField.pre_save() and the post_delete of the owning model,
+so they follow what the owners referenced when they were last saved: a
+MoneyAmount saved on its own is counted again when its owner is saved.
+Amounts stored in the columns of InlineMoneyAmountField and
+MinorMoneyAmountField are not included; aggregate the owning model with
+MoneyAmountOwnerQuerySet.total_in() or expressions.SumIn for those.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.backends.utils import format_number
+from django.db.models import Count, F, Max, Min, Sum
+
+TOTALS_SOURCE = '_totals_source'
+OWNER_TOTALS_SOURCES = '_owner_totals_sources'
+LOADED_MONEYAMOUNTS = '_loaded_moneyamounts'
+
+TotalDifference = namedtuple('TotalDifference', ['currency', 'stored', 'actual', 'owner'], defaults=[''])
+
+
+def _db_decimal(field, value):
+    """Rounds value the way it is stored in the column of field"""
+    return Decimal(format_number(Decimal(value), field.max_digits, field.decimal_places))
+
+
+def row_values(moneyamount):
+    """Returns (currency, amount, base_amount) of a MoneyAmount as stored"""
+    opts = moneyamount._meta
+    return (
+        moneyamount.currency.upper(),
+        _db_decimal(opts.get_field('amount'), moneyamount.amount),
+        _db_decimal(opts.get_field('base_amount'), moneyamount.base_amount),
+    )
+
+
+def mark_stored(moneyamount, values=None):
+    """Remembers the values of a MoneyAmount as they are in the database"""
+    moneyamount.__dict__[TOTALS_SOURCE] = values or row_values(moneyamount)
+
+
+def stored_values(moneyamount, using=None):
+    """
+    Returns (currency, amount, base_amount) of the stored row of a
+    MoneyAmount, or None if it has not been saved. The row is only queried
+    if the instance was not loaded or saved by this process.
+    """
+    if moneyamount.pk is None:
+        return None
+    values = moneyamount.__dict__.get(TOTALS_SOURCE)
+    if values is None:
+        values = _stored_row(moneyamount.__class__, moneyamount.pk, using)
+    return values
+
+
+def _stored_row(model, pk, using=None):
+    if pk is None:
+        return None
+    values = model._base_manager.using(using).filter(pk=pk).values_list('currency', 'amount', 'base_amount').first()
+    if values is not None:
+        values = (values[0].upper(), values[1], values[2])
+    return values
+
+
+def owner_key(field):
+    """Returns the owner of the totals of a MoneyAmountField, e.g. 'shop.order.price'"""
+    return '%s.%s' % (field.model._meta.label_lower, field.name)
+
+
+def counted_moneyamount(instance, field, using=None):
+    """
+    Returns (pk, values) of the MoneyAmount counted in the totals of field
+    for the owner instance: the one it referenced when it was loaded or last
+    saved, with (currency, amount, base_amount) as stored then, or None.
+    """
+    sources = instance.__dict__.get(OWNER_TOTALS_SOURCES, {})
+    if field.name in sources:
+        return sources[field.name]
+    pk = None if instance._state.adding else instance.__dict__.get(LOADED_MONEYAMOUNTS, {}).get(field.name)
+    return pk, _stored_row(field.remote_field.model, pk, using)
+
+
+def remember_counted(instance, field, moneyamount):
+    """
+    Remembers the values of moneyamount, loaded through field of the owner
+    instance, as the ones counted for it, so that saving moneyamount before
+    the owner is still seen as a change when the owner is saved.
+    """
+    sources = instance.__dict__.setdefault(OWNER_TOTALS_SOURCES, {})
+    if field.name in sources or instance._state.adding or moneyamount.pk is None:
+        return
+    if moneyamount.pk == instance.__dict__.get(LOADED_MONEYAMOUNTS, {}).get(field.name):
+        sources[field.name] = (moneyamount.pk, stored_values(moneyamount))
+
+
+def owner_deltas(instances, field, using=None):
+    """
+    Returns the deltas of the totals of field for saving the owner
+    instances, and remembers the MoneyAmounts they now reference as counted.
+    The MoneyAmounts have to be saved.
+    """
+    deltas = {}
+    for instance in instances:
+        pk = instance.__dict__.get(field.attname)
+        rel_obj = field.get_cached_value(instance) if field.is_cached(instance) else None
+        if (field.name not in instance.__dict__.get(OWNER_TOTALS_SOURCES, {}) and not instance._state.adding
+                and pk == instance.__dict__.get(LOADED_MONEYAMOUNTS, {}).get(field.name)
+                and (rel_obj is None or rel_obj.pk != pk)):
+            # Still the MoneyAmount it was loaded with, not loaded since
+            continue
+        old_pk, old = counted_moneyamount(instance, field, using)
+        if pk is None:
+            new = None
+        elif rel_obj is not None and rel_obj.pk == pk:
+            new = stored_values(rel_obj, using)
+        elif pk == old_pk:
+            new = old
+        else:
+            new = _stored_row(field.remote_field.model, pk, using)
+        instance.__dict__.setdefault(OWNER_TOTALS_SOURCES, {})[field.name] = (pk, new)
+        if old != new:
+            if old is not None:
+                add_delta(deltas, old, -1)
+            if new is not None:
+                add_delta(deltas, new)
+    return deltas
+
+
+def add_delta(deltas, values, sign=1, count=1):
+    currency, amount, base_amount = values
+    delta = deltas.setdefault(currency, [Decimal(0), Decimal(0), 0])
+    delta[0] += sign * amount
+    delta[1] += sign * base_amount
+    delta[2] += sign * count
+
+
+def change_deltas(moneyamounts, using=None):
+    """
+    Returns the deltas of saving the given MoneyAmount objects, as a dict of
+    [amount, base_amount, count] keyed by currency. Their base values have
+    to be up to date.
+    """
+    deltas = {}
+    for moneyamount in moneyamounts:
+        old = stored_values(moneyamount, using)
+        new = row_values(moneyamount)
+        if old == new:
+            continue
+        if old is not None:
+            add_delta(deltas, old, -1)
+        add_delta(deltas, new)
+    return deltas
+
+
+def queryset_deltas(queryset, sign=-1, path=''):
+    """
+    Returns the deltas of adding (sign=1) or removing the rows of queryset,
+    or of the MoneyAmounts its rows reference through path (e.g. 'price__').
+    """
+    deltas = {}
+    rows = queryset.order_by().values(path + 'currency').annotate(
+        total_amount=Sum(path + 'amount'), total_base_amount=Sum(path + 'base_amount'), total_count=Count(path + 'pk'))
+    for row in rows:
+        add_delta(deltas, (row[path + 'currency'].upper(), row['total_amount'] or Decimal(0),
+                           row['total_base_amount'] or Decimal(0)), sign, row['total_count'])
+    return deltas
+
+
+def apply_deltas(deltas, using=DEFAULT_DB_ALIAS, owner=''):
+    """Adds deltas to the MoneyAmountTotal of owner, with one UPDATE per currency"""
+    from .models import MoneyAmountTotal
+    manager = MoneyAmountTotal.objects.using(using)
+    for currency, (amount, base_amount, count) in deltas.items():
+        if not (amount or base_amount or count):
+            continue
+        changes = dict(amount=F('amount') + amount, base_amount=F('base_amount') + base_amount, count=F('count') + count)
+        if manager.filter(owner=owner, currency=currency).update(**changes):
+            continue
+        try:
+            with transaction.atomic(using=using):
+                manager.create(owner=owner, currency=currency, amount=amount, base_amount=base_amount, count=count)
+        except IntegrityError:
+            # Created by someone else in the meantime
+            manager.filter(owner=owner, currency=currency).update(**changes)
+
+
+def get_totals(using=DEFAULT_DB_ALIAS, field=None):
+    """
+    Returns a dict of MoneyAmountTotal objects keyed by currency, of all
+    MoneyAmounts or of those referenced by the MoneyAmountField field
+    """
+    from .models import MoneyAmountTotal
+    owner = owner_key(field) if field is not None else ''
+    return {total.currency: total for total in MoneyAmountTotal.objects.using(using).filter(owner=owner).exclude(count=0)}
+
+
+def base_total(using=DEFAULT_DB_ALIAS, field=None):
+    """Returns the total in base currency of all MoneyAmounts, or of those referenced by field"""
+    from .models import MoneyAmountTotal
+    owner = owner_key(field) if field is not None else ''
+    return MoneyAmountTotal.objects.using(using).filter(owner=owner) \
+        .aggregate(total=Sum('base_amount'))['total'] or Decimal(0)
+
+
+def _chunks(queryset, chunk_size):
+    """Splits queryset in ranges of chunk_size integer pks, if its pks are integers"""
+    if queryset.model._meta.pk.get_internal_type() not in ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField'):
+        yield queryset
+        return
+    bounds = queryset.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+    if bounds['max_pk'] is None:
+        return
+    for first_pk in range(bounds['min_pk'], bounds['max_pk'] + 1, chunk_size):
+        yield queryset.filter(pk__gte=first_pk, pk__lt=first_pk + chunk_size)
+
+
+def owner_fields():
+    """Returns the MoneyAmountFields of all installed models"""
+    from .fields import MoneyAmountField
+    return [
+        field for model in apps.get_models() for field in model._meta.local_concrete_fields
+        if isinstance(field, MoneyAmountField)
+    ]
+
+
+def rebuild_totals(chunk_size=10000, dry_run=False, using=DEFAULT_DB_ALIAS):
+    """
+    Recalculates the totals from the MoneyAmount table, and those of each
+    MoneyAmountField from its model, aggregating one pk range of chunk_size
+    at a time, and replaces MoneyAmountTotal with them unless dry_run.
+    Returns a list of TotalDifference for the totals that were wrong, with
+    (amount, base_amount, count) tuples.
+
+    MoneyAmounts saved or deleted while this runs may make the result
+    slightly off; run it when writes are few.
+    """
+    from .models import MoneyAmount, MoneyAmountTotal
+    sources = [('', MoneyAmount._base_manager.using(using), '')]
+    for field in owner_fields():
+        sources.append((owner_key(field), field.model._base_manager.using(using).filter(
+            **{'%s__isnull' % field.name: False}), field.name + '__'))
+    actual = {}
+    for owner, queryset, path in sources:
+        owner_actual = {}
+        for chunk in _chunks(queryset, chunk_size):
+            for currency, delta in queryset_deltas(chunk, 1, path).items():
+                add_delta(owner_actual, (currency, delta[0], delta[1]), 1, delta[2])
+        actual.update(((owner, currency), tuple(delta)) for currency, delta in owner_actual.items() if delta[2])
+    stored = {
+        (total.owner, total.currency): (total.amount, total.base_amount, total.count)
+        for total in MoneyAmountTotal.objects.using(using).exclude(count=0)
+    }
+    differences = [
+        TotalDifference(currency, stored.get((owner, currency)), actual.get((owner, currency)), owner)
+        for owner, currency in sorted(set(stored) | set(actual))
+        if stored.get((owner, currency)) != actual.get((owner, currency))
+    ]
+    if differences and not dry_run:
+        with transaction.atomic(using=using):
+            MoneyAmountTotal.objects.using(using).all().delete()
+            MoneyAmountTotal.objects.using(using).bulk_create([
+                MoneyAmountTotal(owner=owner, currency=currency, amount=amount, base_amount=base_amount, count=count)
+                for (owner, currency), (amount, base_amount, count) in actual.items()
+            ])
+    return differences
@@ -0,0 +1,58 @@
+from asgiref.sync import sync_to_async
+
+INLINE_COLUMNS = ('amount', 'currency', 'base_amount', 'base_exchange_rate')
+
+
+async def acall(obj, name, *args, **kwargs):
+    """
+    Calls the async variant of a method (e.g. aget() for get()) if obj has
+    one, as the Django async ORM and cache API do, or else runs the sync
+    method in a thread.
+    """
+    method = getattr(obj, 'a' + name, None)
+    if method is not None:
+        return await method(*args, **kwargs)
+    return await sync_to_async(getattr(obj, name))(*args, **kwargs)
+
+
+async def alist(queryset):
+    """Evaluates the queryset, with async iteration if Django supports it"""
+    if hasattr(queryset, '__aiter__'):
+        return [obj async for obj in queryset]
+    return await sync_to_async(list)(queryset)
+
+
+def copy_moneyamounts_inline(model, from_field, to_field, batch_size=1000, using=None):
+    """
+    Copies the values of the MoneyAmount objects related through the
+    MoneyAmountField `from_field` into the columns of the
+    InlineMoneyAmountField `to_field`, `batch_size` rows at a time. The stored
+    base amounts and exchange rates are copied as they are, not recalculated.
+
+    Works with historical models, so it can be used in a RunPython migration:
+
+    def forwards(apps, schema_editor):
+        copy_moneyamounts_inline(apps.get_model('shop', 'Order'), 'price', 'inline_price')
+
+    Returns the number of copied rows.
+    """
+    targets = [to_field, '%s_currency' % to_field, '%s_base_amount' % to_field, '%s_base_exchange_rate' % to_field]
+    sources = ['%s__%s' % (from_field, column) for column in INLINE_COLUMNS]
+    queryset = model._base_manager.using(using).filter(**{'%s__isnull' % from_field: False}).order_by('pk')
+    copied = 0
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(batch.values_list('pk', *sources)[:batch_size])
+        if not rows:
+            break
+        objs = []
+        for row in rows:
+            obj = model(pk=row[0])
+            for attname, value in zip(targets, row[1:]):
+                obj.__dict__[attname] = value
+            objs.append(obj)
+        model._base_manager.using(using).bulk_update(objs, targets)
+        copied += len(objs)
+        last_pk = rows[-1][0]
+    return copied